@@ -0,0 +1,721 @@
+"""
+Замеры производительности игровой логики.
+
+Запуск: python bench.py [имя замера ...]
+Без аргументов выполняются все замеры.
+"""
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from registry import GameRegistry
+from scheduler import DeadlineScheduler
+from shards import ShardRouter, ShardWorker, spawn
+from simulator import Simulator, percentile
+from storage import Storage, LRUCache, _save_snapshot, _select_top, _select_rank, _select_page, _record_game, _select_role_stats, _add_points_many
+from migrations import MIGRATIONS, migrate, _create_leaderboard, _create_snapshots, _create_indexes, _create_history
+from stukt import Game, StartGame, PhaseTimeout, distribute_roles
+
+
+def _timeit(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat
+
+
+# Поиск игры игрока при обработке callback
+def bench_lookup(games=1000, players_per_game=10, lookups=20000):
+    registry = GameRegistry()
+    plain = {}
+    for chat_id in range(games):
+        game = Game()
+        game.chat_id = -chat_id - 1
+        registry[game.chat_id] = game
+        plain[game.chat_id] = game
+        for i in range(players_per_game):
+            game.add_player(chat_id * players_per_game + i, f"player{i}")
+
+    rnd = random.Random(1)
+    ids = [rnd.randrange(games * players_per_game) for _ in range(lookups)]
+
+    def scan():
+        for player_id in ids:
+            next((g for g in plain.values() if player_id in [p.player_id for p in g.players]), None)
+
+    def indexed():
+        for player_id in ids:
+            registry.game_for_player(player_id)
+
+    scan_time = _timeit(scan, 1) / lookups
+    index_time = _timeit(indexed, 5) / lookups
+    print(f"lookup: {games} игр x {players_per_game} игроков")
+    print(f"  перебор active_games: {scan_time * 1e6:10.2f} мкс/поиск")
+    print(f"  индекс GameRegistry:  {index_time * 1e6:10.2f} мкс/поиск")
+
+
+# Полные партии: игр в секунду для разного числа игроков
+def bench_games(games=200, sizes=(4, 8, 12, 15)):
+    print("games: полные партии случайными агентами")
+    for players in sizes:
+        started = time.perf_counter()
+        for seed in range(games):
+            Simulator(players, seed).play()
+        elapsed = time.perf_counter() - started
+        print(f"  {players:2} игроков: {games / elapsed:10.1f} игр/с")
+
+
+# Разрешение ночи: process_night_actions на случайных действиях
+def bench_nights(nights=2000, sizes=(4, 8, 12, 15)):
+    print("nights: process_night_actions")
+    for players in sizes:
+        rng = random.Random(players)
+        prepared = []
+        for _ in range(nights):
+            game = Game(chat_id=-1, rng=rng)
+            for player_id in range(1, players + 1):
+                game.add_player(player_id, f"Игрок {player_id}")
+            game.start_game()
+            distribute_roles(game.players, rng)
+            for effect in game.night_keyboards():
+                if effect.buttons:
+                    data = rng.choice(effect.buttons)[0][1].split(":")
+                    if data[1] != "skip":
+                        game.night_actions.append({"action": data[1], "player_id": effect.chat_id, "target_id": int(data[-1])})
+            prepared.append(game)
+
+        started = time.perf_counter()
+        for game in prepared:
+            game.process_night_actions()
+        elapsed = time.perf_counter() - started
+        print(f"  {players:2} игроков: {nights / elapsed:10.1f} ночей/с")
+
+
+# Память активных игр: партия после раздачи ролей, без очередей и базы
+def bench_memory(games=10000, players=10):
+    import gc
+    import tracemalloc
+
+    rng = random.Random(9)
+
+    def build():
+        result = []
+        for chat_id in range(games):
+            game = Game(chat_id=-chat_id - 1, rng=rng)
+            for player_id in range(1, players + 1):
+                game.add_player(chat_id * 100 + player_id, f"Игрок {player_id}")
+            game.creator_id = game.players[0].player_id
+            game.handle(StartGame(game.creator_id))
+            result.append(game)
+        return result
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    prepared = build()
+    gc.collect()
+    total = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    def deep(obj):
+        size = sys.getsizeof(obj)
+        if hasattr(obj, "__dict__"):
+            size += sys.getsizeof(obj.__dict__)
+        return size
+
+    # Игроки и роли отдельно: запись игрока, объект роли и его __dict__, если он есть
+    roles = {id(p.role): p.role for game in prepared for p in game.players}
+    per_players = (sum(deep(p) for game in prepared for p in game.players) + sum(deep(r) for r in roles.values())) / games
+    print(f"memory: {games} игр по {players} игроков после раздачи ролей")
+    print(f"  на игру: {total / games / 1024:8.2f} КБ, из них игроки и роли {per_players / 1024:6.2f} КБ")
+    print(f"  на {games} игр: {total / 1024 / 1024:8.2f} МБ")
+
+
+# Клавиатуры ночи и номинаций в симуляторе: сколько объектов кнопок создаётся
+def bench_keyboards(games=300, players=15):
+    from simulator import StatsSink
+    from stukt import SendMessage
+
+    class KeyboardSink(StatsSink):
+        # Держит клавиатуры до конца партии, чтобы id объектов не переиспользовались
+        def __init__(self):
+            super().__init__()
+            self.keyboards = []
+
+        def consume(self, effects):
+            super().consume(effects)
+            self.keyboards += [e.buttons for e in effects if isinstance(e, SendMessage) and e.buttons]
+
+    messages = rows = size = 0
+    handle_time = 0.0
+    for seed in range(games):
+        sink = KeyboardSink()
+        simulator = Simulator(players, seed, sink=sink)
+        simulator.play()
+        handle_time += sum(sum(values) for values in simulator.latencies.values())
+        seen = set()
+        for buttons in sink.keyboards:
+            messages += 1
+            size += sys.getsizeof(buttons)
+            for row in buttons:
+                if id(row) in seen:
+                    continue
+                seen.add(id(row))
+                rows += 1
+                size += sys.getsizeof(row) + sum(sys.getsizeof(b) + sys.getsizeof(b[0]) + sys.getsizeof(b[1]) for b in row)
+    print(f"keyboards: {games} партий по {players} игроков")
+    print(f"  клавиатур на партию: {messages / games:8.1f}, различных рядов: {rows / games:8.1f}")
+    print(f"  память кнопок на партию: {size / games / 1024:8.1f} КБ, handle(): {handle_time / games * 1000:6.2f} мс на партию")
+
+
+# Задержка одного перехода по фазам (p50/p99)
+def bench_phases(games=300, players=10):
+    latencies = {}
+    for seed in range(games):
+        sim = Simulator(players, seed)
+        sim.play()
+        for phase, values in sim.latencies.items():
+            latencies.setdefault(phase, []).extend(values)
+    print(f"phases: {players} игроков, {games} партий")
+    for phase, values in sorted(latencies.items()):
+        print(f"  {phase:11} p50 {percentile(values, 50) * 1e6:8.1f} мкс   p99 {percentile(values, 99) * 1e6:8.1f} мкс   n={len(values)}")
+
+
+# Дедлайны фаз: взвод, перевзвод и срабатывание для множества игр
+def bench_timers(games=100000):
+    async def noop(key, payload):
+        pass
+
+    scheduler = DeadlineScheduler(noop)
+    rnd = random.Random(3)
+    started = time.perf_counter()
+    for game_id in range(games):
+        scheduler.arm(game_id, rnd.uniform(0, 90))
+    armed = time.perf_counter() - started
+
+    # Каждая игра досрочно переходит в следующую фазу
+    started = time.perf_counter()
+    for game_id in range(games):
+        scheduler.arm(game_id, rnd.uniform(0, 90))
+    rearmed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    due = scheduler.pop_due(time.monotonic() + 1000)
+    popped = time.perf_counter() - started
+    print(f"timers: {games} игр, сработало {len(due)}")
+    print(f"  взвод:       {armed / games * 1e6:8.2f} мкс")
+    print(f"  перевзвод:   {rearmed / games * 1e6:8.2f} мкс")
+    print(f"  срабатывание {popped / games * 1e6:8.2f} мкс")
+
+
+# Восстановление активных игр из снимков при старте бота
+def bench_restore(games=10000, players=10):
+    path = os.path.join(tempfile.mkdtemp(), "restore.db")
+    storage = Storage(path)
+    rng = random.Random(4)
+
+    def fill(conn):
+        _create_snapshots(conn)
+        for chat_id in range(games):
+            game = Game(chat_id=-chat_id - 1, rng=rng)
+            game.creator_id = 1
+            for player_id in range(1, players + 1):
+                game.add_player(chat_id * 100 + player_id, f"Игрок {player_id}")
+            game.creator_id = game.players[0].player_id
+            game.handle(StartGame(game.creator_id))
+            data = json.dumps(game.to_dict(), ensure_ascii=False, separators=(",", ":"))
+            _save_snapshot(conn, game.chat_id, game.game_id, data, time.time() + 60)
+
+    async def restore():
+        async def noop(key, payload):
+            pass
+
+        registry = GameRegistry()
+        deadlines = DeadlineScheduler(noop)
+        started = time.perf_counter()
+        for chat_id, version, data, deadline in await storage.load_snapshots():
+            game = Game.from_dict(json.loads(data))
+            registry[chat_id] = game
+            deadlines.arm(game.game_id, max(0.0, deadline - time.time()), (game, PhaseTimeout(game.phase_seq)))
+        return time.perf_counter() - started, len(registry)
+
+    storage.submit(fill).result()
+    elapsed, restored = asyncio.run(restore())
+    storage.close()
+    size = os.path.getsize(path)
+    print(f"restore: {restored} игр по {players} игроков, база {size / 1e6:.1f} МБ")
+    print(f"  восстановление: {elapsed * 1000:8.1f} мс  ({elapsed / restored * 1e6:.1f} мкс/игра)")
+
+
+# Хранилища снимков игр: CAS, конфликт версий, индекс игроков и скорость записи.
+# Падает с AssertionError, если бэкенд разошёлся с контрактом GameStore.
+def bench_stores(writes=1000):
+    from store import MemoryStore, SQLiteStore, RedisStore, RedisStandIn, VersionConflict
+
+    async def check(store):
+        assert await store.get(-1) is None
+        assert await store.compare_and_swap(-1, "g1", 0, "{}", 100.0, [1, 2]) == 1
+        version, data, deadline = await store.get(-1)
+        assert (version, data, deadline) == (1, "{}", 100.0), (version, data, deadline)
+        try:
+            await store.compare_and_swap(-1, "g1", 0, "{}")
+            raise AssertionError("запись со старой версией прошла")
+        except VersionConflict as e:
+            assert (e.expected, e.actual) == (0, 1), (e.expected, e.actual)
+        assert await store.compare_and_swap(-1, "g1", 1, '{"a":1}', None, [2, 3]) == 2
+        assert await store.games_for_player(1) == [] and await store.games_for_player(3) == [-1]
+        # Две реплики пишут одну версию одновременно: проходит ровно одна
+        results = await asyncio.gather(store.compare_and_swap(-1, "g1", 2, "{}"), store.compare_and_swap(-1, "g1", 2, "{}"),
+                                       return_exceptions=True)
+        assert sorted(type(r).__name__ for r in results) == ["VersionConflict", "int"], results
+        try:
+            await store.delete(-1, 1)
+            raise AssertionError("удаление со старой версией прошло")
+        except VersionConflict:
+            pass
+        assert [row[0] for row in await store.load_all()] == [-1]
+        await store.delete(-1, 3)
+        assert await store.get(-1) is None and await store.games_for_player(2) == []
+
+        started = time.perf_counter()
+        version = 0
+        for _ in range(writes):
+            version = await store.compare_and_swap(-2, "g2", version, "{}" * 500, None, range(10))
+        elapsed = time.perf_counter() - started
+        await store.delete(-2)
+        return elapsed
+
+    async def run():
+        storage = Storage(os.path.join(tempfile.mkdtemp(), "store.db"))
+        await storage.write(migrate)
+        standin = RedisStandIn()
+        port = await standin.start(port=0)
+        redis = RedisStore(port=port)
+        results = []
+        for title, store in (("memory", MemoryStore()), ("sqlite", SQLiteStore(storage)), ("redis (замена)", redis)):
+            results.append((title, await check(store)))
+        await redis.close()
+        await standin.stop()
+        storage.close()
+        return results
+
+    print(f"stores: CAS и конфликты версий, {writes} записей снимка подряд")
+    for title, elapsed in asyncio.run(run()):
+        print(f"  {title:<15} контракт соблюдён, {elapsed / writes * 1e6:8.1f} мкс на запись")
+
+
+def _fill_leaderboard(conn, users, seed=5):
+    rng = random.Random(seed)
+    _create_leaderboard(conn)
+    conn.executemany(
+        "INSERT INTO leaderboard (telegram_id, username, full_name, points, games_played, games_won) VALUES (?, ?, ?, ?, ?, ?)",
+        ((i, f"user{i}", f"Игрок {i}", rng.randrange(10000), rng.randrange(200), rng.randrange(100)) for i in range(users)),
+    )
+
+
+# /leaderboard: сортировка без индекса, по индексу и готовый текст из памяти
+def bench_leaderboard(users=100000, requests=200):
+    path = os.path.join(tempfile.mkdtemp(), "leaders.db")
+    storage = Storage(path)
+    storage.submit(_fill_leaderboard, users).result()
+
+    async def run():
+        started = time.perf_counter()
+        for _ in range(requests):
+            await storage.read(_select_top, 15)
+        plain = (time.perf_counter() - started) / requests
+        await storage.write(_create_indexes)
+        started = time.perf_counter()
+        for _ in range(requests):
+            await storage.read(_select_top, 15)
+        indexed = (time.perf_counter() - started) / requests
+        await storage.leaderboard.text(str)
+        started = time.perf_counter()
+        for _ in range(requests):
+            await storage.leaderboard.text(str)
+        cached = (time.perf_counter() - started) / requests
+        return plain, indexed, cached
+
+    plain, indexed, cached = asyncio.run(run())
+    storage.close()
+    print(f"leaderboard: {users} игроков, топ-15")
+    print(f"  без индекса:     {plain * 1e6:10.1f} мкс")
+    print(f"  по индексу:      {indexed * 1e6:10.1f} мкс")
+    print(f"  текст из памяти: {cached * 1e6:10.1f} мкс")
+
+
+# /mystats: место игрока среди миллиона
+def bench_rank(users=1000000, lookups=2000):
+    import sqlite3
+
+    conn = sqlite3.connect(os.path.join(tempfile.mkdtemp(), "rank.db"))
+    _fill_leaderboard(conn, users)
+    _create_indexes(conn)
+    conn.commit()
+    rng = random.Random(6)
+    ids = [rng.randrange(users) for _ in range(lookups)]
+    timings = []
+    for telegram_id in ids:
+        started = time.perf_counter()
+        _select_rank(conn, telegram_id)
+        timings.append(time.perf_counter() - started)
+    naive = []
+    for telegram_id in ids[:50]:
+        started = time.perf_counter()
+        conn.execute('''
+            SELECT COUNT(*) + 1 FROM leaderboard
+            WHERE points > (SELECT points FROM leaderboard WHERE telegram_id = ?)
+        ''', (telegram_id,)).fetchone()
+        naive.append(time.perf_counter() - started)
+    conn.close()
+    print(f"rank: {users} игроков, {lookups} запросов места")
+    print(f"  гистограмма: p50 {percentile(timings, 50) * 1000:.3f} мс  p99 {percentile(timings, 99) * 1000:.3f} мс  max {max(timings) * 1000:.3f} мс")
+    print(f"  COUNT по индексу: p50 {percentile(naive, 50) * 1000:.3f} мс  max {max(naive) * 1000:.3f} мс")
+
+
+# Дальние страницы таблицы лидеров: OFFSET против keyset
+def bench_pages(users=100000, depths=(1, 100, 1000, 6000), page=15):
+    import sqlite3
+
+    conn = sqlite3.connect(os.path.join(tempfile.mkdtemp(), "pages.db"))
+    _fill_leaderboard(conn, users)
+    _create_indexes(conn)
+    conn.commit()
+    print(f"pages: {users} игроков, страница {page}")
+    for depth in depths:
+        offset = depth * page
+        started = time.perf_counter()
+        conn.execute('''
+            SELECT telegram_id, username, full_name, points FROM leaderboard
+            ORDER BY points DESC, telegram_id LIMIT ? OFFSET ?
+        ''', (page, offset)).fetchall()
+        by_offset = time.perf_counter() - started
+        cursor = conn.execute('''
+            SELECT points, telegram_id FROM leaderboard
+            ORDER BY points DESC, telegram_id LIMIT 1 OFFSET ?
+        ''', (offset - 1,)).fetchone()
+        started = time.perf_counter()
+        _select_page(conn, cursor[0], cursor[1], True, page + 1)
+        by_keyset = time.perf_counter() - started
+        print(f"  страница {depth:5}: OFFSET {by_offset * 1000:8.3f} мс  keyset {by_keyset * 1000:8.3f} мс")
+    conn.close()
+
+
+# История партий: запись итогов и аналитика по ролям
+def bench_history(games=5000, players=10):
+    import sqlite3
+
+    conn = sqlite3.connect(os.path.join(tempfile.mkdtemp(), "history.db"))
+    _create_history(conn)
+    settlements = []
+    for seed in range(games):
+        sim = Simulator(players, seed)
+        sim.play()
+        settlements.append(sim.sink.settlements[-1])
+    started = time.perf_counter()
+    for settlement in settlements:
+        _record_game(conn, settlement)
+        conn.commit()
+    written = time.perf_counter() - started
+    events = conn.execute("SELECT COUNT(*) FROM game_events").fetchone()[0]
+
+    started = time.perf_counter()
+    materialized = _select_role_stats(conn)
+    by_table = time.perf_counter() - started
+    started = time.perf_counter()
+    raw = conn.execute('''
+        SELECT role, COUNT(*), SUM(won), 100.0 * SUM(won) / COUNT(*)
+        FROM game_players GROUP BY role ORDER BY COUNT(*) DESC
+    ''').fetchall()
+    by_scan = time.perf_counter() - started
+    assert sorted(materialized) == sorted(raw)
+    conn.close()
+    print(f"history: {games} партий по {players} игроков, {events} событий")
+    print(f"  запись партии:        {written / games * 1000:8.3f} мс")
+    print(f"  роли из агрегатов:    {by_table * 1000:8.3f} мс")
+    print(f"  роли обходом истории: {by_scan * 1000:8.3f} мс")
+
+
+# Миграции на большой базе, созданной старым script.py (user_version = 0)
+def bench_migrate(users=1000000):
+    import sqlite3
+
+    conn = sqlite3.connect(os.path.join(tempfile.mkdtemp(), "legacy.db"))
+    conn.execute("PRAGMA journal_mode=WAL")
+    _fill_leaderboard(conn, users)
+    conn.commit()
+    names = {version: name for version, name, _ in MIGRATIONS}
+    print(f"migrate: {users} игроков в leaderboard")
+    started = time.perf_counter()
+    for version, elapsed in migrate(conn):
+        print(f"  {version}. {names[version]:<35} {elapsed * 1000:9.1f} мс")
+    print(f"  всего: {(time.perf_counter() - started) * 1000:.1f} мс")
+    started = time.perf_counter()
+    migrate(conn)
+    print(f"  повторный запуск: {(time.perf_counter() - started) * 1000:.3f} мс")
+    conn.close()
+
+
+# Сброс очков за сообщения (PointsAccumulator): цена триггеров гистограммы очков
+def bench_flush(users=100000, batch=500, batches=100):
+    import sqlite3
+
+    rng = random.Random(11)
+    work = [[(rng.randrange(1, 5), "2024-01-01T00:00:00", rng.randrange(users)) for _ in range(batch)]
+            for _ in range(batches)]
+    print(f"flush: {users} игроков, {batches} сбросов по {batch} строк")
+    base = None
+    for title, triggers in (("индекс без триггеров", False), ("индекс и триггеры", True)):
+        conn = sqlite3.connect(os.path.join(tempfile.mkdtemp(), "flush.db"), isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _fill_leaderboard(conn, users)
+        _create_indexes(conn)
+        if not triggers:
+            for name in ("insert", "delete", "update"):
+                conn.execute(f"DROP TRIGGER leaderboard_points_{name}")
+        started = time.perf_counter()
+        for rows in work:
+            conn.execute("BEGIN")
+            _add_points_many(conn, rows)
+            conn.execute("COMMIT")
+        elapsed = (time.perf_counter() - started) / batches
+        conn.close()
+        base = base or elapsed
+        print(f"  {title:<22} {elapsed * 1000:7.2f} мс на сброс, {elapsed / batch * 1e6:6.1f} мкс на строку"
+              f"  (x{elapsed / base:.2f})")
+
+
+# Регистрация при /start и /join: повторные входы одних и тех же игроков
+def bench_users(users=1000, joins=20000):
+    rng = random.Random(7)
+    order = [rng.randrange(users) for _ in range(joins)]
+
+    async def run(storage):
+        await storage.write(migrate)
+        started = time.perf_counter()
+        for telegram_id in order:
+            # Каждый сотый вход — со сменой имени
+            suffix = "" if rng.random() > 0.01 else "!"
+            await storage.add_user(telegram_id, f"user{telegram_id}", f"Игрок {telegram_id}{suffix}")
+        return time.perf_counter() - started
+
+    print(f"users: {joins} входов {users} игроков")
+    for title, capacity in (("без кэша", 0), ("с кэшем", 10000)):
+        storage = Storage(os.path.join(tempfile.mkdtemp(), "users.db"))
+        storage.known_users = LRUCache(capacity)
+        elapsed = asyncio.run(run(storage))
+        storage.close()
+        print(f"  {title}: {elapsed / joins * 1e6:8.1f} мкс на вход, попаданий {storage.known_users.hits}")
+
+
+# Цена строки лога для цикла событий: print против очереди с JSON в потоке
+def bench_logging(calls=20000, players=15):
+    import logging
+    from logs import setup_logging, bind_game, DebugSampler
+
+    actions = {1000 + i: {"action": "kill", "target": 2000 + i, "name": f"Игрок {i}"} for i in range(players)}
+    out = open(os.path.join(tempfile.mkdtemp(), "log.txt"), "w", encoding="utf-8")
+    print(f"logging: {calls} строк, словарь на {players} игроков")
+
+    def report(title, elapsed, total=None):
+        line = f"  {title:<28} {elapsed / calls * 1e6:7.2f} мкс в цикле"
+        if total is not None:
+            line += f", {total / calls * 1e6:7.2f} мкс с записью"
+        print(line)
+
+    report("print(f-строка)", _timeit(lambda: print(f"Night actions: {actions}", file=out), calls) * calls)
+
+    root = logging.getLogger()
+    handler = logging.StreamHandler(out)
+    root.handlers[:] = [handler]
+    root.setLevel(logging.INFO)
+    report("logging в потоке цикла", _timeit(lambda: logging.info("Ночные действия: %s", actions), calls) * calls)
+    report("debug выключен", _timeit(lambda: logging.debug("Ночные действия: %s", actions), calls) * calls)
+
+    # На одном ядре поток записи делит GIL с циклом, поэтому отдельно меряется
+    # пачка строк, пока поток стоит (так выглядит всплеск нажатий), и разбор после
+    cases = (("очередь + JSON", logging.INFO, None, True),
+             ("очередь, поток остановлен", logging.INFO, None, False),
+             ("debug с ограничителем", logging.DEBUG, DebugSampler(rate=100, burst=100), True))
+    for title, level, sampler, running in cases:
+        listener = setup_logging(level, stream=out, sampler=sampler)
+        if not running:
+            listener.stop()
+        started = time.perf_counter()
+        with bind_game("bench"):
+            for _ in range(calls):
+                logging.log(level, "Ночные действия: %s", actions)
+        elapsed = time.perf_counter() - started
+        if not running:
+            listener.start()
+        listener.stop()
+        report(title, elapsed, time.perf_counter() - started)
+    out.close()
+
+
+class _FakeBot:
+    """
+    Локальная замена Bot для очереди отправки: записывает вызовы
+    (секунды от старта, метод, chat_id, текст); на тексты из flood
+    первый раз отвечает RetryAfter.
+    """
+    def __init__(self, flood=()):
+        self.calls = []
+        self.flood = set(flood)
+        self.started = time.monotonic()
+
+    async def _call(self, method, chat_id, text):
+        if text in self.flood:
+            from aiogram.exceptions import TelegramRetryAfter
+            from aiogram.methods import SendMessage
+            self.flood.discard(text)
+            raise TelegramRetryAfter(SendMessage(chat_id=chat_id, text=text), "Too Many Requests", retry_after=1)
+        self.calls.append((time.monotonic() - self.started, method, chat_id, text))
+        return len(self.calls)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self._call("send_message", chat_id, text)
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        return await self._call("edit_message_text", chat_id, text)
+
+    async def delete_message(self, chat_id, message_id):
+        return await self._call("delete_message", chat_id, None)
+
+
+# Проверка очереди отправки на фейке: порядок, лимиты, RetryAfter, склейка правок.
+# Падает с AssertionError, если поведение OutboundScheduler изменилось.
+def bench_outbox(group=-100):
+    from outbound import OutboundScheduler, PHASE, NORMAL, RELAY
+
+    async def run(check, flood=(), **limits):
+        bot = _FakeBot(flood)
+        scheduler = OutboundScheduler(bot, **limits)
+        result = await check(bot, scheduler)
+        await scheduler.stop()
+        return bot, scheduler, result
+
+    async def priorities(bot, scheduler):
+        # Очередь ещё не запущена: всё ждёт, пока не начнётся отправка
+        futures = [scheduler.send_message(group, "relay", priority=RELAY),
+                   scheduler.send_message(group, "normal", priority=NORMAL),
+                   scheduler.send_message(group, "phase1", priority=PHASE),
+                   scheduler.send_message(group, "phase2", priority=PHASE)]
+        scheduler.start()
+        await asyncio.gather(*futures)
+
+    async def burst(bot, scheduler):
+        scheduler.start()
+        await asyncio.gather(*(scheduler.send_message(group, f"m{i}") for i in range(8)))
+
+    async def retry(bot, scheduler):
+        scheduler.start()
+        first = scheduler.send_message(group, "flood")
+        await asyncio.sleep(0.05)
+        # Другой чат тоже ждёт: флуд-контроль общий на бота
+        await asyncio.gather(first, scheduler.send_message(42, "other"))
+
+    async def coalesce(bot, scheduler):
+        futures = [scheduler.edit_message_text(group, 7, f"edit{i}") for i in range(3)]
+        futures.append(scheduler.edit_message_text(group, 8, "gone"))
+        futures.append(scheduler.delete_message(group, 8))
+        scheduler.start()
+        return await asyncio.gather(*futures)
+
+    print("outbox: очередь отправки на фейковом боте")
+    bot, _, _ = asyncio.run(run(priorities))
+    texts = [text for _, _, _, text in bot.calls]
+    assert texts == ["phase1", "phase2", "normal", "relay"], texts
+    print(f"  приоритеты:      {' < '.join(texts)}")
+
+    bot, _, _ = asyncio.run(run(burst, group_rate=10, group_burst=5))
+    times = [at for at, _, _, _ in bot.calls]
+    assert times[4] < 0.05 and times[5] >= 0.09, times
+    print(f"  запас группы:    5 сразу за {times[4] * 1000:.1f} мс, шестое через {times[5] * 1000:.0f} мс")
+
+    bot, scheduler, _ = asyncio.run(run(retry, flood={"flood"}))
+    sent = {text: at for at, _, _, text in bot.calls}
+    assert scheduler.retries == 1 and sent["flood"] >= 1 and sent["other"] >= 1, (scheduler.retries, sent)
+    print(f"  RetryAfter 1 с:  повтор через {sent['flood']:.2f} с, другой чат через {sent['other']:.2f} с")
+
+    bot, scheduler, results = asyncio.run(run(coalesce))
+    calls = [(method, text) for _, method, _, text in bot.calls]
+    assert calls == [("edit_message_text", "edit2"), ("delete_message", None)], calls
+    assert scheduler.coalesced == 2 and results[0] == results[2], (scheduler.coalesced, results)
+    print("  склейка правок:  3 правки -> 1 запрос, правка перед удалением отброшена")
+
+
+# Нагрузочный тест шардов: каждое обновление — целая партия в симуляторе
+def bench_shards(updates=400, players=8, counts=(1, 2, 4)):
+    from aiogram.types import Update
+
+    path = os.path.join(tempfile.mkdtemp(), "shards.sock")
+
+    def worker(shard):
+        async def handle(payload):
+            data = json.loads(payload)
+            Simulator(players, seed=data["update_id"]).play()
+
+        asyncio.run(ShardWorker(shard, handle, path).run())
+
+    def message(update_id):
+        chat_id = -1000 - update_id
+        return Update.model_validate({"update_id": update_id, "message": {
+            "message_id": update_id, "date": 0, "text": "/startgame",
+            "chat": {"id": chat_id, "type": "supergroup"},
+            "from": {"id": update_id, "is_bot": False, "first_name": "Игрок"},
+        }})
+
+    batch = [message(update_id) for update_id in range(updates)]
+    print(f"shards: {updates} обновлений, партия на {players} игроков на каждое, ядер: {os.cpu_count()}")
+    base = None
+    for count in counts:
+        async def front(processes):
+            router = ShardRouter(count, path)
+            await router.start()
+            await router.wait_ready()
+            started = time.perf_counter()
+            for update in batch:
+                await router.forward(update)
+            await router.stop()
+            for process in processes:
+                await asyncio.to_thread(process.join)
+            return time.perf_counter() - started, router.routed
+
+        elapsed, routed = asyncio.run(front(spawn(count, worker)))
+        base = base or elapsed
+        print(f"  {count} шард(а): {updates / elapsed:8.1f} обновлений/с  ускорение x{base / elapsed:.2f}  {routed}")
+
+
+BENCHMARKS = {
+    "lookup": bench_lookup,
+    "games": bench_games,
+    "nights": bench_nights,
+    "phases": bench_phases,
+    "timers": bench_timers,
+    "restore": bench_restore,
+    "stores": bench_stores,
+    "shards": bench_shards,
+    "leaderboard": bench_leaderboard,
+    "rank": bench_rank,
+    "pages": bench_pages,
+    "history": bench_history,
+    "migrate": bench_migrate,
+    "flush": bench_flush,
+    "users": bench_users,
+    "logging": bench_logging,
+    "memory": bench_memory,
+    "keyboards": bench_keyboards,
+    "outbox": bench_outbox,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
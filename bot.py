@@ -2,21 +2,29 @@ import logging
 from aiogram import Bot, Dispatcher, Router
 from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.filters import Command
-from stukt import Game, Mafia, DonMafia, Commissioner, Doctor, Villager, Lover, Kamikaze, Hobo, Judge, Maniac
-import random
-import sqlite3
+from stukt import Game, MAFIA
+from stukt import SendMessage, EditMessage, AnswerCallback, StatsDelta, Settle, Schedule, GameOver
+from stukt import StartGame, NightAction, Nominate, FinalVote, PhaseTimeout
+from storage import db, chat_points, LRUCache
+from migrations import migrate
+from store import open_store, VersionConflict
+from registry import GameRegistry
+from outbound import OutboundScheduler, TokenBucket, PHASE, RELAY
+from scheduler import DeadlineScheduler
+from webhook import WebhookServer, UpdateLatency
+from shards import HashRing, ShardRouter, ShardWorker, spawn
+from metrics import REGISTRY, HandlerMetrics, TelegramMetrics, MetricsServer
+from logs import setup_logging, bind_game
+from aiogram.types import Update
+import asyncio
+import json
+import math
+import secrets
+import time
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import os
 
-# Функция для создания соединения с базой данных
-def connect_db():
-    conn = sqlite3.connect("leaderboard.db")
-    return conn
-
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
-
 # Создаем экземпляры бота и маршрутизатора
 load_dotenv()
 API_TOKEN = os.getenv("TELEGRAM_TOKEN")
@@ -24,78 +32,106 @@ API_TOKEN = os.getenv("TELEGRAM_TOKEN")
 bot = Bot(token=API_TOKEN)
 dp = Dispatcher()
 router = Router()
-port = os.getenv('PORT', 10000)
-
-# Хранилище активных игр
-active_games = {}
+port = int(os.getenv('PORT', 10000))
+# Режим приёма обновлений: polling (по умолчанию) или webhook
+MODE = os.getenv("MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес, например https://example.com/webhook
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+# Число процессов с играми; при SHARDS > 1 этот процесс только раздаёт обновления
+SHARDS = int(os.getenv("SHARDS", 1))
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))  # 0 — не поднимать /metrics
+# Задержка от получения обновления до обработчика (для сравнения режимов)
+latency = UpdateLatency(os.getenv("RECORD_UPDATES"))
+dp.update.outer_middleware(latency)
+
+# Метрики: обновления по типу снаружи, обработчики по имени внутри роутера
+handler_metrics = HandlerMetrics(sample=float(os.getenv("LOG_SAMPLE", 0.01)))
+dp.update.outer_middleware(handler_metrics)
+router.message.middleware(handler_metrics)
+router.callback_query.middleware(handler_metrics)
+bot.session.middleware(TelegramMetrics())
+# Все исходящие сообщения идут через очередь с учётом лимитов Telegram
+outbox = OutboundScheduler(bot)
+
+# Хранилище активных игр (с индексом игрок -> игра)
+active_games = GameRegistry()
+# Снимки игр: memory, sqlite или redis://host:port (общий для нескольких реплик)
+store = open_store(os.getenv("GAME_STORE", "sqlite"), db)
 user_data = {}
 
+# Ответ в тот же чат (и тему форума) через очередь отправки
+async def answer(message, text, **kwargs):
+    thread_id = message.message_thread_id if message.is_topic_message else None
+    return await outbox.send_message(message.chat.id, text, message_thread_id=thread_id, **kwargs)
+
+# Замена текста сообщения с кнопками после выбора игрока
+async def edit_choice(callback, text):
+    return await outbox.edit_message_text(callback.message.chat.id, callback.message.message_id, text, reply_markup=None)
+
 # Функция для проверки информации о пользователе
-def get_user_info(telegram_id):
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM leaderboard WHERE telegram_id = ?", (telegram_id,))
-    user = cursor.fetchone()
-    conn.close()
-
-    if user:
+async def get_user_info(telegram_id):
+    user, rank = await asyncio.gather(db.get_user(telegram_id), db.get_user_rank(telegram_id))
+
+    if user and rank:
+        win_rate = user[5] / user[4] * 100 if user[4] else 0
+        place, total = rank
+        standing = f"\nМесто в рейтинге: *{place}* из {total}\nВходит в топ *{max(1, math.ceil(place / total * 100))}%*\nПроцент побед: *{win_rate:.0f}%*"
         if user[1] != "":
-            return f"Пользователь: *{user[2]} (@{user[1]})*\nЧисло очков: *{user[3]}*\nСыграно игр: *{user[4]}*\nВыиграно игр: *{user[5]}*"
-        else: return f"Пользователь: [{user[2]}](tg://user?id={telegram_id})\nЧисло очков: *{user[3]}*\nСыграно игр: *{user[4]}*\nВыиграно игр: *{user[5]}*"
+            return f"Пользователь: *{user[2]} (@{user[1]})*\nЧисло очков: *{user[3]}*\nСыграно игр: *{user[4]}*\nВыиграно игр: *{user[5]}*" + standing
+        else: return f"Пользователь: [{user[2]}](tg://user?id={telegram_id})\nЧисло очков: *{user[3]}*\nСыграно игр: *{user[4]}*\nВыиграно игр: *{user[5]}*" + standing
     else:
-        print(f"Пользователь с ID {telegram_id} не найден.")
+        logging.debug("Пользователь %s не найден", telegram_id)
         return None
 
 # Функция для добавления игроков в таблицу
-def add_pdb(message):
-    conn = connect_db()
-    cursor = conn.cursor()
+async def add_pdb(message):
     # Если username отсутствует, заменить на уникальный идентификатор
     username = message.from_user.username or ""
-    cursor.execute("SELECT * FROM leaderboard WHERE telegram_id = ?", (message.from_user.id,))
-    user = cursor.fetchone()
-
-    if not user:
-        # Если пользователя нет в базе, добавляем его
-        cursor.execute('''
-                    INSERT INTO leaderboard (telegram_id, username, full_name)
-                    VALUES (?, ?, ?)
-                ''', (message.from_user.id, username, message.from_user.full_name))
-        print(f"Пользователь {message.from_user.full_name} добавлен в базу.")
-    else:
-        print(f"Пользователь {message.from_user.full_name} уже существует в базе.")
+    if await db.add_user(message.from_user.id, username, message.from_user.full_name):
+        logging.debug("Пользователь %s записан в базу", message.from_user.id)
 
-    conn.commit()
-    conn.close()
+# Функция для вывода топ-15 лидеров (текст кэшируется до изменения топа)
+async def get_top_leaders():
+    return await db.leaderboard.text(render_leaders)
 
-# Функция для вывода топ-15 лидеров
-def get_top_leaders():
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT username, full_name, points
-        FROM leaderboard
-        ORDER BY points DESC
-        LIMIT 15
-    ''')
-    leaders = cursor.fetchall()
-    conn.close()
-    leaderboard_text = "🏅 *Топ-15 лидеров:* 🏅\n\n"
-    leaderboard_text += "` # | Игрок       |   Очки`\n"
-    leaderboard_text += "`-------------------------`\n"
-
-    for idx, (username, full_name, points) in enumerate(leaders, start=1):
+
+def render_leaders(leaders, start=1):
+    if start == 1:
+        leaderboard_text = "🏅 *Топ-15 лидеров:* 🏅\n\n"
+    else:
+        leaderboard_text = f"🏅 *Таблица лидеров: места {start}–{start + len(leaders) - 1}* 🏅\n\n"
+    width = max(2, len(str(start + len(leaders) - 1)))
+    leaderboard_text += f"`{'#':>{width}} | Игрок       |   Очки`\n"
+    leaderboard_text += "`" + "-" * (width + 23) + "`\n"
+
+    for idx, (username, full_name, points) in enumerate(leaders, start=start):
         if username != "":
-            leaderboard_text += f"`{idx:2} | @{username[:10]:<10} | {points:6}`\n"
+            leaderboard_text += f"`{idx:{width}} | @{username[:10]:<10} | {points:6}`\n"
         else:
-            leaderboard_text += f"`{idx:2} | {full_name[:11]:<11} | {points:6}`\n"
+            leaderboard_text += f"`{idx:{width}} | {full_name[:11]:<11} | {points:6}`\n"
 
     return leaderboard_text
 
+
+# Кнопки листания таблицы: курсор — крайняя строка страницы (очки, id)
+LEADERS_PAGE = 15
+
+
+def leaders_markup(rows, start, has_prev, has_next):
+    buttons = []
+    if has_prev:
+        first = rows[0]
+        buttons.append(("◀ Назад", f"leaders:prev:{first[3]}:{first[0]}:{max(1, start - LEADERS_PAGE)}"))
+    if has_next:
+        last = rows[-1]
+        buttons.append(("Вперёд ▶", f"leaders:next:{last[3]}:{last[0]}:{start + len(rows)}"))
+    return to_markup([buttons]) if buttons else None
+
 # Команда start
 @router.message(Command(commands=['start']))
 async def start_f(message: Message):
-    add_pdb(message)
+    await add_pdb(message)
 
 # Команда help
 @router.message(Command(commands=['help']))
@@ -136,12 +172,12 @@ async def help_f(message: Message):
     "Играй честно, будь активным, и удачи в игре! 🎭")
 
     if message.chat.is_forum:
-        await bot.send_message(chat_id=chat_id, message_thread_id=message.message_thread_id,
+        await outbox.send_message(chat_id=chat_id, message_thread_id=message.message_thread_id,
                                text=txt,
                                parse_mode="Markdown")
         return
     if not message.chat.is_forum:
-        await bot.send_message(chat_id,
+        await outbox.send_message(chat_id,
                                txt,
                                parse_mode="Markdown")
         return
@@ -150,12 +186,13 @@ async def help_f(message: Message):
 @router.message(Command(commands=['mystats']))
 async def stats_f(message: Message):
     chat_id = message.chat.id
+    user_info = await get_user_info(message.from_user.id)
     if message.chat.is_forum:
-        await bot.send_message(chat_id=chat_id, message_thread_id=message.message_thread_id,
-                               text=f"Информация о игроке *{message.from_user.first_name}*:\n\n{get_user_info(message.from_user.id)}", parse_mode="Markdown")
+        await outbox.send_message(chat_id=chat_id, message_thread_id=message.message_thread_id,
+                               text=f"Информация о игроке *{message.from_user.first_name}*:\n\n{user_info}", parse_mode="Markdown")
         return
     if not message.chat.is_forum:
-        await bot.send_message(chat_id, f"Информация о игроке *{message.from_user.first_name}*:\n\n{get_user_info(message.from_user.id)}", parse_mode="Markdown")
+        await outbox.send_message(chat_id, f"Информация о игроке *{message.from_user.first_name}*:\n\n{user_info}", parse_mode="Markdown")
         return
 
 
@@ -164,14 +201,45 @@ async def stats_f(message: Message):
 @router.message(Command(commands=['leaderboard']))
 async def board_f(message: Message):
     chat_id = message.chat.id
+    leaders_text = await get_top_leaders()
+    rows = await db.leaderboard.top_rows()
+    markup = leaders_markup(rows, 1, False, len(rows) >= LEADERS_PAGE)
     if message.chat.is_forum:
-        await bot.send_message(chat_id=chat_id, message_thread_id=message.message_thread_id,
-                               text=f"{get_top_leaders()}", parse_mode="Markdown")
+        await outbox.send_message(chat_id=chat_id, message_thread_id=message.message_thread_id,
+                               text=leaders_text, parse_mode="Markdown", reply_markup=markup)
         return
     if not message.chat.is_forum:
-        await bot.send_message(chat_id=chat_id,
-                               text=f"{get_top_leaders()}", parse_mode="Markdown")
+        await outbox.send_message(chat_id=chat_id,
+                               text=leaders_text, parse_mode="Markdown", reply_markup=markup)
+        return
+
+
+# Листание таблицы лидеров: то же сообщение редактируется на месте
+@router.callback_query(lambda c: c.data.startswith("leaders:"))
+async def leaders_page(callback: CallbackQuery):
+    _, direction, points, telegram_id, start = callback.data.split(":")
+    forward = direction == "next"
+    rows, more = await db.leaderboard.page(int(points), int(telegram_id), forward, LEADERS_PAGE)
+    if not rows:
+        await callback.answer("Дальше никого нет.")
         return
+    start = int(start)
+    if forward:
+        has_prev, has_next = True, more
+    else:
+        if not more:
+            start = 1  # Дошли до начала таблицы
+        has_prev, has_next = more, True
+    if start == 1:
+        # Первая страница — тот же кэшированный топ, что и у /leaderboard
+        rows = await db.leaderboard.top_rows()
+        text = await get_top_leaders()
+        has_prev, has_next = False, len(rows) >= LEADERS_PAGE
+    else:
+        text = render_leaders([row[1:] for row in rows], start)
+    await outbox.edit_message_text(callback.message.chat.id, callback.message.message_id, text,
+                                   parse_mode="Markdown", reply_markup=leaders_markup(rows, start, has_prev, has_next))
+    await callback.answer()
 
 # Команда для создания новой игры
 @router.message(Command(commands=['newgame']))
@@ -181,7 +249,7 @@ async def create_game(message: Message):
         return
 
     if chat_id in active_games:
-        await message.answer("Игра уже создана. Вы можете присоединиться или дождаться её завершения.")
+        await answer(message, "Игра уже создана. Вы можете присоединиться или дождаться её завершения.")
         return
     if message.chat.is_forum:
         # Получение ID топика (если это группа с несколькими темами)
@@ -198,8 +266,13 @@ async def create_game(message: Message):
         game.creator_id = message.from_user.id
         # Сохраняем ID чата для использования в дальнейшем
         game.chat_id = chat_id  # Сохраняем ID чата в объекте игры
+    async with active_games.lock(game):
+        if not await save(game):
+            # Игру в этом чате уже создала другая реплика
+            await answer(message, "Игра уже создана. Вы можете присоединиться или дождаться её завершения.")
+            return
 
-    await message.answer("Игра создана! Используйте /join, чтобы присоединиться. Минимум 4 игрока.\nДля игры каждый игрок должен запустить @ImpostIgor_wehbot")
+    await answer(message, "Игра создана! Используйте /join, чтобы присоединиться. Минимум 4 игрока.\nДля игры каждый игрок должен запустить @ImpostIgor_wehbot")
 
 # Команда для удаления игры
 @router.message(Command(commands=['endgame']))
@@ -209,20 +282,23 @@ async def end_game(message: Message):
         return
 
     if chat_id not in active_games:
-        await message.answer("Нет активной игры. Создайте игру с помощью команды /newgame.")
+        await answer(message, "Нет активной игры. Создайте игру с помощью команды /newgame.")
         return
     game = active_games[chat_id]
-    active_games[chat_id].end_game()
-    del game
-    del active_games[chat_id]  # Завершаем игру и удаляем из активных
+    async with active_games.lock(game):
+        game.end_game()
+        deadlines.cancel(game.game_id)
+        await store.delete(chat_id)
+        if active_games.get(chat_id) is game:
+            del active_games[chat_id]  # Завершаем игру и удаляем из активных
 
-    await message.answer("Игра Закончена!")
+    await answer(message, "Игра Закончена!")
 
 # Команда для присоединения к игре
 @router.message(Command(commands=['join']))
 async def join_game(message: Message):
     chat_id = message.chat.id
-    add_pdb(message)
+    await add_pdb(message)
     if message.from_user.id  in user_data:
         del user_data[message.from_user.id]
 
@@ -230,52 +306,260 @@ async def join_game(message: Message):
     if chat_id == message.from_user.id:
         return
 
-    if chat_id not in active_games:
-        await message.answer("Нет активной игры. Создайте игру с помощью команды /newgame.")
-        return
-
-    game = active_games[chat_id]
-
-    if game.state != "waiting":
-        await message.answer("Игра уже начата")
-        return
-
-    if message.from_user.id in [player["player_id"] for player in game.players]:
-        await message.answer("Вы уже присоединились к игре.")
-        return
-
-    if len(game.players) >= 15:
-        await message.answer("Достигнуто максимальное количество игроков.")
+    game = active_games.get(chat_id)
+    if game is None:
+        await answer(message, "Нет активной игры. Создайте игру с помощью команды /newgame.")
         return
 
-    game.add_player(player_id=message.from_user.id, player_name=message.from_user.first_name, role=None)
-    await message.answer(f"Игрок {message.from_user.first_name} присоединился к игре. Всего игроков: {len(game.players)}")
+    # Проверки и изменение — под блокировкой игры: иначе между ними
+    # успеют пройти /startgame, другой /join или /leave
+    async with active_games.lock(game):
+        if active_games.get(chat_id) is not game:
+            text = "Игра изменилась, попробуйте ещё раз."
+        elif game.state != "waiting":
+            text = "Игра уже начата"
+        elif active_games.is_playing(message.from_user.id, game):
+            text = "Вы уже присоединились к игре."
+        elif len(game.players) >= 15:
+            text = "Достигнуто максимальное количество игроков."
+        else:
+            try:
+                game.add_player(player_id=message.from_user.id, player_name=message.from_user.first_name, role=None)
+            except ValueError:
+                text = "Вы уже присоединились к игре."
+            else:
+                if await save(game):
+                    text = f"Игрок {message.from_user.first_name} присоединился к игре. Всего игроков: {len(game.players)}"
+                else:
+                    text = "Игра изменилась, попробуйте ещё раз."
+    await answer(message, text)
 
 # Команда для выхода из игры
 @router.message(Command(commands=['leave']))
-async def join_game(message: Message):
+async def leave_game(message: Message):
     chat_id = message.chat.id
 
     if chat_id == message.from_user.id:
         return
 
-    if chat_id not in active_games:
-        await message.answer("Нет активной игры. Создайте игру с помощью команды /newgame.")
+    game = active_games.get(chat_id)
+    if game is None:
+        await answer(message, "Нет активной игры. Создайте игру с помощью команды /newgame.")
         return
 
-    game = active_games[chat_id]
+    async with active_games.lock(game):
+        if active_games.get(chat_id) is not game:
+            text = "Игра изменилась, попробуйте ещё раз."
+        elif game.state != "waiting":
+            text = "Игра уже начата"
+        elif not active_games.is_playing(message.from_user.id, game):
+            text = "Вы не в игре."
+        else:
+            game.del_player(player_id=message.from_user.id)
+            if await save(game):
+                text = f"Игрок {message.from_user.first_name} вышел из игры. Всего игроков: {len(game.players)}"
+            else:
+                text = "Игра изменилась, попробуйте ещё раз."
+    await answer(message, text)
+
+# Кнопки из эффекта игры в разметку aiogram
+def to_markup(buttons):
+    if buttons is None:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=text, callback_data=data) for text, data in row]
+        for row in buttons
+    ])
+
+
+# Передаёт событие игре и исполняет полученные эффекты.
+# События одной игры обрабатываются строго по очереди, разные игры — параллельно.
+# Снимок записывается до исполнения эффектов: если игру успела изменить
+# другая реплика, игра перечитывается и событие обрабатывается заново.
+# Под блокировкой сообщения только ставятся в очередь отправки (в каждом
+# чате она соблюдает порядок), ответов Telegram ждём уже без блокировки.
+async def dispatch(game, event, callback=None):
+    with bind_game(game.game_id):
+        async with active_games.lock(game):
+            for _ in range(3):
+                # Пока ждали блокировку, игру могли перечитать из хранилища
+                current = active_games.get(game.chat_id)
+                if current is None or current.game_id != game.game_id:
+                    return
+                game = current
+                # Аргументы форматируются в потоке логирования и только если запись пройдёт
+                logging.debug("Событие %r в фазе %s", event, game.phase_seq)
+                effects = game.handle(event)
+                if not game.changed:
+                    break  # Отказ нажатию или устаревший таймер: снимок тот же
+                try:
+                    await persist(game, effects)
+                    break
+                except VersionConflict as e:
+                    logging.warning("%s, перечитываем игру", e)
+                    await reload_game(game.chat_id)
+                except Exception:
+                    # Хранилище недоступно, а игра уже изменена: продолжаем её
+                    # в памяти (с дедлайном и сообщениями), снимок догонит
+                    # при следующем успешном сохранении
+                    logging.exception("Не удалось сохранить снимок игры %s", game.chat_id)
+                    break
+            else:
+                return
+            answers, sent = execute(game, effects)
+        await deliver(game, answers, sent, callback)
+
+
+# Исполняет эффекты, не дожидаясь Telegram. Возвращает ответы на кнопку
+# и [(эффект, future)] поставленных в очередь сообщений.
+def execute(game, effects):
+    answers, sent, stats = [], [], []
+    for effect in effects:
+        if isinstance(effect, AnswerCallback):
+            answers.append(effect)
+        elif isinstance(effect, SendMessage):
+            future = outbox.send_message(effect.chat_id, effect.text, message_thread_id=effect.thread_id,
+                                         reply_markup=to_markup(effect.buttons), priority=PHASE)
+            sent.append((effect, future))
+        elif isinstance(effect, EditMessage):
+            # Правка идёт в очередь своего чата: клавиатуры в личке не ждут общий чат
+            future = outbox.edit_message_text(effect.chat_id, effect.message_id, effect.text,
+                                              reply_markup=to_markup(effect.buttons), priority=PHASE)
+            sent.append((effect, future))
+        elif isinstance(effect, StatsDelta):
+            stats.append(effect)
+        elif isinstance(effect, Settle):
+            db.apply_settlement_nowait(effect.settlement)
+        elif isinstance(effect, Schedule):
+            deadlines.arm(game.game_id, effect.delay, (game, effect.event))
+        elif isinstance(effect, GameOver):
+            deadlines.cancel(game.game_id)
+            if active_games.get(game.chat_id) is game:
+                del active_games[game.chat_id]  # Завершаем игру и удаляем из активных
+
+    # Изменения статистики за переход пишутся одной пачкой
+    if stats:
+        db.apply_stats_nowait([(d.telegram_id, d.points, d.game_played, d.game_won) for d in stats])
+    return answers, sent
+
+
+# Отвечает на кнопку и дожидается отправки сообщений из execute
+async def deliver(game, answers, sent, callback=None):
+    if callback is not None:
+        for effect in answers:
+            await callback.answer(effect.text, show_alert=effect.show_alert)
+
+    results = await asyncio.gather(*(future for _, future in sent), return_exceptions=True)
+    required = set()
+    for (effect, _), result in zip(sent, results):
+        if isinstance(result, Exception):
+            logging.warning("Не удалось отправить сообщение %s: %s", effect.chat_id, result)
+            if isinstance(effect, SendMessage) and effect.required:
+                required.add(effect.chat_id)
+    if required:
+        names = ", ".join(p.player_name for p in game._players if p.player_id in required)
+        await outbox.send_message(game.chat_id, f"Не удалось отправить роль игрокам: {names}. Им нужно запустить @ImpostIgor_wehbot",
+                                  message_thread_id=game.topic_id, priority=PHASE)
+
+
+# Снимок игры после каждого изменения: переживает перезапуск бота,
+# а версия не даёт репликам затереть изменения друг друга
+async def persist(game, effects=()):
+    if game.state == "finished":
+        await store.delete(game.chat_id, game.version)
+        return
+    deadline = None
+    for effect in effects:
+        if isinstance(effect, Schedule):
+            deadline = time.time() + effect.delay
+    if deadline is None:
+        deadline = deadlines.deadline(game.game_id)
+        if deadline is not None:
+            # Монотонное время не переживает перезапуск, храним настенное
+            deadline = time.time() + deadline - time.monotonic()
+    data = json.dumps(game.to_dict(), ensure_ascii=False, separators=(",", ":"))
+    players = [p.player_id for p in game.players]
+    game.version = await store.compare_and_swap(game.chat_id, game.game_id, game.version, data, deadline, players)
+
+
+# Сохранение вне dispatch; False — игру уже изменили, она перечитана
+async def save(game):
+    try:
+        await persist(game)
+        return True
+    except VersionConflict as e:
+        logging.warning("%s, перечитываем игру", e)
+        await reload_game(game.chat_id)
+        return False
+
+
+# Игра из снимка: в реестр и с заново взведённым дедлайном
+def load_game(chat_id, version, data, deadline):
+    game = Game.from_dict(json.loads(data))
+    game.version = version
+    active_games.replace(chat_id, game)
+    if deadline is not None:
+        delay = max(0.0, deadline - time.time())
+        deadlines.arm(game.game_id, delay, (game, PhaseTimeout(game.phase_seq)))
+    else:
+        deadlines.cancel(game.game_id)
+    return game
 
-    if game.state != "waiting":
-        await message.answer("Игра уже начата")
-        return
 
-    if message.from_user.id not in [player["player_id"] for player in game.players]:
-        await message.answer("Вы не в игре.")
-        return
+async def reload_game(chat_id):
+    record = await store.get(chat_id)
+    if record is None:
+        game = active_games.get(chat_id)
+        if game is not None:
+            deadlines.cancel(game.game_id)
+            del active_games[chat_id]
+        return None
+    return load_game(chat_id, *record)
+
 
+# Игра игрока. Индекс в памяти отвечает сразу; при промахе игру могла
+# начать другая реплика на общем хранилище — тогда она ищется там.
+# Промахи помнятся несколько секунд, чтобы случайные нажатия кнопок
+# вне игры не ходили в базу каждый раз.
+missed_players = LRUCache(10000)  # player_id -> до какого момента не искать
+MISS_TTL = 5.0
+
+
+async def find_game(player_id):
+    game = active_games.game_for_player(player_id)
+    if game is not None or SHARDS > 1 or not store.shared:
+        return game
+    now = time.monotonic()
+    if missed_players.get(player_id, 0) > now:
+        return None
+    for chat_id in await store.games_for_player(player_id):
+        game = await reload_game(chat_id)
+        if game is not None and active_games.is_playing(player_id, game):
+            return game
+    missed_players.put(player_id, now + MISS_TTL)
+    return None
+
+
+# Поднимает сохранённые игры и заново взводит их дедлайны
+async def restore_games(owns=None):
+    await store.prepare()
+    for chat_id, version, data, deadline in await store.load_all():
+        if owns is not None and not owns(chat_id):
+            continue  # игра другого шарда
+        load_game(chat_id, version, data, deadline)
+    logging.info("Восстановлено игр: %s", len(active_games))
+
+
+# Истёк дедлайн фазы игры
+async def on_deadline(game_id, payload):
+    game, event = payload
+    if active_games.get(game.chat_id) is game:
+        await dispatch(game, event)
+
+
+# Дедлайны фаз всех игр
+deadlines = DeadlineScheduler(on_deadline)
 
-    game.del_player(player_id=message.from_user.id)
-    await message.answer(f"Игрок {message.from_user.first_name} вышел из игры. Всего игроков: {len(game.players)}")
 
 # Команда для начала игры
 @router.message(Command(commands=['startgame']))
@@ -286,42 +570,14 @@ async def start_game(message: Message):
         return
 
     if chat_id not in active_games:
-        await message.answer("Нет активной игры. Создайте игру с помощью команды /newgame.")
+        await answer(message, "Нет активной игры. Создайте игру с помощью команды /newgame.")
         return
 
     game = active_games[chat_id]
-
-    if game.state != "waiting":
-        await message.answer("Игра уже начата")
-        return
-
-    if message.from_user.id != game.creator_id:
-        await message.answer("Только создатель игры может запустить её.")
-        return
-
-    if len(game.players) < 4:
-        await message.answer("Недостаточно игроков для начала игры. Минимум 4.")
-        return
-
     try:
-        game.start_game()
-        player_roles = distribute_roles(game.players)
-        #game.player_roles = player_roles
-
-        for player_id, role in player_roles.items():
-            await bot.send_message(player_id, f"Ваша роль: {role.role_name}. {role.role_desk}")
-            if 1 < sum(1 for p in game.players if isinstance(p["role"], (Mafia, DonMafia))) and player_id in [p['player_id'] for p in game.players if isinstance(p["role"], (Mafia, DonMafia))]:
-                mtxt = "Ваши напарники:\n"
-                for p in game.players:
-                    if isinstance(p["role"], (Mafia, DonMafia)) and p["player_id"] != player_id:
-                        mtxt += f"{p['player_name']} {p['role'].role_name}\n"
-                await bot.send_message(player_id, mtxt)
-
-        await message.answer("Роли распределены, игра начинается! Ночная фаза началась.")
-        await start_night_phase(chat_id)
-        #await end_night_phase(chat_id)
+        await dispatch(game, StartGame(message.from_user.id))
     except Exception as e:
-        await message.answer(f"Ошибка при запуске игры: {e}")
+        await answer(message, f"Ошибка при запуске игры: {e}")
 
 @router.message()
 async def restrict_non_players(message: Message):
@@ -329,15 +585,15 @@ async def restrict_non_players(message: Message):
     current_time = datetime.now()
 
     if chat_id == message.from_user.id:
-        game = next((g for g in active_games.values() if chat_id in [p['player_id'] for p in g.players]), None)
+        game = active_games.game_for_player(chat_id)
         if game and game.state == "night":
             for p in game.players:
-                if p["player_id"] == chat_id and isinstance(p["role"], (Mafia, DonMafia)):
+                if p.player_id == chat_id and p.kind & MAFIA:
                     mes = message.text
                     writer = message.from_user.first_name
                     for po in game.players:
-                        if isinstance(po["role"], (Mafia, DonMafia)) and po["player_id"] != chat_id:
-                            await bot.send_message(po["player_id"], f"{writer}: {mes}")
+                        if po.kind & MAFIA and po.player_id != chat_id:
+                            await outbox.send_message(po.player_id, f"{writer}: {mes}", priority=RELAY)
             return
 
         return
@@ -348,17 +604,17 @@ async def restrict_non_players(message: Message):
     if chat_id in active_games :
         if active_games[chat_id].state == "night":
             for player in active_games[chat_id].players:
-                if user_id != player["player_id"] or user_id == active_games[chat_id].lblock_player:
+                if user_id != player.player_id or user_id == active_games[chat_id].lblock_player:
                     if message.chat.is_forum and message.message_thread_id == active_games[chat_id].topic_id:
-                        await message.delete()  # Удаляем сообщение
+                        await outbox.delete_message(message.chat.id, message.message_id)  # Удаляем сообщение
                         return
                     if not message.chat.is_forum:
-                        await message.delete()  # Удаляем сообщение
+                        await outbox.delete_message(message.chat.id, message.message_id)  # Удаляем сообщение
                         return
         elif active_games[chat_id].state !=  "waiting":
-            game = next((g for g in active_games.values() if user_id in [p['player_id'] for p in g.players]), None)
-            if user_id == game.lblock_player or user_id not in [p["player_id"] for p in game.players]:
-                await message.delete()  # Удаляем сообщение
+            game = active_games[chat_id]
+            if user_id == game.lblock_player or not active_games.is_playing(user_id, game):
+                await outbox.delete_message(message.chat.id, message.message_id)  # Удаляем сообщение
                 return
 
             user = user_data[user_id]
@@ -379,229 +635,25 @@ async def restrict_non_players(message: Message):
             user["timestamps"] = timestamps
             user["last_message"] = message.text
 
-            # Начисление баллов
-            game.update_user_stats(user_id, 1)
+            # Начисление баллов (пишутся в базу пачкой)
+            chat_points.add(user_id, 1)
             user_data[user_id] = user
 
 
-
-
-# Ночная фаза
-async def start_night_phase(chat_id):
-    game = active_games[chat_id]
-    game.state = "night"
-    await bot.send_message(chat_id=game.chat_id, message_thread_id=game.topic_id, text="Ночная фаза: роли начинают свои действия.")
-    await notify_roles(game.chat_id, game)
-
-async def notify_roles(chat_id, game):
-    for player in game.players:
-        role = player["role"]
-        buttons = None  # Для каждого игрока определяем свои кнопки
-        if not isinstance(role, (Villager, Kamikaze)):
-            if isinstance(role, Mafia):
-                buttons = InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [InlineKeyboardButton(
-                            text=f"Убить {target['player_name']}",
-                            callback_data=f"action:kill:{target['player_id']}"
-                        )] for target in game.players if target["player_id"] != player["player_id"]
-                    ]
-                )
-                await bot.send_message(player["player_id"], "Выберите кого убить этой ночью:", reply_markup=buttons)
-            elif isinstance(role, DonMafia):
-                buttons = InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [InlineKeyboardButton(
-                            text=f"Решить судьбу {target['player_name']}",
-                            callback_data=f"action:final_kill:{target['player_id']}"
-                        )] for target in game.players if target["player_id"] != player["player_id"]
-                    ]
-                )
-                await bot.send_message(player["player_id"], "Выберите кого убить этой ночью:", reply_markup=buttons)
-            elif isinstance(role, Doctor):
-                if role.self_heal:
-                    buttons = InlineKeyboardMarkup(
-                        inline_keyboard=[
-                            [InlineKeyboardButton(
-                                text=f"Лечить {target['player_name']}",
-                                callback_data=f"action:heal:{target['player_id']}"
-                            )] for target in game.players
-                        ]
-                    )
-                else:
-                    buttons = InlineKeyboardMarkup(
-                        inline_keyboard=[
-                            [InlineKeyboardButton(
-                                text=f"Лечить {target['player_name']}",
-                                callback_data=f"action:heal:{target['player_id']}"
-                            )] for target in game.players if target["player_id"] != player["player_id"]
-                        ]
-                    )
-                await bot.send_message(player["player_id"], "Выберите кого лечить этой ночью:", reply_markup=buttons)
-            elif isinstance(role, Commissioner):
-                buttons = InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [InlineKeyboardButton(
-                            text=f"Проверить {target['player_name']}",
-                            callback_data=f"action:investigate:{target['player_id']}"
-                        )] for target in game.players if target["player_id"] != player["player_id"]
-                    ]
-                )
-                await bot.send_message(player["player_id"], "Выберите кого проверить этой ночью:", reply_markup=buttons)
-            elif isinstance(role, Lover):
-                buttons = InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [InlineKeyboardButton(
-                            text=f"Блокировать {target['player_name']}",
-                            callback_data=f"action:block:{target['player_id']}"
-                        )] for target in game.players if target["player_id"] != player["player_id"]
-                    ]
-                )
-                await bot.send_message(player["player_id"], "Выберите с кем Вы будете этой ночью:", reply_markup=buttons)
-            elif isinstance(role, Maniac):
-                buttons = InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [InlineKeyboardButton(
-                            text=f"Зарезать {target['player_name']}",
-                            callback_data=f"action:m_kill:{target['player_id']}"
-                        )] for target in game.players if target["player_id"] != player["player_id"]
-                    ]
-                )
-                await bot.send_message(player["player_id"], "Выберите кого порешать этой ночью:", reply_markup=buttons)
-            elif isinstance(role, Judge):
-                if role.vote_canceled:
-                    buttons = InlineKeyboardMarkup(
-                        inline_keyboard=[
-                            [InlineKeyboardButton(
-                                text=f"Оправдать {target['player_name']}",
-                                callback_data=f"action:cancel_vote:{target['player_id']}"
-                            )] for target in game.players
-                        ] + [[InlineKeyboardButton(text="Пропустить", callback_data="action:skip")]]
-                    )
-                await bot.send_message(player["player_id"], "Выберите кому дать иммунитет от дневного голосования:", reply_markup=buttons)
-            elif isinstance(role, Hobo):
-                buttons = InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [InlineKeyboardButton(
-                            text=f"Пойти к {target['player_name']}",
-                            callback_data=f"action:start_tracking:{target['player_id']}"
-                        )] for target in game.players if target["player_id"] != player["player_id"]
-                    ]
-                )
-                await bot.send_message(player["player_id"], "Выберите у кого поспать под дверью:", reply_markup=buttons)
-
 @router.callback_query(lambda c: c.data.startswith("action:"))
 async def handle_action(callback: CallbackQuery):
     player_id = callback.from_user.id
-    action = callback.data.split(":")[1]
+    data = callback.data.split(":")
 
     # Проверяем, в какой игре находится игрок
-    game = next((g for g in active_games.values() if player_id in [p['player_id'] for p in g.players]), None)
+    game = await find_game(player_id)
     if not game:
         await callback.answer("Вы не участвуете в текущей игре.", show_alert=True)
         return
 
-    # Проверка, не совершал ли игрок уже действие
-    if player_id in [a['player_id'] for a in game.night_actions]:
-        await callback.answer("Вы уже выбрали действие!", show_alert=True)
-        return
-
-    # Логика обработки действий
-    if action == "skip":
-        game.night_actions.append({"action": action, "player_id": player_id})
-        await callback.message.edit_text(text=f"Вы не дали никому иммунитет", reply_markup=None)
-        return
-
-    target_id = int(callback.data.split(":")[-1])
-
-    game.night_actions.append({"action": action, "player_id": player_id, "target_id": target_id})
-    await callback.answer("Ваше действие принято.")
-    t = next(p for p in game.players if p["player_id"] == target_id)
-    await callback.message.edit_text(text = f"Ваш выбор {t['player_name']}",reply_markup=None)
-
-    players_with_actions = [p for p in game.players if not isinstance(p["role"], (Villager, Kamikaze))]
-    # Отладочная информация для проверки логики
-    if any(isinstance(player['role'], Judge) for player in game.players):
-        Ju = next(p for p in game.players if isinstance(p["role"], Judge))
-        if not Ju["role"].vote_canceled:
-            players_with_actions = [p for p in game.players if not isinstance(p["role"], (Villager, Kamikaze, Judge))]
-
-
-    actions_done = len([p for p in players_with_actions if p['player_id'] in [a['player_id'] for a in game.night_actions]])
-
-    print(f"Players with actions: {players_with_actions}")
-    print(f"Night actions: {game.night_actions}")
-    print(f"Actions done: {actions_done}")
-    print(f"Total players with actions: {len(players_with_actions)}")
-
-    # Проверяем, все ли игроки выполнили действия
-    if actions_done == len(players_with_actions):
-        await end_night_phase(game.chat_id)
-    else:
-        print("Not all players have completed their actions yet.")
-
-
-async def end_night_phase(chat_id):
-    game = active_games[chat_id]
-    results = game.process_night_actions()
-    blocked_players = {action["target_id"] for action in game.night_actions if action["action"] == "block"}
-    start_day_text = ""
-    for result in results:
-        if result["action"] == "kill":
-            game.del_player(result["target_id"])
-            start_day_text += result["text"] + "\n"
-
-        if result["action"] == "m_kill":
-            game.del_player(result["target_id"])
-            start_day_text += result["text"] + "\n"
-
-        if result["action"] == "explode":
-            game.del_player(result["target_id"])
-            start_day_text += result["text"] + "\n"
-
-        if result["action"] == "investigate":
-            await bot.send_message(chat_id=result["player_id"], text=result["text"])
-
-        if result["action"] == "start_tracking":
-            await bot.send_message(chat_id=result["player_id"], text=result["text"])
-
-    if not any(isinstance(player['role'], DonMafia) for player in game.players) and any(isinstance(player['role'], Mafia) for player in game.players):
-        ma = [po for po in game.players if isinstance(po["role"], Mafia)]
-        m = random.choice(ma)
-        game.change_role(m['player_id'], DonMafia)
-        await bot.send_message(chat_id=m['player_id'], text=f"Ваш Дон погиб, вы занимаете его место. {m['role'].role_desk}")
-
-    if start_day_text != "":
-        await bot.send_message(chat_id=game.chat_id, message_thread_id=game.topic_id, text=start_day_text)
-    else:
-        await bot.send_message(chat_id=game.chat_id, message_thread_id=game.topic_id, text="Этой ночью всё спокойно")
-
-    if await declare_winner(game):
-        return
-
-    game.night_actions = []
-    game.state = "day"
-
-    await bot.send_message(chat_id=game.chat_id, message_thread_id=game.topic_id, text="Наступает день. Обсудите и голосуйте.")
-    await asyncio.sleep(60)
-    await bot.send_message(chat_id=game.chat_id, message_thread_id=game.topic_id,
-                           text="Обсуждение закончилось. Выдвигайте кандидатов на голосование в личных сообщениях.")
-    game.nominations = {}
-
-    for player in game.players:
-        if player["player_id"] != game.lblock_player:
-            buttons = InlineKeyboardMarkup(
-                inline_keyboard=[
-                                    [InlineKeyboardButton(text=p["player_name"],
-                                                          callback_data=f"nominate:{p['player_id']}")]
-                                    for p in game.players if p["player_id"] != player["player_id"] and p["player_id"] != game.vote_canceled
-                                ] + [[InlineKeyboardButton(text="Пропустить", callback_data="nominate:skip")]]
-            )
-            await bot.send_message(
-                player["player_id"],
-                "Выберите игрока для номинации или воздержитесь.",
-                reply_markup=buttons
-            )
+    target_id = int(data[-1]) if data[1] != "skip" else None
+    event = NightAction(player_id, data[1], target_id, callback.message.chat.id, callback.message.message_id)
+    await dispatch(game, event, callback)
 
 
 # Обработка номинаций
@@ -610,189 +662,148 @@ async def handle_nomination(callback: CallbackQuery):
     nominee_data = callback.data.split(":")[-1]
     player_id = callback.from_user.id
 
-    chat_id = next((g.chat_id for g in active_games.values() if player_id in [p["player_id"] for p in g.players]), None)
-    if not chat_id:
+    game = await find_game(player_id)
+    if not game:
         await callback.answer("Вы не в игре.", show_alert=True)
         return
 
-    game = active_games[chat_id]
-
-    if game.state != "day" or game.nominations.get(player_id):
-        await callback.answer("Сейчас нельзя голосовать", show_alert=True)
-        return
-
-    if player_id == game.lblock_player:
-        await callback.answer("Вы заблокированы любовницей и не можете голосовать.", show_alert=True)
-        return
-
-    if nominee_data == "skip":
-        game.nominations[player_id] = None
-        await callback.message.edit_text("Вы воздержались от номинации.", reply_markup=None)
-    else:
-        nominee_id = int(nominee_data)
-        if nominee_id not in [p["player_id"] for p in game.players]:
-            await callback.answer("Некорректный выбор.", show_alert=True)
-            return
-        nominee_name = next(p["player_name"] for p in game.players if p["player_id"] == nominee_id)
-        game.nominations[player_id] = nominee_id
-        await callback.message.edit_text(f"Вы выбрали игрока {nominee_name}.", reply_markup=None)
-    print(f"Total game.nominations: {len(game.nominations)}")
-    print(f"Total players with actions: {len(game.players) - 1 if game.lblock_player else len(game.players)}")
-    if len(game.nominations) == (len(game.players) - 1 if game.lblock_player else len(game.players)):
-        await process_nominations(chat_id)
-    else:
-        print("Not all players have completed their actions yet.")
-
-# Обработка результатов номинации
-async def process_nominations(chat_id):
-    game = active_games[chat_id]
-
-    vote_counts = {}
-    for nominee in game.nominations.values():
-        if nominee:
-            vote_counts[nominee] = vote_counts.get(nominee, 0) + 1
-
-    if not vote_counts:
-        await bot.send_message(chat_id=game.chat_id, message_thread_id=game.topic_id, text="Никто не был номинирован. День заканчивается.")
-        await start_night_phase(chat_id)
-        return
-
-    max_votes = max(vote_counts.values())
-    top_nominees = [player_id for player_id, count in vote_counts.items() if count == max_votes]
+    nominee_id = None if nominee_data == "skip" else int(nominee_data)
+    event = Nominate(player_id, nominee_id, callback.message.chat.id, callback.message.message_id)
+    await dispatch(game, event, callback)
 
-    if len(top_nominees) > 1:
-        await bot.send_message(
-            chat_id=game.chat_id,
-            message_thread_id=game.topic_id,
-            text="Несколько игроков номинированы с равным количеством голосов. Никто не будет линчеван. День заканчивается."
-        )
-        await start_night_phase(chat_id)
-    else:
-        await start_final_vote(chat_id, top_nominees[0])
-
-# Финальное голосование
-async def start_final_vote(chat_id, nominee_id):
-    game = active_games[chat_id]
-    game.nominations = {}
-
-    nominee_name = next(p["player_name"] for p in game.players if p["player_id"] == nominee_id)
-
-    buttons = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="Да", callback_data=f"final_vote:yes:{nominee_id}"),
-             InlineKeyboardButton(text="Нет", callback_data=f"final_vote:no:{nominee_id}")]
-        ]
-    )
-    await bot.send_message(
-        chat_id=game.chat_id,
-        message_thread_id=game.topic_id,
-        text=f"Голосуйте за казнь игрока {nominee_name}. Да или Нет?",
-        reply_markup=buttons
-    )
 
 # Обработка голосования
 @router.callback_query(lambda c: c.data.startswith("final_vote:"))
 async def handle_final_vote(callback: CallbackQuery):
     player_id = callback.from_user.id
     data = callback.data.split(":")
-    decision = data[1]
-    nominee_id = int(data[2])
-
-    game = next((g for g in active_games.values() if player_id in [p["player_id"] for p in g.players]), None)
 
-    if not game or game.state != "day":
+    game = await find_game(player_id)
+    if not game:
         await callback.answer("Сейчас нельзя голосовать.", show_alert=True)
         return
 
-    if player_id in game.nominations:
-        await callback.answer("Вы уже проголосовали.", show_alert=True)
-        return
-
-    if player_id == game.lblock_player:
-        await callback.answer("Вы заблокированы и не можете голосовать.", show_alert=True)
-        return
-
-    if player_id == nominee_id:
-        await callback.answer("Вы не можете голосовать за себя", show_alert=True)
-        return
-
-    game.nominations[player_id] = decision
-    await callback.answer("Ваш голос учтен.")
-
-    if len(game.nominations) == (len(game.players) - 1 if game.lblock_player else len(game.players)):
-        await finalize_final_vote(game.chat_id, nominee_id)
-
-# Завершение финального голосования
-async def finalize_final_vote(chat_id, nominee_id):
-    game = active_games[chat_id]
-    yes_votes = sum(1 for vote in game.nominations.values() if vote == "yes")
-    no_votes = sum(1 for vote in game.nominations.values() if vote == "no")
-
-    nominee_name = next(p["player_name"] for p in game.players if p["player_id"] == nominee_id)
-
-    if yes_votes > no_votes:
-        victim = next(p for p in game.players if p["player_id"] == nominee_id)
-        game.players.remove(victim)
-        await bot.send_message(chat_id=game.chat_id, message_thread_id=game.topic_id, text=f"Игрок {nominee_name} был линчёван.")
-    else:
-        await bot.send_message(chat_id=game.chat_id, message_thread_id=game.topic_id, text=f"Игрок {nominee_name} остался жив.")
-
-    if not await declare_winner(game):
-        await start_night_phase(chat_id)
-
-
-# Распределение ролей
-def distribute_roles(players):
-    num_players = len(players)
-    roles = []
-
-    if num_players <= 6:
-        roles = [DonMafia(None), Commissioner(None), Doctor(None)] + [Villager(None)] * (num_players - 3)
-    elif num_players <= 9:
-        roles = [Mafia(None), DonMafia(None), Commissioner(None), Doctor(None), Lover(None)] + [Villager(None)] * (num_players - 5)
-    elif num_players <= 12:
-        roles = [DonMafia(None), Commissioner(None), Doctor(None), Lover(None), Kamikaze(None), Hobo(None)] + [Villager(None)] * (num_players - 8) + [Mafia(None)]* 2
-    elif num_players <= 15:
-        roles = [DonMafia(None), Commissioner(None), Doctor(None), Lover(None), Kamikaze(None), Hobo(None), Judge(None), Maniac(None)] + [Villager(None)] * (num_players - 11) + [Mafia(None)]* 3
-
-
-    random.shuffle(players)
-    random.shuffle(roles)
-
-    player_roles = {}
-    for player, role in zip(players, roles):
-        player["role"] = role
-        role.player_id = player["player_id"]
-        player_roles[player["player_id"]] = role
-
-    return player_roles
-
-
-async def declare_winner(game):
-    winner = game.check_winner()
-    if winner:
-        if winner == "peaceful":
-            text = "Мирные жители победили! Мафия уничтожена."
-        elif winner == "mafia":
-            text = "Мафия победила! Мирные жители проиграли."
-        elif winner == "maniac":
-            text = "Маньяк победил!"
-        await bot.send_message(chat_id=game.chat_id, message_thread_id=game.topic_id, text=text)
-        del active_games[game.chat_id]  # Завершаем игру и удаляем из активных
-        game.end_game()
-        del game
-        return True
+    await dispatch(game, FinalVote(player_id, data[1], int(data[2])), callback)
 
 
 # Регистрация маршрутизатора
 dp.include_router(router)
 
+# Счётчики, которые уже ведут сами компоненты
+REGISTRY.gauge("bot_active_games", "Активные игры процесса", lambda: len(active_games))
+REGISTRY.gauge("bot_outbox_pending", "Сообщения в очереди отправки", outbox.pending)
+REGISTRY.gauge("bot_outbox_sent", "Отправлено через очередь", lambda: outbox.sent)
+REGISTRY.gauge("bot_outbox_retries", "Ответы 429 от Telegram", lambda: outbox.retries)
+REGISTRY.gauge("bot_points_pending_rows", "Начисления, ждущие записи", lambda: chat_points.pending_rows)
+REGISTRY.gauge("bot_points_last_flush_rows", "Строк в последнем сбросе очков", lambda: chat_points.last_flush_rows)
+REGISTRY.gauge("bot_leaderboard_reloads", "Перечитывания топа из базы", lambda: db.leaderboard.reloads)
+
 # Запуск бота
 if __name__ == "__main__":
-    import asyncio
+    def start_logging():
+        return setup_logging(os.getenv("LOG_LEVEL", "INFO").upper(), json_lines=os.getenv("LOG_FORMAT", "json") == "json")
+
+    async def receive(dispatcher, **kwargs):
+        if MODE == "webhook":
+            secret = WEBHOOK_SECRET
+            if not secret:
+                if not WEBHOOK_URL:
+                    raise SystemExit("MODE=webhook без WEBHOOK_URL требует WEBHOOK_SECRET, заданный при set_webhook")
+                # Вебхук ставит сам бот: секрет можно придумать на этот запуск
+                secret = secrets.token_urlsafe(32)
+            server = WebhookServer(dispatcher, bot, secret=secret, workers=WEBHOOK_WORKERS)
+            await server.start(port=port)
+            if WEBHOOK_URL:
+                await bot.set_webhook(WEBHOOK_URL, secret_token=secret, drop_pending_updates=True)
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await server.stop()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dispatcher.start_polling(bot, **kwargs)
+
+    async def serve(run, owns=None, metrics_port=METRICS_PORT):
+        await db.write(migrate)
+        metrics = MetricsServer()
+        if metrics_port:
+            await metrics.start(port=metrics_port)
+        chat_points.start()
+        outbox.start()
+        await restore_games(owns)
+        deadlines.start()
+        try:
+            await run()
+        finally:
+            await metrics.stop()
+            await deadlines.stop()
+            await outbox.stop()
+            await chat_points.stop()
+            await store.close()
+            db.close()
 
     async def main():
-        await bot.delete_webhook(drop_pending_updates=True)
-        await dp.start_polling(bot)
-
-    asyncio.run(main())
+        try:
+            await serve(lambda: receive(dp))
+        finally:
+            logging.info("Задержка обновлений (%s): %s", MODE, latency.summary())
+
+    # Фронт: принимает обновления и раздаёт их шардам
+    async def front_main(processes):
+        shard_router = ShardRouter(SHARDS)
+        REGISTRY.gauge("bot_shard_dropped", "Обновления, отброшенные из-за недоступного шарда", lambda: shard_router.dropped)
+        front = Dispatcher()
+        front.update.outer_middleware(latency)
+        front.update.outer_middleware(handler_metrics)
+        front.update.outer_middleware(shard_router)
+        metrics = MetricsServer()
+        if METRICS_PORT:
+            await metrics.start(port=METRICS_PORT)
+        await shard_router.start()
+        await shard_router.wait_ready()
+        try:
+            await receive(front, allowed_updates=dp.resolve_used_update_types())
+        finally:
+            await metrics.stop()
+            logging.info("Задержка обновлений (%s): %s", MODE, latency.summary())
+            logging.info("Обновлений по шардам: %s", shard_router.routed)
+            await shard_router.stop()
+            # Шарды дописывают очереди и сами завершаются
+            for process in processes:
+                await asyncio.to_thread(process.join, 30)
+
+    # Шард: свои игры, свои записи в базу, своя доля лимита отправки
+    def shard_main(shard):
+        async def handle(payload):
+            update = Update.model_validate_json(payload, context={"bot": bot})
+            await dp.feed_update(bot, update)
+
+        async def run():
+            worker = ShardWorker(shard, handle, players=active_games.players)
+            active_games.listener = worker
+            outbox.global_bucket = TokenBucket(30 / SHARDS, 30 / SHARDS)
+            ring = HashRing(SHARDS)
+            # У каждого шарда свои метрики на следующем порту
+            await serve(worker.run, owns=lambda chat_id: ring.shard_for(chat_id) == shard,
+                        metrics_port=METRICS_PORT and METRICS_PORT + 1 + shard)
+
+        listener = start_logging()
+        try:
+            asyncio.run(run())
+        finally:
+            listener.stop()
+
+    # Поток логирования запускается после fork, в каждом процессе свой
+    if SHARDS > 1:
+        processes = spawn(SHARDS, shard_main)
+        listener = start_logging()
+        try:
+            asyncio.run(front_main(processes))
+        finally:
+            listener.stop()
+    else:
+        listener = start_logging()
+        try:
+            asyncio.run(main())
+        finally:
+            listener.stop()
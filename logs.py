@@ -0,0 +1,137 @@
+"""
+Логирование без записи в поток вывода из event loop.
+
+Обработчик на корне только кладёт запись в очередь; форматирование
+(в том числе подстановка аргументов — logging.debug("... %s", game)
+ничего не форматирует в цикле событий) и запись в stdout делает
+отдельный поток QueueListener. Строки выводятся в JSON.
+
+К записям добавляется id игры из контекста (bind_game), поэтому все
+строки одной партии, в каком бы обработчике они ни появились, можно
+собрать по game_id. Отладочные записи проходят через ограничитель:
+не больше rate строк в секунду на одно место в коде.
+"""
+import contextlib
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+current_game = contextvars.ContextVar("current_game", default=None)
+
+
+@contextlib.contextmanager
+def bind_game(game_id):
+    """
+    Привязывает записи текущей задачи к партии game_id.
+    """
+    token = current_game.set(game_id)
+    try:
+        yield
+    finally:
+        current_game.reset(token)
+
+
+class GameFilter(logging.Filter):
+    def filter(self, record):
+        record.game_id = current_game.get()
+        return True
+
+
+class DebugSampler(logging.Filter):
+    """
+    Ограничивает отладочные записи: ведро на rate строк в секунду
+    (запас burst) для каждого места вызова. Остальные уровни не трогает.
+    """
+    def __init__(self, rate=5, burst=20):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}  # (файл, строка) -> [токены, время]
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                self.dropped += 1
+                return False
+            bucket[0] = tokens - 1
+        return True
+
+
+# Поля LogRecord, которые не считаются пользовательскими (extra=...)
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "game_id"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        game_id = getattr(record, "game_id", None)
+        if game_id is not None:
+            entry["game_id"] = game_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler.prepare() форматирует запись ещё в вызывающем потоке;
+    здесь запись уходит как есть, а форматирует её поток-слушатель.
+    Аргументы записи не копируются: изменяемый объект попадёт в лог
+    в том состоянии, в каком его застанет слушатель.
+    """
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level=logging.INFO, json_lines=True, stream=None, sampler=None):
+    """
+    Настраивает корневой логгер и запускает поток записи.
+    Возвращает QueueListener; при выходе нужно вызвать stop(),
+    чтобы дописать очередь.
+    Вызывать в каждом процессе после fork: поток в дочерний не переходит.
+    """
+    target = logging.StreamHandler(stream or sys.stdout)
+    if json_lines:
+        target.setFormatter(JsonFormatter())
+    else:
+        target.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(game_id)s:%(message)s"))
+
+    records = queue.SimpleQueue()
+    handler = LazyQueueHandler(records)
+    handler.addFilter(GameFilter())
+    handler.addFilter(sampler or DebugSampler())
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(records, target)
+    listener.start()
+    return listener
@@ -0,0 +1,253 @@
+"""
+Метрики бота в формате Prometheus.
+
+Счётчики и гистограммы живут в памяти процесса (у каждого шарда свои)
+и отдаются по HTTP на локальном порту:
+    curl http://127.0.0.1:9100/metrics
+
+Что меряется:
+- обработчики: число вызовов, время и ошибки по имени обработчика
+  (мидлварь HandlerMetrics);
+- запросы к Telegram API по методу (мидлварь сессии TelegramMetrics);
+- запросы к SQLite по имени функции (Storage._call);
+- сброс очков за сообщения (PointsAccumulator.flush).
+"""
+import bisect
+import logging
+import random
+import threading
+import time
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+# Границы корзин гистограмм, секунды
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+logger = logging.getLogger("metrics")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, value=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def get(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами. Наблюдения приходят и из
+    потоков SQLite, поэтому запись идёт под блокировкой.
+    """
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # labels -> [счётчики корзин..., +Inf, сумма]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return sum(series[:-1]) if series else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in items:
+            names = self.labels + ("le",)
+            total = 0
+            for bound, value in zip(self.buckets + ("+Inf",), series[:-1]):
+                total += value
+                lines.append(f"{self.name}_bucket{_labels(names, labels + (bound,))} {total}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {total}")
+        return lines
+
+
+class Gauge:
+    """
+    Значение, которое считывается при каждом запросе метрик
+    (для счётчиков, которые уже ведут другие модули).
+    """
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, read):
+        return self.add(Gauge(name, help, read))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                logger.exception("Не удалось снять метрику %s", metric.name)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram("bot_handler_seconds", "Время обработчика", ("handler",))
+HANDLER_ERRORS = REGISTRY.counter("bot_handler_errors_total", "Исключения в обработчиках", ("handler", "error"))
+TELEGRAM_SECONDS = REGISTRY.histogram("bot_telegram_request_seconds", "Время запроса к Telegram API", ("method",))
+TELEGRAM_ERRORS = REGISTRY.counter("bot_telegram_errors_total", "Ошибки запросов к Telegram API", ("method", "error"))
+SQLITE_SECONDS = REGISTRY.histogram("bot_sqlite_seconds", "Время запроса к SQLite с коммитом", ("query",))
+SQLITE_ERRORS = REGISTRY.counter("bot_sqlite_errors_total", "Ошибки запросов к SQLite", ("query",))
+POINTS_FLUSH_SECONDS = REGISTRY.histogram("bot_points_flush_seconds", "Время сброса накопленных очков за сообщения")
+
+
+def handler_name(event, data):
+    handler = data.get("handler")
+    if handler is not None:
+        return handler.callback.__name__
+    # Внешняя мидлварь диспетчера: обработчик ещё не выбран
+    return f"update:{getattr(event, 'event_type', type(event).__name__)}"
+
+
+def event_keys(event):
+    event = getattr(event, "event", event)  # Update -> сообщение или кнопка
+    chat = getattr(event, "chat", None)
+    if chat is None and getattr(event, "message", None) is not None:
+        chat = event.message.chat  # callback_query
+    user = getattr(event, "from_user", None)
+    return (chat.id if chat else None), (user.id if user else None)
+
+
+class HandlerMetrics(BaseMiddleware):
+    """
+    Время, число вызовов и ошибки обработчиков.
+
+    Снаружи диспетчера (dp.update.outer_middleware) обработчик ещё не
+    известен, и обновление учитывается по типу; имя обработчика aiogram
+    кладёт в data только для мидлварей наблюдателей роутера
+    (router.message.middleware и т. п.).
+
+    Вместо отладочных print в лог попадает выборка вызовов (sample)
+    и все медленные (slow, секунды); поля идут в extra и попадают
+    в JSON-строку лога (logs.JsonFormatter).
+    """
+    def __init__(self, sample=0.01, slow=0.5):
+        self.sample = sample
+        self.slow = slow
+
+    async def __call__(self, handler, event, data):
+        name = handler_name(event, data)
+        started = time.perf_counter()
+        error = None
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            error = type(e).__name__
+            HANDLER_ERRORS.inc(name, error)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_SECONDS.observe(elapsed, name)
+            if elapsed >= self.slow or error is not None or random.random() < self.sample:
+                chat_id, user_id = event_keys(event)
+                level = logging.WARNING if elapsed >= self.slow or error else logging.INFO
+                logger.log(level, "Обработчик %s: %.1f мс", name, elapsed * 1000, extra={
+                    "handler": name, "elapsed_ms": round(elapsed * 1000, 1),
+                    "chat_id": chat_id, "user_id": user_id, "error": error,
+                })
+
+
+class TelegramMetrics(BaseRequestMiddleware):
+    """
+    Время запросов к Bot API по методу: bot.session.middleware(TelegramMetrics()).
+    """
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, name)
+
+
+class MetricsServer:
+    def __init__(self, registry=REGISTRY, path="/metrics"):
+        self.registry = registry
+        self.path = path
+        self._runner = None
+
+    async def handle(self, request):
+        return web.Response(body=self.registry.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    async def start(self, host="127.0.0.1", port=9100):
+        app = web.Application()
+        app.router.add_get(self.path, self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info("Метрики: http://%s:%s%s", host, port, self.path)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,211 @@
+"""
+Версионированные миграции схемы базы.
+
+Номер применённой миграции хранится в PRAGMA user_version. Каждая миграция
+выполняется в своей транзакции (BEGIN IMMEDIATE) вместе с записью нового
+номера, поэтому прерванная миграция откатывается целиком, а повторный
+запуск продолжает с того же места. Все шаги написаны через IF NOT EXISTS
+и годятся для баз, созданных старым script.py (user_version = 0).
+
+Индексы строятся под блокировкой записи, но в режиме WAL читатели
+(в том числе другие процессы-шарды) продолжают работать.
+
+Запуск вручную: python migrations.py [путь к базе]
+"""
+import logging
+import sqlite3
+import time
+
+from storage import DB_PATH, BUCKET_SHIFT
+
+
+def _create_leaderboard(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS leaderboard (
+            telegram_id INTEGER PRIMARY KEY,
+            username TEXT,
+            full_name TEXT,
+            points INTEGER DEFAULT 0,
+            games_played INTEGER DEFAULT 0,
+            games_won INTEGER DEFAULT 0,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _create_snapshots(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS game_snapshots (
+            chat_id INTEGER PRIMARY KEY,
+            game_id TEXT,
+            data TEXT,
+            deadline REAL,
+            version INTEGER NOT NULL DEFAULT 1,
+            updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(game_snapshots)")]
+    if "version" not in columns:
+        conn.execute("ALTER TABLE game_snapshots ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+    # Индекс игрок -> игры для поиска игры по нажатию кнопки
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS snapshot_players (
+            player_id INTEGER,
+            chat_id INTEGER,
+            PRIMARY KEY (player_id, chat_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS snapshot_players_chat ON snapshot_players (chat_id)")
+
+
+def _create_indexes(conn):
+    # Порядок таблицы лидеров; по нему же идут выборки топа и страниц
+    conn.execute("DROP INDEX IF EXISTS leaderboard_points")
+    conn.execute("CREATE INDEX IF NOT EXISTS leaderboard_points_id ON leaderboard (points DESC, telegram_id)")
+
+    # Место игрока — число игроков с большим числом очков. COUNT по индексу
+    # линеен, поэтому триггеры ведут гистограмму очков и её корзины:
+    # место считается суммой по корзинам и по очкам внутри одной корзины.
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'points_histogram'").fetchone()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS points_histogram (
+            points INTEGER PRIMARY KEY,
+            users INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS points_buckets (
+            bucket INTEGER PRIMARY KEY,
+            users INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    if not exists:
+        conn.execute("INSERT INTO points_histogram SELECT points, COUNT(*) FROM leaderboard GROUP BY points")
+        conn.execute(f"INSERT INTO points_buckets SELECT points >> {BUCKET_SHIFT}, COUNT(*) FROM leaderboard GROUP BY 1")
+
+    def change(sign, points):
+        return f'''
+            INSERT INTO points_histogram VALUES ({points}, {sign}1)
+                ON CONFLICT (points) DO UPDATE SET users = users {sign} 1;
+            INSERT INTO points_buckets VALUES ({points} >> {BUCKET_SHIFT}, {sign}1)
+                ON CONFLICT (bucket) DO UPDATE SET users = users {sign} 1;
+        '''
+
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS leaderboard_points_insert AFTER INSERT ON leaderboard
+        BEGIN {change("+", "NEW.points")} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS leaderboard_points_delete AFTER DELETE ON leaderboard
+        BEGIN {change("-", "OLD.points")} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS leaderboard_points_update AFTER UPDATE OF points ON leaderboard
+        WHEN OLD.points != NEW.points
+        BEGIN {change("-", "OLD.points")} {change("+", "NEW.points")} END
+    ''')
+
+
+def _create_history(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS games (
+            game_id TEXT PRIMARY KEY,
+            chat_id INTEGER,
+            winner TEXT,
+            players_count INTEGER,
+            finished_at TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS game_players (
+            game_id TEXT,
+            telegram_id INTEGER,
+            player_name TEXT,
+            role TEXT,
+            alive INTEGER,
+            won INTEGER,
+            points INTEGER,
+            PRIMARY KEY (game_id, telegram_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS game_players_player ON game_players (telegram_id)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS game_events (
+            game_id TEXT,
+            seq INTEGER,
+            phase INTEGER,
+            kind TEXT,
+            player_id INTEGER,
+            target_id INTEGER,
+            PRIMARY KEY (game_id, seq)
+        ) WITHOUT ROWID
+    ''')
+    # Агрегаты обновляются вместе с записью партии
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS role_stats (
+            role TEXT PRIMARY KEY,
+            games INTEGER NOT NULL DEFAULT 0,
+            wins INTEGER NOT NULL DEFAULT 0,
+            survived INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS balance_stats (
+            players_count INTEGER,
+            winner TEXT,
+            games INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (players_count, winner)
+        ) WITHOUT ROWID
+    ''')
+
+
+# (номер, описание, функция(conn)); номера только растут, старые шаги не меняются
+MIGRATIONS = [
+    (1, "таблица лидеров", _create_leaderboard),
+    (2, "снимки активных игр", _create_snapshots),
+    (3, "индекс очков и гистограмма мест", _create_indexes),
+    (4, "история партий и агрегаты", _create_history),
+]
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, migrations=MIGRATIONS):
+    """
+    Применяет недостающие миграции. Возвращает [(номер, секунд)].
+    """
+    applied = []
+    for version, name, step in migrations:
+        if schema_version(conn) >= version:
+            continue
+        started = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Номер перечитывается под блокировкой: миграцию мог успеть
+            # применить другой процесс
+            if schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        elapsed = time.perf_counter() - started
+        logging.info("Миграция %s (%s): %.3f с", version, name, elapsed)
+        applied.append((version, elapsed))
+    return applied
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    conn = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else DB_PATH)
+    conn.execute("PRAGMA journal_mode=WAL")
+    migrate(conn)
+    print(f"Версия схемы: {schema_version(conn)}")
+    conn.close()
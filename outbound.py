@@ -0,0 +1,261 @@
+import asyncio
+import heapq
+import logging
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+
+
+# Приоритеты очереди отправки: меньше — раньше
+PHASE = 0  # смена фаз, роли, клавиатуры действий
+NORMAL = 1  # ответы на команды
+RELAY = 2  # пересылка сообщений между мафией
+
+
+class TokenBucket:
+    """
+    Ограничение частоты: rate токенов в секунду, не больше capacity подряд.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """
+        Сколько секунд ждать до следующего токена.
+        """
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now, seconds):
+        self.paused_until = max(self.paused_until, now + seconds)
+
+
+class _Job:
+    def __init__(self, method, kwargs, priority, seq, key, future):
+        self.method = method
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.future = future
+        self.attempts = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _Lane:
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.jobs = []  # куча _Job
+        self.keys = {}  # ключ склейки -> ожидающий _Job
+        self.scheduled = False
+        self.busy = False  # запрос чата уже у Telegram
+
+
+class OutboundScheduler:
+    """
+    Единая очередь исходящих запросов к Telegram.
+
+    Все отправки, правки и удаления сообщений проходят через общий
+    token bucket (лимит бота) и token bucket чата (лимит группы или
+    личного чата). Внутри чата запросы уходят по приоритету, а при равном
+    приоритете — в порядке вызова, по одному: следующий запрос чата
+    отправляется после ответа на предыдущий. Повторные правки одного
+    сообщения склеиваются, а RetryAfter от Telegram приостанавливает
+    всю очередь и ставит запрос в неё заново.
+
+    Запрос попадает в очередь в момент вызова send_message и др.; они
+    возвращают future с ответом Telegram, которую можно не ждать сразу.
+
+    bot — любой объект с методами send_message, edit_message_text,
+    delete_message, поэтому очередь можно проверять на локальном фейке.
+    """
+    def __init__(self, bot, global_rate=30, group_rate=20 / 60, group_burst=5,
+                 private_rate=1, private_burst=3, max_attempts=5):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.max_attempts = max_attempts
+        self._lanes = {}
+        self._ready = []  # куча (priority, seq, lane_id)
+        self._wakeup = asyncio.Event()
+        self._seq = 0
+        self._task = None
+        self._inflight = set()
+        # Метрики
+        self.sent = 0
+        self.retries = 0
+        self.coalesced = 0
+
+    def _lane(self, lane_id):
+        # lane_id = (вид, chat_id): удаления не тратят лимит сообщений чата
+        lane = self._lanes.get(lane_id)
+        if lane is None:
+            kind, chat_id = lane_id
+            if kind == "delete":
+                bucket = TokenBucket(self.global_bucket.rate, self.global_bucket.capacity)
+            elif chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, self.private_burst)
+            lane = self._lanes[lane_id] = _Lane(bucket)
+        return lane
+
+    def _schedule(self, lane_id, lane):
+        # Ставит чат в очередь готовых, когда у него появится токен
+        if lane.scheduled or lane.busy or not lane.jobs:
+            return
+        lane.scheduled = True
+        wait = lane.bucket.delay(time.monotonic())
+        if wait > 0:
+            asyncio.get_running_loop().call_later(wait, self._mark_ready, lane_id, lane)
+        else:
+            self._mark_ready(lane_id, lane)
+
+    def _mark_ready(self, lane_id, lane):
+        if not lane.jobs:
+            lane.scheduled = False
+            return
+        # Пока чат ждал, мог прийти RetryAfter
+        wait = lane.bucket.delay(time.monotonic())
+        if wait > 0:
+            asyncio.get_running_loop().call_later(wait, self._mark_ready, lane_id, lane)
+            return
+        head = lane.jobs[0]
+        heapq.heappush(self._ready, (head.priority, head.seq, lane_id))
+        self._wakeup.set()
+
+    def _enqueue(self, lane_id, method, kwargs, priority, key=None):
+        lane = self._lane(lane_id)
+        if key is not None and key in lane.keys:
+            # Склеиваем с ещё не отправленным запросом
+            job = lane.keys[key]
+            job.kwargs = kwargs
+            self.coalesced += 1
+            return job.future
+        self._seq += 1
+        job = _Job(method, kwargs, priority, self._seq, key, asyncio.get_running_loop().create_future())
+        heapq.heappush(lane.jobs, job)
+        if key is not None:
+            lane.keys[key] = job
+        self._schedule(lane_id, lane)
+        return job.future
+
+    def send_message(self, chat_id, text, priority=NORMAL, **kwargs):
+        return self._enqueue(("send", chat_id), "send_message", dict(kwargs, chat_id=chat_id, text=text), priority)
+
+    def edit_message_text(self, chat_id, message_id, text, priority=NORMAL, **kwargs):
+        kwargs = dict(kwargs, chat_id=chat_id, message_id=message_id, text=text)
+        return self._enqueue(("send", chat_id), "edit_message_text", kwargs, priority, key=("edit", message_id))
+
+    def delete_message(self, chat_id, message_id, priority=NORMAL):
+        lane = self._lane(("send", chat_id))
+        edit = lane.keys.get(("edit", message_id))
+        if edit is not None:
+            # Править сообщение, которое сейчас удалят, незачем
+            self._drop(lane, edit)
+            if not edit.future.done():
+                edit.future.set_result(None)
+        kwargs = {"chat_id": chat_id, "message_id": message_id}
+        return self._enqueue(("delete", chat_id), "delete_message", kwargs, priority, key=("delete", message_id))
+
+    def _drop(self, lane, job):
+        lane.jobs.remove(job)
+        heapq.heapify(lane.jobs)
+        lane.keys.pop(job.key, None)
+
+    async def _run(self):
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            wait = self.global_bucket.delay(time.monotonic())
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, lane_id = heapq.heappop(self._ready)
+            lane = self._lanes[lane_id]
+            lane.scheduled = False
+            if not lane.jobs:
+                continue
+            wait = lane.bucket.delay(time.monotonic())
+            if wait > 0:
+                self._schedule(lane_id, lane)
+                continue
+            job = heapq.heappop(lane.jobs)
+            if job.key is not None:
+                lane.keys.pop(job.key, None)
+            now = time.monotonic()
+            self.global_bucket.consume(now)
+            lane.bucket.consume(now)
+            lane.busy = True
+            task = asyncio.get_running_loop().create_task(self._execute(lane_id, lane, job))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _execute(self, lane_id, lane, job):
+        job.attempts += 1
+        try:
+            result = await getattr(self.bot, job.method)(**job.kwargs)
+        except TelegramRetryAfter as e:
+            self.retries += 1
+            now = time.monotonic()
+            # Флуд-контроль считается на весь бот: молчат все чаты, а не только этот
+            lane.bucket.pause(now, e.retry_after)
+            self.global_bucket.pause(now, e.retry_after)
+            if job.attempts >= self.max_attempts:
+                if not job.future.done():
+                    job.future.set_exception(e)
+                return
+            logging.warning("Telegram просит подождать %s с для чата %s", e.retry_after, lane_id[1])
+            heapq.heappush(lane.jobs, job)
+            if job.key is not None:
+                lane.keys.setdefault(job.key, job)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            lane.busy = False
+            self._schedule(lane_id, lane)
+
+    def pending(self):
+        return sum(len(lane.jobs) for lane in self._lanes.values())
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout=10):
+        # Даём очереди опустеть, затем останавливаем цикл
+        deadline = time.monotonic() + timeout
+        while (self.pending() or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
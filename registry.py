@@ -0,0 +1,106 @@
+import asyncio
+
+
+class GameRegistry:
+    """
+    Хранилище активных игр с индексами chat_id -> игра и player_id -> игра.
+
+    Ведёт себя как словарь active_games (ключ — chat_id), а индекс игроков
+    обновляется самой игрой при добавлении и удалении игроков.
+    Для каждой игры есть свой asyncio.Lock, через который идут все её изменения.
+    """
+    def __init__(self):
+        self._by_chat = {}
+        self._by_player = {}  # player_id -> список игр (обычно одна)
+        self._locks = {}  # game_id -> asyncio.Lock
+        # Получает player_bound/player_unbound (карта игрок -> шард)
+        self.listener = None
+
+    def __contains__(self, chat_id):
+        return chat_id in self._by_chat
+
+    def __getitem__(self, chat_id):
+        return self._by_chat[chat_id]
+
+    def __setitem__(self, chat_id, game):
+        if chat_id in self._by_chat:
+            del self[chat_id]
+        self._by_chat[chat_id] = game
+        game.registry = self
+        for p in game.players:
+            self.index_player(p.player_id, game)
+
+    def __delitem__(self, chat_id):
+        game = self._by_chat.pop(chat_id)
+        for p in game.players:
+            self.unindex_player(p.player_id, game)
+        game.registry = None
+        # Тот, кто держит блокировку, и ждущие её сохраняют ссылку на неё
+        self._locks.pop(game.game_id, None)
+
+    def replace(self, chat_id, game):
+        """
+        Подменяет игру её свежей копией (из хранилища), сохраняя блокировку:
+        события, ждущие старую копию, продолжат работать уже с новой.
+        """
+        old = self._by_chat.get(chat_id)
+        lock = self._locks.get(old.game_id) if old is not None else None
+        self[chat_id] = game
+        if lock is not None and old.game_id == game.game_id:
+            self._locks[game.game_id] = lock
+
+    def __len__(self):
+        return len(self._by_chat)
+
+    def __iter__(self):
+        return iter(self._by_chat)
+
+    def get(self, chat_id, default=None):
+        return self._by_chat.get(chat_id, default)
+
+    def values(self):
+        return self._by_chat.values()
+
+    def items(self):
+        return self._by_chat.items()
+
+    def lock(self, game):
+        """
+        Блокировка игры: события одной игры обрабатываются по очереди.
+        """
+        lock = self._locks.get(game.game_id)
+        if lock is None:
+            lock = self._locks[game.game_id] = asyncio.Lock()
+        return lock
+
+    def index_player(self, player_id, game):
+        games = self._by_player.setdefault(player_id, [])
+        if game not in games:
+            games.append(game)
+            if len(games) == 1 and self.listener is not None:
+                self.listener.player_bound(player_id)
+
+    def unindex_player(self, player_id, game):
+        games = self._by_player.get(player_id)
+        if games and game in games:
+            games.remove(game)
+            if not games:
+                del self._by_player[player_id]
+                if self.listener is not None:
+                    self.listener.player_unbound(player_id)
+
+    def game_for_player(self, player_id):
+        """
+        Возвращает игру, в которой участвует игрок, или None.
+        """
+        games = self._by_player.get(player_id)
+        return games[0] if games else None
+
+    def players(self):
+        """
+        Все игроки, которые сейчас в играх этого процесса.
+        """
+        return list(self._by_player)
+
+    def is_playing(self, player_id, game):
+        return game in self._by_player.get(player_id, ())
@@ -0,0 +1,100 @@
+import asyncio
+import heapq
+import logging
+import time
+
+
+class DeadlineScheduler:
+    """
+    Один таймер на все игры: куча дедлайнов и одна фоновая задача.
+
+    У каждого ключа (обычно game_id) не больше одного активного дедлайна:
+    повторный arm() заменяет прежний, cancel() снимает его. Отменённые
+    записи остаются в куче и пропускаются при срабатывании, куча
+    периодически пересобирается, чтобы не разрастаться.
+    """
+    def __init__(self, callback):
+        self.callback = callback  # async callback(key, payload)
+        self._heap = []  # (deadline, seq, key)
+        self._entries = {}  # key -> (seq, deadline, payload)
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()
+        self.fired = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def arm(self, key, delay, payload=None):
+        self._seq += 1
+        deadline = time.monotonic() + delay
+        self._entries[key] = (self._seq, deadline, payload)
+        heapq.heappush(self._heap, (deadline, self._seq, key))
+        if self._heap[0][1] == self._seq:
+            # Новый дедлайн раньше всех остальных — будим цикл
+            self._wakeup.set()
+        self._compact()
+
+    def cancel(self, key):
+        self._entries.pop(key, None)
+        self._compact()
+
+    def deadline(self, key):
+        entry = self._entries.get(key)
+        return entry[1] if entry else None
+
+    def _compact(self):
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [(deadline, seq, key) for key, (seq, deadline, _) in self._entries.items()]
+            heapq.heapify(self._heap)
+
+    def pop_due(self, now):
+        """
+        Снимает и возвращает все просроченные (key, payload).
+        """
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, seq, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != seq:
+                continue  # дедлайн отменён или заменён
+            del self._entries[key]
+            due.append((key, entry[2]))
+        return due
+
+    async def _run(self):
+        while True:
+            for key, payload in self.pop_due(time.monotonic()):
+                self.fired += 1
+                task = asyncio.get_running_loop().create_task(self._fire(key, payload))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+            timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, key, payload):
+        try:
+            await self.callback(key, payload)
+        except Exception:
+            logging.exception("Ошибка при обработке дедлайна %s", key)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,268 @@
+"""
+Шардирование игр по процессам.
+
+Фронт-процесс получает обновления (polling или вебхук) и раздаёт их
+воркерам: групповые чаты — по консистентному хешу chat_id, личные
+сообщения и кнопки в личке — по карте игрок -> шард, которую воркеры
+обновляют сами, когда игрок попадает в игру или выходит из неё.
+Каждый воркер — обычный экземпляр бота со своими играми и записями в базу.
+
+Транспорт — Unix-сокет, кадры вида: тип (1 байт), длина (4 байта), тело
+(обновление в JSON или id игрока).
+"""
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import struct
+
+from aiogram import BaseMiddleware
+
+SOCKET_PATH = "/tmp/impostigor-shards.sock"
+
+# Типы кадров
+HELLO = b"H"  # воркер -> фронт: номер шарда
+UPDATE = b"U"  # фронт -> воркер: обновление Telegram
+BIND = b"B"  # воркер -> фронт: игрок теперь в игре на этом шарде
+UNBIND = b"F"  # воркер -> фронт: игрок больше не играет на этом шарде
+
+_HEADER = struct.Struct(">cI")
+
+
+def write_frame(writer, kind, payload):
+    writer.write(_HEADER.pack(kind, len(payload)) + payload)
+
+
+async def read_frame(reader):
+    kind, size = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    return kind, await reader.readexactly(size)
+
+
+class HashRing:
+    """
+    Консистентный хеш: при смене числа шардов переезжает
+    примерно 1/N чатов, а не все.
+    """
+    def __init__(self, shards, replicas=100):
+        self.shards = shards
+        points = []
+        for shard in range(shards):
+            for replica in range(replicas):
+                points.append((self._hash(f"{shard}:{replica}"), shard))
+        points.sort()
+        self._keys = [key for key, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(value):
+        # Не hash(): он должен совпадать во всех процессах
+        return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], "big")
+
+    def shard_for(self, key):
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._shards[index]
+
+
+def update_keys(update):
+    """
+    Возвращает (chat_id, user_id) обновления; любое из них может быть None.
+    """
+    event = update.event
+    chat = getattr(event, "chat", None)
+    if chat is None and getattr(event, "message", None) is not None:
+        chat = event.message.chat  # callback_query
+    user = getattr(event, "from_user", None)
+    return (chat.id if chat else None), (user.id if user else None)
+
+
+class ShardRouter(BaseMiddleware):
+    """
+    Мидлварь фронт-процесса: вместо обработки отправляет обновление воркеру.
+
+    Пока шард не подключён, его обновления ждут не дольше timeout секунд
+    и затем отбрасываются; обновления остальных шардов идут без задержки.
+    """
+    def __init__(self, shards, path=SOCKET_PATH, timeout=5.0):
+        self.ring = HashRing(shards)
+        self.path = path
+        self.timeout = timeout
+        self.player_map = {}  # player_id -> шард
+        self._writers = {}
+        self._connected = [asyncio.Event() for _ in range(shards)]
+        self._ready = asyncio.Event()
+        self._server = None
+        self._stopping = False
+        self.routed = [0] * shards
+        self.dropped = 0
+
+    def shard_for(self, update):
+        chat_id, user_id = update_keys(update)
+        if chat_id is None or chat_id == user_id:
+            # Личка: туда, где идёт игра игрока
+            shard = self.player_map.get(user_id)
+            if shard is not None:
+                return shard
+            return self.ring.shard_for(user_id)
+        return self.ring.shard_for(chat_id)
+
+    async def forward(self, update):
+        shard = self.shard_for(update)
+        writer = self._writers.get(shard)
+        if writer is None:
+            try:
+                await asyncio.wait_for(self._connected[shard].wait(), self.timeout)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                logging.warning("Шард %s недоступен, обновление %s отброшено", shard, update.update_id)
+                return
+            writer = self._writers[shard]
+        write_frame(writer, UPDATE, update.model_dump_json(exclude_none=True).encode())
+        self.routed[shard] += 1
+        try:
+            await writer.drain()
+        except ConnectionError:
+            self.dropped += 1
+            logging.warning("Шард %s отключился, обновление %s потеряно", shard, update.update_id)
+
+    async def __call__(self, handler, event, data):
+        # Обработчики фронта не вызываются
+        await self.forward(event)
+
+    async def _on_connect(self, reader, writer):
+        kind, payload = await read_frame(reader)
+        if kind != HELLO:
+            writer.close()
+            return
+        shard = int(payload)
+        # Шард (пере)подключился и сейчас пришлёт BIND всех своих игроков
+        self.player_map = {player_id: owner for player_id, owner in self.player_map.items() if owner != shard}
+        self._writers[shard] = writer
+        self._connected[shard].set()
+        logging.info("Шард %s подключён", shard)
+        if len(self._writers) == self.ring.shards:
+            self._ready.set()
+        try:
+            while True:
+                kind, payload = await read_frame(reader)
+                player_id = int(payload)
+                if kind == BIND:
+                    self.player_map[player_id] = shard
+                elif kind == UNBIND and self.player_map.get(player_id) == shard:
+                    del self.player_map[player_id]
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # Шард мог уже переподключиться новым соединением
+            if not self._stopping and self._writers.get(shard) is writer:
+                logging.warning("Шард %s отключился", shard)
+                del self._writers[shard]
+                self._connected[shard].clear()
+                self._ready.clear()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._on_connect, self.path)
+
+    async def wait_ready(self):
+        await self._ready.wait()
+
+    async def stop(self):
+        self._stopping = True
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+class ShardWorker:
+    """
+    Сторона воркера: читает обновления от фронта и сообщает ему,
+    какие игроки играют на этом шарде (слушатель GameRegistry).
+
+    Игры восстанавливаются до подключения к фронту, и их BIND тогда
+    некуда отправить, поэтому при подключении воркер заново передаёт
+    всех игроков из players() — так же карта восстанавливается и после
+    перезапуска шарда.
+    """
+    def __init__(self, shard, handle, path=SOCKET_PATH, concurrency=64, players=None):
+        self.shard = shard
+        self.handle = handle  # async handle(payload: bytes)
+        self.path = path
+        self.players = players  # () -> [player_id], например GameRegistry.players
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+        self._writer = None
+        self.handled = 0
+
+    async def connect(self, attempts=50):
+        for _ in range(attempts):
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)  # фронт ещё не поднял сокет
+        else:
+            raise ConnectionError(f"Не удалось подключиться к {self.path}")
+        write_frame(self._writer, HELLO, str(self.shard).encode())
+        for player_id in (self.players() if self.players is not None else ()):
+            write_frame(self._writer, BIND, str(player_id).encode())
+        await self._writer.drain()
+        return reader
+
+    async def run(self):
+        """
+        Обрабатывает обновления, пока фронт не закроет соединение.
+        """
+        reader = await self.connect()
+        try:
+            while True:
+                kind, payload = await read_frame(reader)
+                if kind != UPDATE:
+                    continue
+                await self._semaphore.acquire()
+                task = asyncio.get_running_loop().create_task(self._handle(payload))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        except asyncio.IncompleteReadError:
+            pass
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+    async def _handle(self, payload):
+        try:
+            await self.handle(payload)
+            self.handled += 1
+        except Exception:
+            logging.exception("Ошибка при обработке обновления на шарде %s", self.shard)
+        finally:
+            self._semaphore.release()
+
+    def _send(self, kind, player_id):
+        if self._writer is not None and not self._writer.is_closing():
+            write_frame(self._writer, kind, str(player_id).encode())
+
+    # Вызываются GameRegistry
+    def player_bound(self, player_id):
+        self._send(BIND, player_id)
+
+    def player_unbound(self, player_id):
+        self._send(UNBIND, player_id)
+
+
+def spawn(shards, target):
+    """
+    Запускает target(shard) в отдельных процессах.
+    Вызывать до asyncio.run() в главном процессе.
+    """
+    import multiprocessing
+
+    context = multiprocessing.get_context("fork")
+    processes = []
+    for shard in range(shards):
+        process = context.Process(target=target, args=(shard,), name=f"shard-{shard}", daemon=True)
+        process.start()
+        processes.append(process)
+    return processes
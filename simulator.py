@@ -0,0 +1,183 @@
+"""
+Безголовый симулятор игр: играет партии целиком против stukt.Game
+без Telegram и без базы данных.
+"""
+import random
+import time
+
+from stukt import Game, SendMessage, Schedule, StatsDelta, Settle
+from stukt import StartGame, NightAction, Nominate, FinalVote, PhaseTimeout
+
+
+class StatsSink:
+    """
+    Заглушка вместо базы: просто копит изменения статистики.
+    """
+    def __init__(self):
+        self.points = {}
+        self.settlements = []
+
+    def consume(self, effects):
+        for effect in effects:
+            if isinstance(effect, StatsDelta):
+                self.points[effect.telegram_id] = self.points.get(effect.telegram_id, 0) + effect.points
+            elif isinstance(effect, Settle):
+                self.settlements.append(effect.settlement)
+
+
+class RandomAgent:
+    """
+    Нажимает случайную кнопку из присланной клавиатуры.
+    С вероятностью afk не нажимает ничего (None) — фазу закроет дедлайн.
+    """
+    def __init__(self, rng, afk=0.0):
+        self.rng = rng
+        self.afk = afk
+
+    def choose(self, game, player_id, buttons):
+        if self.afk and self.rng.random() < self.afk:
+            return None
+        row = self.rng.choice(buttons)
+        return self.rng.choice(row)[1]
+
+    def final_vote(self, game, player_id, nominee_id):
+        if self.afk and self.rng.random() < self.afk:
+            return None
+        return self.rng.choice(("yes", "no"))
+
+
+class ScriptedAgent(RandomAgent):
+    """
+    Выбирает кнопку функцией script(game, player_id, buttons) -> callback_data.
+    """
+    def __init__(self, rng, script, vote=None):
+        super().__init__(rng)
+        self.script = script
+        self.vote = vote
+
+    def choose(self, game, player_id, buttons):
+        return self.script(game, player_id, buttons)
+
+    def final_vote(self, game, player_id, nominee_id):
+        if self.vote:
+            return self.vote(game, player_id, nominee_id)
+        return super().final_vote(game, player_id, nominee_id)
+
+
+# Фаза, к которой относится событие (для замеров задержки)
+PHASES = {
+    StartGame: "start",
+    NightAction: "night",
+    Nominate: "nomination",
+    FinalVote: "final_vote",
+    PhaseTimeout: "timeout",
+}
+
+
+class Simulator:
+    def __init__(self, players=8, seed=0, agent=None, sink=None, max_events=10000):
+        self.rng = random.Random(seed)
+        self.players = players
+        self.agent = agent or RandomAgent(self.rng)
+        self.sink = sink or StatsSink()
+        self.max_events = max_events
+        self.latencies = {}  # фаза -> список длительностей handle(), секунд
+        self.events = 0
+        self.nights = 0
+        self.timeouts = 0
+        self._timer = None  # Последний Schedule — дедлайн текущей фазы
+
+    def _handle(self, game, event):
+        started = time.perf_counter()
+        effects = game.handle(event)
+        elapsed = time.perf_counter() - started
+        phase = PHASES[type(event)]
+        self.latencies.setdefault(phase, []).append(elapsed)
+        self.events += 1
+        self.sink.consume(effects)
+        return effects
+
+    def play(self):
+        """
+        Играет одну партию до конца и возвращает победителя.
+        """
+        game = Game(chat_id=-1, rng=self.rng)
+        game.creator_id = 1
+        for player_id in range(1, self.players + 1):
+            game.add_player(player_id, f"Игрок {player_id}")
+
+        queue = self._handle(game, StartGame(game.creator_id))
+        while game.state != "finished":
+            if self.events > self.max_events:
+                raise RuntimeError(f"Игра не завершилась за {self.max_events} событий")
+            if not queue:
+                if self._timer is None:
+                    raise RuntimeError(f"Игра зависла: {game.state} {game.day_stage}")
+                # Все, кто хотел, уже походили — время фазы истекает
+                timer, self._timer = self._timer, None
+                self.timeouts += 1
+                queue = self._handle(game, timer.event)
+                continue
+            effects, queue = queue, []
+            for effect in effects:
+                if game.state == "finished":
+                    break
+                queue += self._react(game, effect)
+        return game.settlement["winner"]
+
+    def _react(self, game, effect):
+        if isinstance(effect, Schedule):
+            # Новый дедлайн заменяет прежний, как в DeadlineScheduler
+            self._timer = effect
+            return []
+        if not isinstance(effect, SendMessage) or not effect.buttons:
+            return []
+
+        if effect.chat_id == game.chat_id:
+            # Финальное голосование в общем чате: голосуют все живые
+            nominee_id = game.nominee_id
+            effects = []
+            for p in list(game.players):
+                if game.day_stage != "final_vote" or game.nominee_id != nominee_id:
+                    break
+                decision = self.agent.final_vote(game, p.player_id, nominee_id)
+                if decision is None:
+                    continue
+                effects += self._handle(game, FinalVote(p.player_id, decision, nominee_id))
+            return effects
+
+        choice = self.agent.choose(game, effect.chat_id, effect.buttons)
+        if choice is None:
+            return []
+        data = choice.split(":")
+        if data[0] == "action":
+            if game.state == "night" and not game.night_actions:
+                self.nights += 1
+            target_id = None if data[1] == "skip" else int(data[-1])
+            return self._handle(game, NightAction(effect.chat_id, data[1], target_id))
+        if data[0] == "nominate":
+            nominee_id = None if data[1] == "skip" else int(data[1])
+            return self._handle(game, Nominate(effect.chat_id, nominee_id))
+        return []
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+if __name__ == "__main__":
+    import sys
+
+    players = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    games = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    afk = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    winners = {}
+    for seed in range(games):
+        rng = random.Random(seed)
+        winner = Simulator(players, seed, agent=RandomAgent(rng, afk)).play()
+        winners[winner] = winners.get(winner, 0) + 1
+    print(f"{players} игроков, {games} партий: {winners}")
@@ -0,0 +1,649 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from metrics import SQLITE_SECONDS, SQLITE_ERRORS, POINTS_FLUSH_SECONDS
+
+DB_PATH = "leaderboard.db"
+
+
+class Storage:
+    """
+    Доступ к базе данных вне event loop.
+
+    Все записи идут через один поток-писатель с постоянным соединением,
+    чтения — через небольшой пул потоков, у каждого своё соединение.
+    База работает в режиме WAL, поэтому чтения не ждут записи.
+    """
+    def __init__(self, path: str = DB_PATH, readers: int = 2):
+        self.path = path
+        self._local = threading.local()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self._connections = []
+        self._lock = threading.Lock()
+        self.leaderboard = Leaderboard(self)
+        # telegram_id -> (username, full_name), уже записанные в базу
+        self.known_users = LRUCache(10000)
+
+    def _connect(self):
+        # Соединение создаётся один раз на поток и живёт до close()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            # Чтения из отображённой памяти и кэш страниц на соединение (16 МБ)
+            conn.execute("PRAGMA mmap_size=268435456")
+            conn.execute("PRAGMA cache_size=-16000")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _call(self, fn, *args):
+        conn = self._connect()
+        started = time.perf_counter()
+        try:
+            result = fn(conn, *args)
+            conn.commit()
+            return result
+        except Exception:
+            SQLITE_ERRORS.inc(fn.__name__)
+            conn.rollback()
+            raise
+        finally:
+            SQLITE_SECONDS.observe(time.perf_counter() - started, fn.__name__)
+
+    async def write(self, fn, *args):
+        """
+        Выполняет fn(conn, *args) в потоке-писателе.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._call, fn, *args)
+
+    async def read(self, fn, *args):
+        """
+        Выполняет fn(conn, *args) в пуле читателей.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._call, fn, *args)
+
+    def submit(self, fn, *args):
+        """
+        Ставит запись в очередь писателя без ожидания (для синхронного кода).
+        """
+        return self._writer.submit(self._call, fn, *args)
+
+    def _call_points(self, fn, *args):
+        # fn меняет очки и возвращает telegram_id затронутых игроков;
+        # после коммита их новые очки попадают в топ в памяти
+        ids = self._call(fn, *args)
+        if ids:
+            self.leaderboard.apply(self._call(_select_points, ids))
+        return ids
+
+    async def write_points(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._call_points, fn, *args)
+
+    def submit_points(self, fn, *args):
+        return self._writer.submit(self._call_points, fn, *args)
+
+    # Аналитика по сыгранным партиям (из агрегатов, без обхода истории)
+    async def get_role_stats(self):
+        return await self.read(_select_role_stats)
+
+    async def get_balance_stats(self):
+        return await self.read(_select_balance_stats)
+
+    async def get_user(self, telegram_id):
+        return await self.read(_select_user, telegram_id)
+
+    async def get_user_rank(self, telegram_id):
+        return await self.read(_select_rank, telegram_id)
+
+    async def add_user(self, telegram_id, username, full_name):
+        """
+        Добавляет пользователя или обновляет его имя. Возвращает True,
+        если строка изменилась. Известный пользователь с теми же именами
+        не стоит ни одного обращения к базе.
+        """
+        names = (username, full_name)
+        if self.known_users.get(telegram_id) == names:
+            return False
+        written = bool(await self.write_points(_upsert_user, telegram_id, username, full_name))
+        self.known_users.put(telegram_id, names)
+        return written
+
+    def apply_stats_nowait(self, rows):
+        """
+        rows — список (telegram_id, points, game_played, game_won).
+        """
+        return self.submit_points(_update_stats_many, rows)
+
+    def apply_settlement_nowait(self, settlement):
+        return self.submit_points(_apply_settlement, settlement)
+
+    # Снимки активных игр
+    async def load_snapshots(self):
+        return await self.read(_load_snapshots)
+
+    def close(self):
+        # Дожидаемся очереди записей и закрываем соединения
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+def _select_user(conn, telegram_id):
+    cursor = conn.execute("SELECT * FROM leaderboard WHERE telegram_id = ?", (telegram_id,))
+    return cursor.fetchone()
+
+
+def _upsert_user(conn, telegram_id, username, full_name):
+    # Возвращает [telegram_id], если пользователь добавлен или сменил имя
+    cursor = conn.execute('''
+        INSERT INTO leaderboard (telegram_id, username, full_name)
+        VALUES (?, ?, ?)
+        ON CONFLICT (telegram_id) DO UPDATE SET
+            username = excluded.username,
+            full_name = excluded.full_name
+        WHERE username IS NOT excluded.username OR full_name IS NOT excluded.full_name
+    ''', (telegram_id, username, full_name))
+    return [telegram_id] if cursor.rowcount > 0 else []
+
+
+# Ширина корзины гистограммы очков (степень двойки для сдвига)
+BUCKET_SHIFT = 6
+
+
+def _select_rank(conn, telegram_id):
+    # Возвращает (место, всего игроков) или None
+    row = conn.execute("SELECT points FROM leaderboard WHERE telegram_id = ?", (telegram_id,)).fetchone()
+    if row is None:
+        return None
+    points = row[0]
+    bucket = points >> BUCKET_SHIFT
+    above, total = conn.execute('''
+        SELECT
+            (SELECT COALESCE(SUM(users), 0) FROM points_buckets WHERE bucket > :bucket)
+            + (SELECT COALESCE(SUM(users), 0) FROM points_histogram
+               WHERE points > :points AND points < (:bucket + 1) << :shift),
+            (SELECT SUM(users) FROM points_buckets)
+    ''', {"points": points, "bucket": bucket, "shift": BUCKET_SHIFT}).fetchone()
+    return above + 1, total
+
+
+def _select_top(conn, limit):
+    cursor = conn.execute('''
+        SELECT telegram_id, username, full_name, points
+        FROM leaderboard
+        ORDER BY points DESC, telegram_id
+        LIMIT ?
+    ''', (limit,))
+    return cursor.fetchall()
+
+
+def _select_page(conn, points, telegram_id, forward, limit):
+    # Keyset-пагинация по индексу (points DESC, telegram_id): без OFFSET,
+    # поэтому дальние страницы не медленнее первых
+    if forward:
+        cursor = conn.execute('''
+            SELECT telegram_id, username, full_name, points
+            FROM leaderboard
+            WHERE points <= ? AND (points < ? OR telegram_id > ?)
+            ORDER BY points DESC, telegram_id
+            LIMIT ?
+        ''', (points, points, telegram_id, limit))
+        return cursor.fetchall()
+    cursor = conn.execute('''
+        SELECT telegram_id, username, full_name, points
+        FROM leaderboard
+        WHERE points >= ? AND (points > ? OR telegram_id < ?)
+        ORDER BY points, telegram_id DESC
+        LIMIT ?
+    ''', (points, points, telegram_id, limit))
+    rows = cursor.fetchall()
+    rows.reverse()
+    return rows
+
+
+def _select_points(conn, ids):
+    rows = []
+    ids = list(ids)
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        cursor = conn.execute(f'''
+            SELECT telegram_id, username, full_name, points
+            FROM leaderboard
+            WHERE telegram_id IN ({",".join("?" * len(chunk))})
+        ''', chunk)
+        rows += cursor.fetchall()
+    return rows
+
+
+def _update_stats_many(conn, rows):
+    now = datetime.now().isoformat()
+    conn.executemany('''
+        UPDATE leaderboard
+        SET points = points + ?,
+            games_played = games_played + ?,
+            games_won = games_won + ?,
+            last_updated = ?
+        WHERE telegram_id = ?
+    ''', [
+        (points, 1 if game_played else 0, 1 if game_won else 0, now, int(telegram_id))
+        for telegram_id, points, game_played, game_won in rows
+    ])
+    return {int(row[0]) for row in rows}
+
+
+def _apply_settlement(conn, settlement):
+    # Итоги всех игроков, история партии и агрегаты — одной транзакцией.
+    # Сначала строка games: повторно присланные итоги той же партии
+    # не начисляют очки второй раз
+    if not _record_game(conn, settlement):
+        return set()
+    now = datetime.now().isoformat()
+    players = settlement["players"]
+    conn.executemany('''
+        UPDATE leaderboard
+        SET points = points + ?,
+            games_played = games_played + ?,
+            games_won = games_won + ?,
+            last_updated = ?
+        WHERE telegram_id = ?
+    ''', [
+        (p["points"], p["games_played"], p["games_won"], now, p["telegram_id"])
+        for p in players
+    ])
+    return {p["telegram_id"] for p in players}
+
+
+def _record_game(conn, settlement):
+    players = settlement["players"]
+    cursor = conn.execute('''
+        INSERT OR IGNORE INTO games (game_id, chat_id, winner, players_count, finished_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (settlement["game_id"], settlement["chat_id"], settlement["winner"], len(players), settlement["finished_at"]))
+    if cursor.rowcount == 0:
+        return False  # Партия уже записана — агрегаты не удваиваем
+    conn.executemany('''
+        INSERT INTO game_players (game_id, telegram_id, player_name, role, alive, won, points)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (settlement["game_id"], p["telegram_id"], p["player_name"], p["role"], p["alive"], p["games_won"], p["points"])
+        for p in players
+    ])
+    conn.executemany('''
+        INSERT INTO game_events (game_id, seq, phase, kind, player_id, target_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [
+        (settlement["game_id"], seq, phase, kind, player_id, target_id)
+        for seq, (phase, kind, player_id, target_id) in enumerate(settlement.get("events", ()))
+    ])
+    conn.executemany('''
+        INSERT INTO role_stats (role, games, wins, survived) VALUES (?, 1, ?, ?)
+        ON CONFLICT (role) DO UPDATE SET
+            games = games + 1,
+            wins = wins + excluded.wins,
+            survived = survived + excluded.survived
+    ''', [(p["role"], p["games_won"], int(p["alive"])) for p in players if p["role"]])
+    conn.execute('''
+        INSERT INTO balance_stats (players_count, winner, games) VALUES (?, ?, 1)
+        ON CONFLICT (players_count, winner) DO UPDATE SET games = games + 1
+    ''', (len(players), settlement["winner"]))
+    return True
+
+
+def _select_role_stats(conn):
+    # (роль, партий, побед, процент побед)
+    cursor = conn.execute('''
+        SELECT role, games, wins, 100.0 * wins / games
+        FROM role_stats
+        ORDER BY games DESC
+    ''')
+    return cursor.fetchall()
+
+
+def _select_balance_stats(conn):
+    # (игроков, победитель, партий, доля среди партий с тем же числом игроков)
+    cursor = conn.execute('''
+        SELECT players_count, winner, games,
+               100.0 * games / SUM(games) OVER (PARTITION BY players_count)
+        FROM balance_stats
+        ORDER BY players_count, winner
+    ''')
+    return cursor.fetchall()
+
+
+def _save_snapshot(conn, chat_id, game_id, data, deadline):
+    conn.execute('''
+        INSERT OR REPLACE INTO game_snapshots (chat_id, game_id, data, deadline, updated)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (chat_id, game_id, data, deadline, datetime.now().isoformat()))
+
+
+def _cas_snapshot(conn, chat_id, game_id, expected, data, deadline, players):
+    # Возвращает новую версию или None, если снимок уже изменили
+    now = datetime.now().isoformat()
+    if expected == 0:
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO game_snapshots (chat_id, game_id, data, deadline, version, updated)
+            VALUES (?, ?, ?, ?, 1, ?)
+        ''', (chat_id, game_id, data, deadline, now))
+    else:
+        cursor = conn.execute('''
+            UPDATE game_snapshots
+            SET game_id = ?, data = ?, deadline = ?, version = version + 1, updated = ?
+            WHERE chat_id = ? AND version = ?
+        ''', (game_id, data, deadline, now, chat_id, expected))
+    if cursor.rowcount == 0:
+        return None
+    conn.execute("DELETE FROM snapshot_players WHERE chat_id = ?", (chat_id,))
+    conn.executemany("INSERT OR IGNORE INTO snapshot_players (player_id, chat_id) VALUES (?, ?)",
+                     [(player_id, chat_id) for player_id in players])
+    return expected + 1
+
+
+def _delete_snapshot(conn, chat_id, expected=None):
+    # Возвращает False, если снимок уже изменили
+    if expected is None:
+        conn.execute("DELETE FROM game_snapshots WHERE chat_id = ?", (chat_id,))
+    else:
+        cursor = conn.execute("DELETE FROM game_snapshots WHERE chat_id = ? AND version = ?", (chat_id, expected))
+        if cursor.rowcount == 0 and _select_snapshot(conn, chat_id) is not None:
+            return False
+    conn.execute("DELETE FROM snapshot_players WHERE chat_id = ?", (chat_id,))
+    return True
+
+
+def _select_snapshot(conn, chat_id):
+    cursor = conn.execute("SELECT version, data, deadline FROM game_snapshots WHERE chat_id = ?", (chat_id,))
+    return cursor.fetchone()
+
+
+def _snapshots_for_player(conn, player_id):
+    cursor = conn.execute("SELECT chat_id FROM snapshot_players WHERE player_id = ?", (player_id,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _load_snapshots(conn):
+    cursor = conn.execute("SELECT chat_id, version, data, deadline FROM game_snapshots")
+    return cursor.fetchall()
+
+
+def _add_points_many(conn, rows):
+    conn.executemany('''
+        UPDATE leaderboard
+        SET points = points + ?,
+            last_updated = ?
+        WHERE telegram_id = ?
+    ''', rows)
+    return {row[2] for row in rows}
+
+
+class LRUCache:
+    """
+    Словарь ограниченного размера: при переполнении вытесняется то,
+    к чему дольше всего не обращались.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self.capacity:
+            self._items.popitem(last=False)
+
+
+class Leaderboard:
+    """
+    Топ-K игроков в памяти и готовый текст таблицы лидеров.
+
+    Каждая запись, меняющая очки, после коммита передаёт сюда новые очки
+    затронутых игроков (из потока-писателя). Если кто-то из топа потерял
+    очки, его место мог занять игрок вне топа — тогда топ перечитывается
+    из базы при следующем запросе. Поколение защищает от установки
+    перечитанного топа, который устарел, пока шёл запрос.
+
+    Записи других процессов (шарды, реплики на общем файле) сюда не
+    приходят, поэтому топ живёт не дольше ttl секунд и затем
+    перечитывается из базы.
+    """
+    def __init__(self, storage, k=15, ttl=5.0):
+        self.storage = storage
+        self.k = k
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._top = None  # [(telegram_id, username, full_name, points)] или None
+        self._text = None
+        self._expires = 0.0  # когда перечитать топ, time.monotonic()
+        self._generation = 0
+        self._pages = {}  # курсор -> (истекает, страница)
+        self.page_ttl = 30.0
+        # Метрики
+        self.hits = 0
+        self.reloads = 0
+        self.page_hits = 0
+
+    @staticmethod
+    def _order(row):
+        return -row[3], row[0]
+
+    def apply(self, rows):
+        with self._lock:
+            self._generation += 1
+            self._text = None
+            if self._top is None:
+                return
+            top = {row[0]: row for row in self._top}
+            dropped = False
+            for row in rows:
+                old = top.get(row[0])
+                if old is not None and row[3] < old[3]:
+                    dropped = True
+                if old is not None or len(top) < self.k or self._order(row) < self._order(self._top[-1]):
+                    top[row[0]] = tuple(row)
+            if dropped and len(top) >= self.k:
+                self._top = None
+                return
+            self._top = sorted(top.values(), key=self._order)[:self.k]
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._top = None
+            self._text = None
+
+    def _expire(self):
+        # Вызывается под self._lock
+        if self._top is not None and time.monotonic() >= self._expires:
+            self._generation += 1
+            self._top = None
+            self._text = None
+
+    async def top_rows(self):
+        """
+        Возвращает [(telegram_id, username, full_name, points)] лучших K игроков.
+        """
+        with self._lock:
+            self._expire()
+            top, generation = self._top, self._generation
+        if top is None:
+            self.reloads += 1
+            expires = time.monotonic() + self.ttl
+            top = [tuple(row) for row in await self.storage.read(_select_top, self.k)]
+            with self._lock:
+                if self._generation == generation:
+                    self._top = top
+                    self._expires = expires
+        return top
+
+    async def top(self):
+        """
+        Возвращает [(username, full_name, points)] лучших K игроков.
+        """
+        return [(username, full_name, points) for _, username, full_name, points in await self.top_rows()]
+
+    async def page(self, points, telegram_id, forward=True, limit=15):
+        """
+        Страница после (forward) или перед строкой-курсором (points, telegram_id).
+        Возвращает (строки, есть ли ещё в ту же сторону). Страницы кэшируются
+        по курсору на page_ttl секунд — таблица меняется постоянно, поэтому
+        страницы не сбрасываются при записи, а просто быстро устаревают.
+        """
+        key = (points, telegram_id, forward, limit)
+        now = time.monotonic()
+        cached = self._pages.get(key)
+        if cached is not None and cached[0] > now:
+            self.page_hits += 1
+            return cached[1]
+        rows = await self.storage.read(_select_page, points, telegram_id, forward, limit + 1)
+        # Лишняя строка говорит, есть ли ещё; при движении назад она первая
+        result = (rows[:limit] if forward else rows[-limit:]), len(rows) > limit
+        if len(self._pages) >= 1000:
+            self._pages = {k: v for k, v in self._pages.items() if v[0] > now}
+        self._pages[key] = (now + self.page_ttl, result)
+        return result
+
+    async def text(self, render):
+        """
+        Текст таблицы: render(top) вызывается, только если кэш сброшен.
+        """
+        with self._lock:
+            self._expire()
+            text, generation = self._text, self._generation
+        if text is not None:
+            self.hits += 1
+            return text
+        text = render(await self.top())
+        with self._lock:
+            if self._generation == generation:
+                self._text = text
+        return text
+
+
+class PointsAccumulator:
+    """
+    Отложенная запись очков за сообщения в чате.
+
+    Очки копятся в памяти по telegram_id и сбрасываются одной транзакцией
+    по таймеру, при достижении порога и при остановке бота.
+    """
+    def __init__(self, storage: Storage, interval: float = 5.0, max_pending: int = 500):
+        self.storage = storage
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._task = None
+        self._stopping = None  # asyncio.Event: просит цикл сброса завершиться
+        self._flushing = None
+        # Метрики
+        self.last_flush_latency = 0.0
+        self.last_flush_rows = 0
+        self.flushes = 0
+
+    @property
+    def pending_rows(self):
+        return len(self._pending)
+
+    def add(self, telegram_id, points=1):
+        telegram_id = int(telegram_id)
+        self._pending[telegram_id] = self._pending.get(telegram_id, 0) + points
+        if len(self._pending) >= self.max_pending and self._flushing is None:
+            self._flushing = asyncio.get_running_loop().create_task(self.flush())
+            self._flushing.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task):
+        self._flushing = None
+        if not task.cancelled() and task.exception():
+            logging.error("Не удалось записать очки за сообщения", exc_info=task.exception())
+
+    async def flush(self):
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        now = datetime.now().isoformat()
+        rows = [(points, now, telegram_id) for telegram_id, points in pending.items()]
+        started = time.perf_counter()
+        try:
+            # Отмена ожидающего не отменяет запись: строки уже изъяты из
+            # _pending, и иначе они потерялись бы, не дойдя до писателя
+            await asyncio.shield(self.storage.write_points(_add_points_many, rows))
+        except Exception:
+            # Возвращаем очки обратно, чтобы не потерять их
+            for telegram_id, points in pending.items():
+                self._pending[telegram_id] = self._pending.get(telegram_id, 0) + points
+            raise
+        self.last_flush_latency = time.perf_counter() - started
+        POINTS_FLUSH_SECONDS.observe(self.last_flush_latency)
+        self.last_flush_rows = len(rows)
+        self.flushes += 1
+        return len(rows)
+
+    def metrics(self):
+        return {
+            "pending_rows": self.pending_rows,
+            "last_flush_latency": self.last_flush_latency,
+            "last_flush_rows": self.last_flush_rows,
+            "flushes": self.flushes,
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Не удалось записать очки за сообщения")
+
+    def start(self):
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        # Цикл не отменяется, а дожидается конца текущего сброса и выходит
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+        if self._flushing is not None:
+            await asyncio.wait([self._flushing])
+        await self.flush()
+
+
+# Общий экземпляр для bot.py
+db = Storage()
+chat_points = PointsAccumulator(db)
@@ -0,0 +1,510 @@
+"""
+Хранилище состояния игр (снимков) за реестром активных игр.
+
+Снимок — JSON от Game.to_dict() с версией. Запись идёт через
+compare_and_swap(expected_version): если игру успела изменить другая
+реплика, запись отклоняется с VersionConflict, и вызывающий перечитывает
+игру и повторяет событие.
+
+Бэкенды: MemoryStore (один процесс), SQLiteStore (таблица game_snapshots)
+и RedisStore (протокол Redis; локально проверяется на RedisStandIn:
+python store.py standin [порт]).
+"""
+import asyncio
+import json
+import logging
+
+from storage import _cas_snapshot, _delete_snapshot, _select_snapshot, _snapshots_for_player, _load_snapshots
+
+
+class VersionConflict(Exception):
+    def __init__(self, chat_id, expected, actual=None):
+        super().__init__(f"Снимок игры {chat_id}: ожидалась версия {expected}, в хранилище {actual}")
+        self.chat_id = chat_id
+        self.expected = expected
+        self.actual = actual
+
+
+class GameStore:
+    """
+    Интерфейс хранилища. Версия 0 означает «снимка нет».
+    shared — хранилище видят другие реплики, и в нём может быть игра,
+    которой нет в памяти этого процесса.
+    """
+    shared = False
+
+    async def prepare(self):
+        pass
+
+    async def get(self, chat_id):
+        """
+        Возвращает (version, data, deadline) или None.
+        """
+        raise NotImplementedError
+
+    async def compare_and_swap(self, chat_id, game_id, expected, data, deadline=None, players=()):
+        """
+        Записывает снимок, если в хранилище версия expected; возвращает новую версию.
+        """
+        raise NotImplementedError
+
+    async def delete(self, chat_id, expected=None):
+        """
+        Удаляет снимок; с expected — только если версия не менялась.
+        """
+        raise NotImplementedError
+
+    async def games_for_player(self, player_id):
+        """
+        chat_id игр, в которых участвует игрок.
+        """
+        raise NotImplementedError
+
+    async def load_all(self):
+        """
+        Все снимки: список (chat_id, version, data, deadline).
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryStore(GameStore):
+    def __init__(self):
+        self._games = {}  # chat_id -> (version, data, deadline, players)
+        self._by_player = {}  # player_id -> set(chat_id)
+
+    def _unindex(self, chat_id, players):
+        for player_id in players:
+            chats = self._by_player.get(player_id)
+            if chats is not None:
+                chats.discard(chat_id)
+                if not chats:
+                    del self._by_player[player_id]
+
+    async def get(self, chat_id):
+        record = self._games.get(chat_id)
+        return record[:3] if record else None
+
+    async def compare_and_swap(self, chat_id, game_id, expected, data, deadline=None, players=()):
+        record = self._games.get(chat_id)
+        actual = record[0] if record else 0
+        if actual != expected:
+            raise VersionConflict(chat_id, expected, actual)
+        if record:
+            self._unindex(chat_id, record[3])
+        players = tuple(players)
+        self._games[chat_id] = (expected + 1, data, deadline, players)
+        for player_id in players:
+            self._by_player.setdefault(player_id, set()).add(chat_id)
+        return expected + 1
+
+    async def delete(self, chat_id, expected=None):
+        record = self._games.get(chat_id)
+        if record is None:
+            return
+        if expected is not None and record[0] != expected:
+            raise VersionConflict(chat_id, expected, record[0])
+        del self._games[chat_id]
+        self._unindex(chat_id, record[3])
+
+    async def games_for_player(self, player_id):
+        return list(self._by_player.get(player_id, ()))
+
+    async def load_all(self):
+        return [(chat_id, version, data, deadline) for chat_id, (version, data, deadline, _) in self._games.items()]
+
+
+class SQLiteStore(GameStore):
+    """
+    Снимки в таблице game_snapshots через поток-писатель Storage.
+    Реплики на одной машине могут делить файл базы. Таблицу создаёт
+    миграция при старте процесса (serve в bot.py).
+    """
+    shared = True
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def get(self, chat_id):
+        return await self.storage.read(_select_snapshot, chat_id)
+
+    async def compare_and_swap(self, chat_id, game_id, expected, data, deadline=None, players=()):
+        version = await self.storage.write(_cas_snapshot, chat_id, game_id, expected, data, deadline, list(players))
+        if version is None:
+            record = await self.get(chat_id)
+            raise VersionConflict(chat_id, expected, record[0] if record else 0)
+        return version
+
+    async def delete(self, chat_id, expected=None):
+        if not await self.storage.write(_delete_snapshot, chat_id, expected):
+            raise VersionConflict(chat_id, expected)
+
+    async def games_for_player(self, player_id):
+        return await self.storage.read(_snapshots_for_player, player_id)
+
+    async def load_all(self):
+        return await self.storage.read(_load_snapshots)
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnection:
+    """
+    Минимальный клиент протокола Redis (RESP2) поверх asyncio.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def command(self, *args):
+        self.writer.write(encode_command(args))
+        await self.writer.drain()
+        return await read_reply(self.reader)
+
+    def close(self):
+        self.writer.close()
+
+
+def encode_command(args):
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def read_reply(reader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Соединение с Redis закрыто")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        raise RedisError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        size = int(rest)
+        if size < 0:
+            return None
+        return (await reader.readexactly(size + 2))[:-2]
+    if kind == b"*":
+        size = int(rest)
+        if size < 0:
+            return None
+        return [await read_reply(reader) for _ in range(size)]
+    raise RedisError(f"Непонятный ответ: {line!r}")
+
+
+class RedisStore(GameStore):
+    """
+    Снимок игры — ключ game:{chat_id} с JSON {version, data, deadline, players},
+    индекс игроков — множества player:{id}, список игр — множество games.
+    CAS сделан через WATCH/MULTI/EXEC, поэтому каждой операции нужно своё
+    соединение — они берутся из небольшого пула.
+    """
+    shared = True
+
+    def __init__(self, host="127.0.0.1", port=6379, prefix="impostigor:", pool_size=8):
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.pool_size = pool_size
+        self._idle = []
+        self._opened = 0
+        self._available = asyncio.Condition()
+
+    def _key(self, *parts):
+        return self.prefix + ":".join(str(part) for part in parts)
+
+    async def _acquire(self):
+        async with self._available:
+            while not self._idle and self._opened >= self.pool_size:
+                await self._available.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._opened += 1
+        try:
+            return await RedisConnection.open(self.host, self.port)
+        except Exception:
+            async with self._available:
+                self._opened -= 1
+                self._available.notify()
+            raise
+
+    async def _release(self, conn, broken=False):
+        async with self._available:
+            if broken:
+                conn.close()
+                self._opened -= 1
+            else:
+                self._idle.append(conn)
+            self._available.notify()
+
+    async def _run(self, fn, *args):
+        conn = await self._acquire()
+        try:
+            result = await fn(conn, *args)
+        except VersionConflict:
+            # WATCH уже снят (UNWATCH или EXEC), соединение чистое
+            await self._release(conn)
+            raise
+        except BaseException:
+            # Не возвращаем в пул соединение с неизвестным состоянием WATCH/MULTI
+            await self._release(conn, broken=True)
+            raise
+        await self._release(conn)
+        return result
+
+    @staticmethod
+    def _decode(raw):
+        return json.loads(raw) if raw is not None else None
+
+    async def get(self, chat_id):
+        record = self._decode(await self._run(lambda conn: conn.command("GET", self._key("game", chat_id))))
+        return (record["version"], record["data"], record["deadline"]) if record else None
+
+    async def _cas(self, conn, chat_id, expected, data, deadline, players):
+        key = self._key("game", chat_id)
+        await conn.command("WATCH", key)
+        record = self._decode(await conn.command("GET", key))
+        actual = record["version"] if record else 0
+        if actual != expected:
+            await conn.command("UNWATCH")
+            raise VersionConflict(chat_id, expected, actual)
+        old_players = set(record["players"]) if record else set()
+        players = list(players)
+        value = json.dumps({"version": expected + 1, "data": data, "deadline": deadline, "players": players})
+        await conn.command("MULTI")
+        commands = [("SET", key, value), ("SADD", self._key("games"), chat_id)]
+        commands += [("SREM", self._key("player", p), chat_id) for p in old_players - set(players)]
+        commands += [("SADD", self._key("player", p), chat_id) for p in players if p not in old_players]
+        for command in commands:
+            await conn.command(*command)
+        if await conn.command("EXEC") is None:
+            raise VersionConflict(chat_id, expected)
+        return expected + 1
+
+    async def compare_and_swap(self, chat_id, game_id, expected, data, deadline=None, players=()):
+        return await self._run(self._cas, chat_id, expected, data, deadline, players)
+
+    async def _delete(self, conn, chat_id, expected):
+        key = self._key("game", chat_id)
+        await conn.command("WATCH", key)
+        record = self._decode(await conn.command("GET", key))
+        if record is None:
+            await conn.command("UNWATCH")
+            return
+        if expected is not None and record["version"] != expected:
+            await conn.command("UNWATCH")
+            raise VersionConflict(chat_id, expected, record["version"])
+        await conn.command("MULTI")
+        await conn.command("DEL", key)
+        await conn.command("SREM", self._key("games"), chat_id)
+        for player_id in record["players"]:
+            await conn.command("SREM", self._key("player", player_id), chat_id)
+        if await conn.command("EXEC") is None:
+            raise VersionConflict(chat_id, expected)
+
+    async def delete(self, chat_id, expected=None):
+        await self._run(self._delete, chat_id, expected)
+
+    async def games_for_player(self, player_id):
+        members = await self._run(lambda conn: conn.command("SMEMBERS", self._key("player", player_id)))
+        return [int(chat_id) for chat_id in members]
+
+    async def _load_all(self, conn):
+        chat_ids = [int(chat_id) for chat_id in await conn.command("SMEMBERS", self._key("games"))]
+        if not chat_ids:
+            return []
+        values = await conn.command("MGET", *[self._key("game", chat_id) for chat_id in chat_ids])
+        return [
+            (chat_id, record["version"], record["data"], record["deadline"])
+            for chat_id, record in zip(chat_ids, map(self._decode, values)) if record
+        ]
+
+    async def load_all(self):
+        return await self._run(self._load_all)
+
+    async def close(self):
+        async with self._available:
+            for conn in self._idle:
+                conn.close()
+            self._opened -= len(self._idle)
+            self._idle.clear()
+
+
+class RedisStandIn:
+    """
+    Локальная замена Redis для проверки RedisStore: строки, множества
+    и WATCH/MULTI/EXEC. Данные живут в памяти процесса.
+    """
+    def __init__(self):
+        self.data = {}
+        self.versions = {}  # key -> счётчик изменений для WATCH
+        self._server = None
+        self._clients = set()
+
+    def _touch(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _set_members(self, key):
+        value = self.data.setdefault(key, set())
+        if not isinstance(value, set):
+            raise RedisError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def execute(self, name, args):
+        if name == "PING":
+            return "PONG"
+        if name == "GET":
+            return self.data.get(args[0])
+        if name == "MGET":
+            return [self.data.get(key) for key in args]
+        if name == "SET":
+            self.data[args[0]] = args[1]
+            self._touch(args[0])
+            return "OK"
+        if name == "DEL":
+            removed = 0
+            for key in args:
+                if self.data.pop(key, None) is not None:
+                    removed += 1
+                    self._touch(key)
+            return removed
+        if name == "SADD":
+            members = self._set_members(args[0])
+            added = len(set(args[1:]) - members)
+            members.update(args[1:])
+            self._touch(args[0])
+            return added
+        if name == "SREM":
+            members = self._set_members(args[0])
+            removed = len(members & set(args[1:]))
+            members.difference_update(args[1:])
+            if not members:
+                del self.data[args[0]]
+            self._touch(args[0])
+            return removed
+        if name == "SMEMBERS":
+            return sorted(self.data.get(args[0], ()))
+        if name == "FLUSHALL":
+            for key in list(self.data):
+                self._touch(key)
+            self.data.clear()
+            return "OK"
+        raise RedisError(f"ERR unknown command '{name}'")
+
+    async def _client(self, reader, writer):
+        watched = {}
+        queued = None
+        self._clients.add(asyncio.current_task())
+        try:
+            while True:
+                args = await read_reply(reader)
+                name, args = args[0].decode().upper(), args[1:]
+                try:
+                    if name == "WATCH":
+                        for key in args:
+                            watched[key] = self.versions.get(key, 0)
+                        reply = "OK"
+                    elif name == "UNWATCH":
+                        watched.clear()
+                        reply = "OK"
+                    elif name == "MULTI":
+                        queued = []
+                        reply = "OK"
+                    elif name == "DISCARD":
+                        queued = None
+                        watched.clear()
+                        reply = "OK"
+                    elif name == "EXEC":
+                        if queued is None:
+                            raise RedisError("ERR EXEC without MULTI")
+                        changed = any(self.versions.get(key, 0) != version for key, version in watched.items())
+                        # Весь MULTI выполняется без переключения задач — атомарно
+                        reply = None if changed else [self.execute(n, a) for n, a in queued]
+                        queued = None
+                        watched.clear()
+                    elif queued is not None:
+                        queued.append((name, args))
+                        reply = "QUEUED"
+                    else:
+                        reply = self.execute(name, args)
+                except RedisError as e:
+                    reply = e
+                writer.write(encode_reply(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass  # клиент отключился или сервер останавливается
+        finally:
+            self._clients.discard(asyncio.current_task())
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=6379):
+        self._server = await asyncio.start_server(self._client, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            for task in list(self._clients):
+                task.cancel()
+            await asyncio.gather(*self._clients, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+
+def encode_reply(value):
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, RedisError):
+        return b"-%s\r\n" % str(value).encode()
+    if isinstance(value, str):
+        return b"+%s\r\n" % value.encode()
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    return b"*%d\r\n" % len(value) + b"".join(encode_reply(item) for item in value)
+
+
+def open_store(url, storage=None):
+    """
+    memory, sqlite или redis://host:port
+    """
+    if url == "memory":
+        return MemoryStore()
+    if url == "sqlite":
+        return SQLiteStore(storage)
+    if url.startswith("redis://"):
+        host, _, port = url[len("redis://"):].rstrip("/").partition(":")
+        return RedisStore(host or "127.0.0.1", int(port or 6379))
+    raise ValueError(f"Неизвестное хранилище игр: {url}")
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "standin":
+        async def serve(port):
+            standin = RedisStandIn()
+            port = await standin.start(port=port)
+            logging.info("Замена Redis слушает 127.0.0.1:%s", port)
+            await asyncio.Event().wait()
+
+        logging.basicConfig(level=logging.INFO)
+        asyncio.run(serve(int(sys.argv[2]) if len(sys.argv) > 2 else 6379))
+    else:
+        print(__doc__)
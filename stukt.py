@@ -1,25 +1,49 @@
 import uuid
-import sqlite3
 import random
-from contextlib import nullcontext
-from typing import List, Optional
+from typing import Optional
 from datetime import datetime
 
-# Функция для создания соединения с базой данных
-def connect_db():
-    conn = sqlite3.connect("leaderboard.db")
-    return conn
 
 
+# Битовые метки ролей: проверка стороны — одна операция & вместо isinstance.
+# Метка подкласса включает метку родителя (Дон — тоже мафия).
+MAFIA = 1
+DON = 2
+COMMISSIONER = 4
+DOCTOR = 8
+VILLAGER = 16
+LOVER = 32
+KAMIKAZE = 64
+MANIAC = 128
+JUDGE = 256
+HOBO = 512
+# Роли, которые Любовница «отвлекает» с начислением очков
+BLOCKABLE = MAFIA | COMMISSIONER | DOCTOR
+
 
 class Role:
     """
     Базовый класс для ролей.
+    Название и описание общие для класса, в экземпляре — только игрок и состояние.
+
+    Роль сама описывает свою ночь: action — действие из callback-данных
+    (action:<action>:<id>), prompt и button — текст клавиатуры и подпись
+    кнопок, priority — очередь разрешения (меньше — раньше), reward — очки
+    за удачное действие, resolve() — исход действия. Новая роль — это
+    подкласс и строка в ROLE_CLASSES.
     """
-    def __init__(self, player_id: int, role_name: str, role_desk: str):
+    __slots__ = ("player_id",)
+    kind = 0
+    role_name = ""  # Название роли
+    role_desk = ""  # Описание роли
+    action = None
+    prompt = None
+    button = None
+    priority = 0
+    reward = 0
+
+    def __init__(self, player_id: int):
         self.player_id = player_id  # Идентификатор игрока
-        self.role_name = role_name  # Название роли
-        self.role_desk = role_desk  # Описание роли
 
     def perform_action(self, *args, **kwargs):
         """
@@ -27,11 +51,36 @@ class Role:
         """
         pass
 
-class Mafia(Role):
-    def __init__(self, player_id: int):
-        role_desk = "Каждую ночь Вы голосуете за жертву. Но последнее слово за Доном.\nВы также можете общаться с напарниками в этом чате."
-        super().__init__(player_id, "Мафия", role_desk)
+    def has_night_action(self):
+        # Ждём ли этого игрока, прежде чем закончить ночь
+        return self.action is not None
+
+    def button_row(self, target):
+        return [(f"{self.button} {target.player_name}", f"action:{self.action}:{target.player_id}")]
 
+    def keyboard(self, game, player):
+        """
+        Возвращает (текст, ряды кнопок) для ночного сообщения или None.
+        Ряды общие для всех игроков с этим действием, у каждого без него самого.
+        """
+        if self.action is None:
+            return None
+        return self.prompt, game.buttons_for(("night", self.action), self.button_row, viewer=player.player_id)
+
+    @classmethod
+    def resolve(cls, night, action):
+        pass
+
+class Mafia(Role):
+    __slots__ = ()
+    kind = MAFIA
+    role_name = "Мафия"
+    role_desk = "Каждую ночь Вы голосуете за жертву. Но последнее слово за Доном.\nВы также можете общаться с напарниками в этом чате."
+    action = "kill"
+    prompt = "Выберите кого убить этой ночью:"
+    button = "Убить"
+    priority = 1
+    reward = 3  # каждому мафиози за удачное убийство
 
     def perform_action(self, target_id: int):
         """
@@ -39,12 +88,19 @@ class Mafia(Role):
         """
         return {"action": "kill", "target": target_id}
 
-class DonMafia(Mafia):
+    @classmethod
+    def resolve(cls, night, action):
+        if not night.blocked(action["player_id"]):
+            night.vote(action["target_id"])
 
-    def __init__(self, player_id: int):
-        super().__init__(player_id)
-        self.role_name = "Дон Мафии"
-        self.role_desk = "Каждую ночь Вы голосуете за жертву. Но помните последнее слово за Вами.\nВы также можете общаться с напарниками в этом чате."
+class DonMafia(Mafia):
+    __slots__ = ()
+    kind = MAFIA | DON
+    role_name = "Дон Мафии"
+    role_desk = "Каждую ночь Вы голосуете за жертву. Но помните последнее слово за Вами.\nВы также можете общаться с напарниками в этом чате."
+    action = "final_kill"
+    button = "Решить судьбу"
+    reward = 7
 
     def finalize_decision(self, target_id: int):
         """
@@ -52,10 +108,22 @@ class DonMafia(Mafia):
         """
         return {"action": "final_kill", "target": target_id}
 
+    @classmethod
+    def resolve(cls, night, action):
+        if not night.blocked(action["player_id"]):
+            night.vote(action["target_id"])
+            night.final_kill_target = action["target_id"]
+
 class Commissioner(Role):
-    def __init__(self, player_id: int):
-        role_desk = "Каждую ночь Вы можете проверить одного игрока на принадлежность его к мафии."
-        super().__init__(player_id, "Комиссар", role_desk)
+    __slots__ = ()
+    kind = COMMISSIONER
+    role_name = "Комиссар"
+    role_desk = "Каждую ночь Вы можете проверить одного игрока на принадлежность его к мафии."
+    action = "investigate"
+    prompt = "Выберите кого проверить этой ночью:"
+    button = "Проверить"
+    priority = 1
+    reward = 4  # за найденную мафию
 
     def perform_action(self, target_id: int):
         """
@@ -63,10 +131,35 @@ class Commissioner(Role):
         """
         return {"action": "investigate", "target": target_id}
 
+    @classmethod
+    def resolve(cls, night, action):
+        if night.blocked(action["player_id"]):
+            return
+        target = night.alive[action["target_id"]]
+        text = f"Игрок {target.player_name} не мафия."
+        if target.kind & MAFIA:
+            text = f"Игрок {target.player_name} мафия."
+            night.reward(action["player_id"], cls.reward)
+        night.results.append({
+            "action": "investigate",
+            "player_id": action["player_id"],
+            "target_id": action["target_id"],
+            "text": text
+        })
+
 class Doctor(Role):
+    __slots__ = ("self_heal",)
+    kind = DOCTOR
+    role_name = "Доктор"
+    role_desk = "Каждую ночь Вы можете вылечить одного игрока и спасти его от ночного убийства. Но помните, себя можно выбрать один раз."
+    action = "heal"
+    prompt = "Выберите кого лечить этой ночью:"
+    button = "Лечить"
+    priority = 1
+    reward = 5  # за спасённого
+
     def __init__(self, player_id: int):
-        role_desk = "Каждую ночь Вы можете вылечить одного игрока и спасти его от ночного убийства. Но помните, себя можно выбрать один раз."
-        super().__init__(player_id, "Доктор", role_desk)
+        super().__init__(player_id)
         self.self_heal = True
 
     def perform_action(self, target_id: int):
@@ -75,15 +168,36 @@ class Doctor(Role):
         """
         return {"action": "heal", "target": target_id}
 
+    def keyboard(self, game, player):
+        # Себя можно лечить, пока не потрачено самолечение
+        viewer = None if self.self_heal else player.player_id
+        return self.prompt, game.buttons_for(("night", self.action), self.button_row, viewer=viewer)
+
+    @classmethod
+    def resolve(cls, night, action):
+        if night.blocked(action["player_id"]):
+            return
+        night.heal_target = action["target_id"]
+        night.results.append({"action": "heal", "target_id": action["target_id"]})
+        if action["target_id"] == action["player_id"]:
+            night.alive[action["player_id"]].role.self_heal = False
+
 class Villager(Role):
-    def __init__(self, player_id: int):
-        role_desk = "Вы не имеете активных действий ночью. Ждите утра и вершите правосудие."
-        super().__init__(player_id, "Мирный житель", role_desk)
+    __slots__ = ()
+    kind = VILLAGER
+    role_name = "Мирный житель"
+    role_desk = "Вы не имеете активных действий ночью. Ждите утра и вершите правосудие."
 
 class Lover(Role):
-    def __init__(self, player_id: int):
-        role_desk = "Каждую ночь Вы можете выбрать одного игрока и лишить его всех активных действий до следующей ночи."
-        super().__init__(player_id, "Любовница", role_desk)
+    __slots__ = ()
+    kind = LOVER
+    role_name = "Любовница"
+    role_desk = "Каждую ночь Вы можете выбрать одного игрока и лишить его всех активных действий до следующей ночи."
+    action = "block"
+    prompt = "Выберите с кем Вы будете этой ночью:"
+    button = "Блокировать"
+    priority = 0  # блокировка действует на все остальные действия ночи
+    reward = 2  # за заблокированную активную роль
 
     def perform_action(self, target_id: int):
         """
@@ -91,10 +205,20 @@ class Lover(Role):
         """
         return {"action": "block", "target": target_id}
 
+    @classmethod
+    def resolve(cls, night, action):
+        night.results.append({"action": "block", "target_id": action["target_id"]})
+        night.game.lblock_player = action["target_id"]
+        target = night.everyone.get(action["target_id"])
+        if target is not None and target.kind & BLOCKABLE:
+            night.reward(action["player_id"], cls.reward)
+
 class Kamikaze(Role):
-    def __init__(self, player_id: int):
-        role_desk = "Если вас убивают ночью, вы забираете убийцу с собой в могилу."
-        super().__init__(player_id, "Камикадзе", role_desk)
+    __slots__ = ()
+    kind = KAMIKAZE
+    role_name = "Камикадзе"
+    role_desk = "Если вас убивают ночью, вы забираете убийцу с собой в могилу."
+    reward = 5  # за взорванного убийцу
 
     def perform_action(self, target_id: int):
         """
@@ -104,9 +228,15 @@ class Kamikaze(Role):
 
 
 class Maniac(Role):
-    def __init__(self, player_id: int):
-        role_desk = "Вы действуете независимо от всех. Каждую ночь убиваете одного игрока. Цель — остаться последним выжившим."
-        super().__init__(player_id, "Маньяк", role_desk)
+    __slots__ = ()
+    kind = MANIAC
+    role_name = "Маньяк"
+    role_desk = "Вы действуете независимо от всех. Каждую ночь убиваете одного игрока. Цель — остаться последним выжившим."
+    action = "m_kill"
+    prompt = "Выберите кого порешать этой ночью:"
+    button = "Зарезать"
+    priority = 2  # после мафии: убитый мафией маньяк не ходит
+    reward = 3
 
     def perform_action(self, target_id: int):
         """
@@ -114,11 +244,42 @@ class Maniac(Role):
         """
         return {"action": "kill", "target": target_id}
 
+    @classmethod
+    def resolve(cls, night, action):
+        night.settle_mafia()
+        player_id, target_id = action["player_id"], action["target_id"]
+        if night.blocked(player_id) or player_id == night.final_kill_target or night.heal_target == target_id:
+            return
+        night.m_kill_target = target_id
+        night.reward(player_id, cls.reward)
+        victim = night.alive[target_id]
+        night.results.append({
+            "action": "m_kill",
+            "player_id": player_id,
+            "target_id": target_id,
+            "text": f"Этой ночью был зверски убит игрок {victim.player_name}."
+        })
+        if victim.kind & KAMIKAZE:
+            maniac = night.first(MANIAC)
+            if maniac.player_id != night.heal_target:
+                night.explode(victim, maniac)
+            else:
+                night.reward_doctor()
+
 
 class Judge(Role):
+    __slots__ = ("vote_canceled",)
+    kind = JUDGE
+    role_name = "Судья"
+    role_desk = "Вы можете один раз за игру отменить дневное голосование дав игроку иммунитет."
+    action = "cancel_vote"
+    prompt = "Выберите кому дать иммунитет от дневного голосования:"
+    button = "Оправдать"
+    priority = 3  # после всех убийств: убитый ночью судья не ходит
+    reward = 5
+
     def __init__(self, player_id: int):
-        role_desk = "Вы можете один раз за игру отменить дневное голосование дав игроку иммунитет."
-        super().__init__(player_id, "Судья", role_desk)
+        super().__init__(player_id)
         self.vote_canceled = True  # Индикатор использования способности
 
     def perform_action(self):
@@ -131,11 +292,40 @@ class Judge(Role):
         else:
             return {"action": "ability_used"}
 
+    def has_night_action(self):
+        return bool(self.vote_canceled)
+
+    def keyboard(self, game, player):
+        # Способность одноразовая; после неё остаётся только текст
+        buttons = None
+        if self.vote_canceled:
+            buttons = game.buttons_for(("night", self.action), self.button_row) + [[("Пропустить", "action:skip")]]
+        return self.prompt, buttons
+
+    @classmethod
+    def resolve(cls, night, action):
+        night.settle_mafia()
+        player_id = action["player_id"]
+        if night.blocked(player_id) or night.killed(player_id):
+            return
+        night.alive[player_id].role.vote_canceled = False
+        night.game.vote_canceled = action["target_id"]
+        night.reward(player_id, cls.reward)
+
 
 class Hobo(Role):
+    __slots__ = ("current_target",)
+    kind = HOBO
+    role_name = "Бомж"
+    role_desk = "Каждую ночь вы можете наведаться к любому игроку и выпить. Будьте внимательны, возможно вы увидите убийцу."
+    action = "start_tracking"
+    prompt = "Выберите у кого поспать под дверью:"
+    button = "Пойти к"
+    priority = 3
+    reward = 4  # если что-то увидел
+
     def __init__(self, player_id: int):
-        role_desk = "Каждую ночь вы можете наведаться к любому игроку и выпить. Будьте внимательны, возможно вы увидите убийцу."
-        super().__init__(player_id, "Бомж", role_desk)
+        super().__init__(player_id)
         self.current_target = None
 
     def perform_action(self, target_id: Optional[int] = None):
@@ -148,56 +338,365 @@ class Hobo(Role):
         else:
             return {"action": "reveal_killer", "target": self.current_target}
 
+    @classmethod
+    def resolve(cls, night, action):
+        night.settle_mafia()
+        player_id, target_id = action["player_id"], action["target_id"]
+        if night.blocked(player_id) or night.killed(player_id):
+            return
+        text = "Сегодня всё тихо."
+        if target_id == night.final_kill_target:
+            # Проверяем, совпадает ли цель с жертвой мафии
+            seen = night.game.rng.choice(night.of_kind(MAFIA))
+            text = f"ОЙ!! Кажется, вы видели {seen.player_name} на месте преступления."
+        elif target_id == night.m_kill_target:
+            seen = night.first(MANIAC)
+            text = f"ОЙ!! Кажется, вы видели {seen.player_name} на месте преступления."
+        elif night.alive.get(target_id) is not None and night.alive[target_id].kind & (MAFIA | MANIAC):
+            # Убийцы ночью не дома
+            text = "Странно, но дома никого не было..."
+        night.results.append({
+            "action": "start_tracking",
+            "player_id": player_id,
+            "target_id": target_id,
+            "text": text
+        })
+        if text != "Сегодня всё тихо.":
+            night.reward(player_id, cls.reward)
+
+
+class Player:
+    """
+    Участник игры. Роль назначается при старте через set_role(),
+    которая заодно копирует метку роли в kind (0 — роли ещё нет).
+    """
+    __slots__ = ("player_id", "player_name", "role", "kind")
+
+    def __init__(self, player_id: int, player_name: str, role: Optional[Role] = None):
+        self.player_id = player_id
+        self.player_name = player_name
+        self.set_role(role)
+
+    def set_role(self, role):
+        self.role = role
+        self.kind = role.kind if role is not None else 0
+
+    def __repr__(self):
+        return f"Player({self.player_id}, {self.player_name!r}, {type(self.role).__name__ if self.role else None})"
+
+
+class Night:
+    """
+    Состояние разрешения одной ночи: голоса мафии, цели лечения и убийств,
+    результаты. Игроки ищутся по словарю, а не перебором списка.
+    """
+    def __init__(self, game):
+        self.game = game
+        self.alive = {p.player_id: p for p in game.players}
+        self.everyone = {p.player_id: p for p in game._players}
+        self.results = []
+        self.kill_votes = {}
+        self.final_kill_target = None
+        self.heal_target = None
+        self.m_kill_target = None
+        self._mafia_settled = False
+
+    def blocked(self, player_id):
+        return player_id == self.game.lblock_player
+
+    def killed(self, player_id):
+        return player_id == self.final_kill_target or player_id == self.m_kill_target
+
+    def reward(self, player_id, points):
+        self.game.update_user_stats(int(player_id), points, False, False)
+
+    def of_kind(self, mask):
+        return [p for p in self.game.players if p.kind & mask]
+
+    def first(self, mask):
+        return next((p for p in self.game.players if p.kind & mask), None)
+
+    def reward_doctor(self):
+        doctor = self.first(DOCTOR)
+        if doctor:
+            self.reward(doctor.player_id, Doctor.reward)
+
+    def vote(self, target_id):
+        self.kill_votes[target_id] = self.kill_votes.get(target_id, 0) + 1
+
+    def explode(self, kamikaze, killer):
+        self.results.append({"action": "explode", "player_id": kamikaze.player_id, "target_id": killer.player_id,
+                             "text": f"Игрок {killer.player_name} нарвался на камикадзе"})
+        self.reward(kamikaze.player_id, Kamikaze.reward)
+
+    def settle_mafia(self):
+        """
+        Итог голосования мафии. Вызывается, когда все голоса уже учтены:
+        действиями следующих по очереди ролей или в конце ночи.
+        """
+        if self._mafia_settled:
+            return
+        self._mafia_settled = True
+        if not self.kill_votes:
+            return
+        max_votes = max(self.kill_votes.values())
+        top_targets = [target_id for target_id, votes in self.kill_votes.items() if votes == max_votes]
+
+        # Если несколько целей с одинаковыми голосами, выбираем цель Дона мафии
+        if len(top_targets) > 1:
+            if self.final_kill_target and self.heal_target == self.final_kill_target:
+                self.final_kill_target = None
+        elif self.heal_target != top_targets[0]:
+            self.final_kill_target = top_targets[0]
+        else:
+            self.final_kill_target = None
+
+        if not self.final_kill_target:
+            self.reward_doctor()
+            return
+        victim = self.alive[self.final_kill_target]
+        if victim.kind & KAMIKAZE:
+            killer = self.game.rng.choice(self.of_kind(MAFIA))
+            if killer.player_id != self.heal_target:
+                self.explode(victim, killer)
+        for p in self.game.players:
+            if p.kind & MAFIA:
+                self.reward(p.player_id, p.role.reward)
+        self.results.append({
+            "action": "kill", "target_id": self.final_kill_target,
+            "text": f"У игрока {victim.player_name} этой ночью побывала мафия."
+        })
+
+
+# Роли по имени класса — для восстановления игры из снимка
+ROLE_CLASSES = {cls.__name__: cls for cls in (Mafia, DonMafia, Commissioner, Doctor, Villager, Lover, Kamikaze, Maniac, Judge, Hobo)}
+# Ночное действие -> роль, которая его разрешает
+NIGHT_ACTIONS = {cls.action: cls for cls in ROLE_CLASSES.values() if cls.action}
+# Изменяемое состояние ролей, которое нужно сохранять
+ROLE_STATE = ("self_heal", "vote_canceled", "current_target")
+
+
+def role_to_dict(role):
+    if role is None:
+        return None
+    data = {"kind": type(role).__name__}
+    for name in ROLE_STATE:
+        if hasattr(role, name):
+            data[name] = getattr(role, name)
+    return data
+
+
+def role_from_dict(data, player_id):
+    if data is None:
+        return None
+    role = ROLE_CLASSES[data["kind"]](player_id)
+    for name in ROLE_STATE:
+        if name in data:
+            setattr(role, name, data[name])
+    return role
+
+
+# Эффекты — что нужно сделать снаружи после перехода игры.
+# Игра не делает сетевых вызовов и не пишет в базу сама,
+# она только возвращает список эффектов, которые исполняет bot.py.
+
+class SendMessage:
+    def __init__(self, chat_id, text, thread_id=None, buttons=None, required=False):
+        self.chat_id = chat_id
+        self.text = text
+        self.thread_id = thread_id
+        self.buttons = buttons  # Список рядов кнопок [(текст, callback_data), ...]
+        self.required = required  # Сообщить в чат, если сообщение не дошло
+
+    def __repr__(self):
+        return f"SendMessage({self.chat_id}, {self.text!r})"
+
+
+class EditMessage:
+    def __init__(self, chat_id, message_id, text, buttons=None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.buttons = buttons
+
+    def __repr__(self):
+        return f"EditMessage({self.chat_id}, {self.message_id}, {self.text!r})"
+
+
+class AnswerCallback:
+    def __init__(self, text, show_alert=False):
+        self.text = text
+        self.show_alert = show_alert
+
+    def __repr__(self):
+        return f"AnswerCallback({self.text!r})"
+
+
+class StatsDelta:
+    def __init__(self, telegram_id, points=0, game_played=False, game_won=False):
+        self.telegram_id = telegram_id
+        self.points = points
+        self.game_played = game_played
+        self.game_won = game_won
+
+    def __repr__(self):
+        return f"StatsDelta({self.telegram_id}, {self.points})"
+
+
+class Settle:
+    def __init__(self, settlement):
+        self.settlement = settlement
+
+
+class Schedule:
+    """
+    Передать игре событие event через delay секунд.
+    Новый Schedule заменяет прежний таймер игры.
+    """
+    def __init__(self, delay, event):
+        self.delay = delay
+        self.event = event
+
+
+class GameOver:
+    pass
+
+
+# События — входы конечного автомата игры
+
+class StartGame:
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    def __repr__(self):
+        return f"StartGame({self.user_id})"
+
+
+class NightAction:
+    def __init__(self, player_id, action, target_id=None, chat_id=None, message_id=None):
+        self.player_id = player_id
+        self.action = action
+        self.target_id = target_id
+        self.chat_id = chat_id  # Сообщение с кнопками, которое нужно поправить
+        self.message_id = message_id
+
+    def __repr__(self):
+        return f"NightAction({self.player_id}, {self.action!r}, {self.target_id})"
+
+
+class PhaseTimeout:
+    """
+    Дедлайн фазы истёк. seq отличает таймер текущей фазы от устаревших.
+    """
+    def __init__(self, seq):
+        self.seq = seq
+
+    def __repr__(self):
+        return f"PhaseTimeout({self.seq})"
+
+
+class Nominate:
+    def __init__(self, player_id, nominee_id=None, chat_id=None, message_id=None):
+        self.player_id = player_id
+        self.nominee_id = nominee_id  # None — воздержался
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    def __repr__(self):
+        return f"Nominate({self.player_id}, {self.nominee_id})"
+
+
+class FinalVote:
+    def __init__(self, player_id, decision, nominee_id):
+        self.player_id = player_id
+        self.decision = decision
+        self.nominee_id = nominee_id
+
+    def __repr__(self):
+        return f"FinalVote({self.player_id}, {self.decision!r}, {self.nominee_id})"
+
+
+# Длительность фаз, секунд
+NIGHT_TIME = 90
+DISCUSSION_TIME = 60
+NOMINATION_TIME = 60
+FINAL_VOTE_TIME = 45
+
 
 class Game:
-    def __init__(self, game_id: Optional[str] = None, topic_id=None):
+    def __init__(self, game_id: Optional[str] = None, topic_id=None, chat_id=None, rng=None):
         self.game_id = game_id or str(uuid.uuid4())  # Уникальный идентификатор игры
         self.topic_id = topic_id
+        self.chat_id = chat_id
         self.players = []  # Список игроков
         self._players = []  # полный список игроков
         self.roles = []  # Список ролей
         self.state = "waiting"  # Состояние игры: waiting, night, day, finished
+        self.day_stage = None  # Этап дня: discussion, nomination, final_vote
+        self.nominee_id = None  # Кандидат на финальном голосовании
+        self.phase_seq = 0  # Номер текущей фазы для дедлайнов
         self.creator_id = None
         self.player_roles = {}  # Хранение привязки игрока к роли
         self.night_actions = []  # Список действий на ночь
         self.lblock_player = None
         self.nominations = {}
         self.vote_canceled = None
-
-    @staticmethod
-    def update_user_stats(telegram_id, points_to_add=0, game_played=False, game_won=False):
-        with connect_db() as conn:
-            cursor = conn.cursor()
-
-            # Обновление данных пользователя
-            cursor.execute('''
-                UPDATE leaderboard
-                SET points = points + ?,
-                    games_played = games_played + ?,
-                    games_won = games_won + ?,
-                    last_updated = ?
-                WHERE telegram_id = ?
-            ''', (
-                points_to_add,  # Добавляемые очки
-                1 if game_played else 0,  # Увеличение количества игр, если игра сыграна
-                1 if game_won else 0,  # Увеличение побед, если игра выиграна
-                datetime.now().isoformat(),  # Текущее время для last_updated
-                int(telegram_id)
-            ))
+        self.settlement = None  # Итоги игры после check_winner
+        self.registry = None  # GameRegistry, в котором зарегистрирована игра
+        self.version = 0  # Версия снимка в хранилище игр (0 — ещё не сохранена)
+        self.rng = rng or random.Random()
+        self._stats = []  # Накопленные StatsDelta
+        self.history = []  # События партии: [phase_seq, kind, player_id, target_id]
+        self.roster_version = 0  # Меняется вместе с составом и порядком живых игроков
+        self._keyboards = {}  # (фаза, действие, ..., roster_version) -> (ряды, позиция игрока), на один handle()
+        self.changed = False  # Изменил ли игру последний handle()
+
+    def update_user_stats(self, telegram_id, points_to_add=0, game_played=False, game_won=False):
+        # Изменение статистики уходит наружу эффектом StatsDelta
+        self._stats.append(StatsDelta(int(telegram_id), points_to_add, game_played, game_won))
+
+    def roster_changed(self):
+        # Кэш клавиатур построен по прежнему составу
+        self.roster_version += 1
+        self._keyboards.clear()
+
+    def buttons_for(self, key, row, viewer=None, hidden=None):
+        """
+        Ряды кнопок по живым игрокам: row(player) для каждого, кроме hidden.
+        Ряды строятся один раз на ключ и состав игроков в пределах
+        одного handle(); игроку viewer достаётся копия списка без его
+        собственного ряда.
+        """
+        key = key + (hidden, self.roster_version)
+        cached = self._keyboards.get(key)
+        if cached is None:
+            targets = [p for p in self.players if p.player_id != hidden]
+            cached = self._keyboards[key] = ([row(p) for p in targets], {p.player_id: i for i, p in enumerate(targets)})
+        rows, positions = cached
+        index = positions.get(viewer)
+        if index is None:
+            return list(rows)
+        return rows[:index] + rows[index + 1:]
 
     def del_player(self, player_id: int):
-        victim = next(p for p in self.players if p["player_id"] == player_id)
+        victim = next(p for p in self.players if p.player_id == player_id)
         self.players.remove(victim)
+        self.roster_changed()
+        if self.registry:
+            self.registry.unindex_player(player_id, self)
 
     def add_player(self, player_id: int, player_name: str, role: Optional[Role] = None):
         """
         Добавляет игрока в игру.
         """
-        if any(player["player_id"] == player_id for player in self.players):
+        if any(player.player_id == player_id for player in self.players):
             raise ValueError("Игрок с таким ID уже существует.")
-        self.players.append({"player_id": player_id, "player_name": player_name, "role": role})
+        self.players.append(Player(player_id, player_name, role))
+        self.roster_changed()
         if role:
             self.roles.append(role)
+        if self.registry:
+            self.registry.index_player(player_id, self)
 
     def start_game(self):
         """
@@ -205,7 +704,7 @@ class Game:
         """
         if len(self.players) >= 4:
             self.state = "night"
-            self._players = self.players
+            self._players = list(self.players)
         else:
             raise ValueError("Недостаточно игроков для начала игры.")
 
@@ -218,209 +717,437 @@ class Game:
     def change_role(self, player_id, new_role):
         # Ищем игрока с указанным id
         for player in self.players:
-            if player['player_id'] == player_id:
-                player['role'] = new_role(player_id)  # Меняем роль
-                return f"Успешное изменение роли  игрока id: {player['player_id']} name: {player['player_name']} на роль: {player['role']}"
+            if player.player_id == player_id:
+                player.set_role(new_role(player_id))  # Меняем роль
+                return f"Успешное изменение роли  игрока id: {player.player_id} name: {player.player_name} на роль: {player.role}"
         return f"игрок с id: {player_id} не найден"
 
     # Проверка на победу одной из сторон
     def check_winner(self):
-        mafia_count = sum(1 for p in self.players if isinstance(p["role"], (Mafia, DonMafia)))
-        gray_count = sum(1 for p in self.players if isinstance(p["role"], Maniac))
+        mafia_count = sum(1 for p in self.players if p.kind & MAFIA)
+        gray_count = sum(1 for p in self.players if p.kind & MANIAC)
         peaceful_count = len(self.players) - mafia_count - gray_count
 
         if gray_count > mafia_count + peaceful_count:
-            for p in self._players:
-                if isinstance(p["role"], Maniac):
-                    self.update_user_stats(p["player_id"], 15, True, True)
-                else:
-                    self.update_user_stats(p["player_id"], 0, True, False)
-            return "maniac"
-
+            winner = "maniac"
         elif mafia_count == 0:
-            for p in self._players:
-                if not isinstance(p["role"], (Mafia, DonMafia, Maniac)):
-                    self.update_user_stats(p["player_id"], 10, True, True)
-                else:
-                    self.update_user_stats(p["player_id"], 0, True, False)
-            return "peaceful"  # Мирные жители победили
-
+            winner = "peaceful"  # Мирные жители победили
         elif mafia_count >= peaceful_count + gray_count:
-            for p in self._players:
-                if isinstance(p["role"], (Mafia, DonMafia)):
-                    self.update_user_stats(p["player_id"], 10, True, True)
-                else:
-                    self.update_user_stats(p["player_id"], 0, True, False)
-            return "mafia"  # Мафия победила
-
+            winner = "mafia"  # Мафия победила
         else:
             return None  # Игра продолжается
 
+        # Итоги игры записываются одной транзакцией через эффект Settle
+        self.settlement = self.settle(winner)
+        return winner
+
+    @staticmethod
+    def is_winner(kind, winner):
+        if winner == "maniac":
+            return bool(kind & MANIAC)
+        if winner == "peaceful":
+            return not kind & (MAFIA | MANIAC)
+        return bool(kind & MAFIA)
+
+    def settle(self, winner):
+        """
+        Считает итоговые изменения статистики всех участников игры.
+        Возвращает запись об итогах, которую можно сохранить в историю игр.
+        """
+        win_points = 15 if winner == "maniac" else 10
+        players = []
+        for p in self._players:
+            won = self.is_winner(p.kind, winner)
+            players.append({
+                "telegram_id": int(p.player_id),
+                "player_name": p.player_name,
+                "role": p.role.role_name if p.role else None,
+                "alive": p in self.players,
+                "points": win_points if won else 0,
+                "games_played": 1,
+                "games_won": 1 if won else 0,
+            })
+        return {
+            "game_id": self.game_id,
+            "chat_id": self.chat_id,
+            "winner": winner,
+            "finished_at": datetime.now().isoformat(),
+            "players": players,
+            "events": self.history,
+        }
+
     def process_night_actions(self):
         """
-        Обрабатывает действия игроков ночью.
-        """
-        results = []
-        kill_votes = {}
-        final_kill_target = None
-        heal_target = None
-        m_kill_target = None
-
-
-        for action in self.night_actions:
-            if action["action"] == "block":
-                # Блокировка действия
-                results.append({"action": "block", "target_id": action["target_id"]})
-                self.lblock_player = action["target_id"]
-                for p in self._players:
-                    if isinstance(p["role"], (Mafia, DonMafia, Commissioner, Doctor)) and p["player_id"] == action["target_id"]:
-                        self.update_user_stats(int(action["player_id"]), 2, False, False)
-
-            elif action["action"] == "investigate" and action["player_id"] != self.lblock_player:
-                # Проверка роли игрока
-                s = next(po for po in self.players if po["player_id"] == action["target_id"])
-                t = f"Игрок {s['player_name']} не мафия."
-
-                if isinstance(s["role"], (Mafia, DonMafia)):
-                    t = f"Игрок {s['player_name']} мафия."
-                    self.update_user_stats(int(action["player_id"]), 4, False, False)
-
-                # Добавляем результат
-                results.append({
-                    "action": "investigate",
-                    "player_id": action["player_id"],
-                    "target_id": action["target_id"],
-                    "text": t
-                })
-
-            elif action["action"] == "heal" and action["player_id"] != self.lblock_player:
-                # Осуществляем лечение
-                heal_target = action["target_id"]
-                results.append({"action": "heal", "target_id": action["target_id"]})
-                if action["target_id"] == action["player_id"]:
-                    v = next(p for p in self.players if p["player_id"] == action["player_id"])
-                    v["role"].self_heal = False
-
-            elif action["action"] == "kill" and action["player_id"] != self.lblock_player:
-                target_id = action["target_id"]
-                kill_votes[target_id] = kill_votes.get(target_id, 0) + 1
-
-            # Сохраняем выбор Дона мафии (final_kill)
-            elif action["action"] == "final_kill" and action["player_id"] != self.lblock_player:
-                target_id = action["target_id"]
-                kill_votes[target_id] = kill_votes.get(target_id, 0) + 1
-                final_kill_target = target_id
-
-
-        # Определяем цели с наибольшим количеством голосов
-        if kill_votes:
-            max_votes = max(kill_votes.values())
-            top_targets = [target_id for target_id, votes in kill_votes.items() if votes == max_votes]
-            dead_pm = None
-
-            # Если несколько целей с одинаковыми голосами, выбираем цель Дона мафии
-            if len(top_targets) > 1 :
-                if final_kill_target:
-                    if heal_target == final_kill_target:
-                        final_kill_target = None
-            else:
-                if heal_target != top_targets[0]:
-                    final_kill_target = top_targets[0]
-                else:
-                    final_kill_target = None
-
-            if final_kill_target:
-                dead_pm = next(po for po in self.players if po["player_id"] == final_kill_target)
-                textki = f"У игрока {dead_pm['player_name']} этой ночью побывала мафия."
-
-                if isinstance(dead_pm["role"], Kamikaze):
-                    ma = [po for po in self.players if isinstance(po["role"], (Mafia, DonMafia))]
-                    m = random.choice(ma)
-                    if m["player_id"] != heal_target:
-                        results.append({"action": "explode", "player_id": dead_pm["player_id"], "target_id": m["player_id"],
-                                        "text": f"Игрок {m['player_name']} нарвался на камикадзе"})
-                        self.update_user_stats(int(dead_pm["player_id"]), 5, False, False)
-                    #else:
-                        #doc = next(po for po in self.players if isinstance(po["role"], Doctor))
-                        #update_user_stats(int(doc["player_id"]), 5, False, False)
-
-                for p in self.players:
-                    if isinstance(p["role"], Mafia):
-                        self.update_user_stats(int(p["player_id"]), 3, False, False)
-                    if isinstance(p["role"], DonMafia):
-                        self.update_user_stats(int(p["player_id"]), 4, False, False)
-
-                results.append({
-                    "action": "kill", "target_id": final_kill_target,
-                    "text": textki
-                })
+        Обрабатывает действия игроков ночью: один проход по действиям
+        в порядке приоритета их ролей.
+        """
+        night = Night(self)
+        actions = [(NIGHT_ACTIONS[a["action"]], a) for a in self.night_actions if a["action"] in NIGHT_ACTIONS]
+        actions.sort(key=lambda item: item[0].priority)
+        for role, action in actions:
+            role.resolve(night, action)
+        night.settle_mafia()
+        return night.results
 
-            else:
-                doc = next(po for po in self.players if isinstance(po["role"], Doctor))
-                self.update_user_stats(int(doc["player_id"]), 5, False, False)
-
-
-        for action in self.night_actions:
-            # Логика Маньяка
-            if action["action"] == "m_kill" and action["player_id"] != self.lblock_player and action["player_id"] != final_kill_target:
-                if heal_target != action["target_id"]:
-                    m_kill_target = action["target_id"]
-                    self.update_user_stats(int(action["player_id"]), 3, False, False)
-                    # Добавляем результат
-                    a = next(p for p in self.players if p["player_id"] == action["target_id"])
-                    results.append({
-                        "action": "m_kill",
-                        "player_id": action["player_id"],
-                        "target_id": action["target_id"],
-                        "text": f"Этой ночью был зверски убит игрок {a['player_name']}."
-                    })
-                    if isinstance(a["role"], Kamikaze):
-                        m = next(po for po in self.players if isinstance(po["role"], Maniac))
-                        if m["player_id"] != heal_target:
-                            results.append(
-                                {"action": "explode", "player_id": p["player_id"], "target_id": m["player_id"],
-                                 "text": f"Игрок {m['player_name']} нарвался на камикадзе"})
-                            self.update_user_stats(int(p["player_id"]), 5, False, False)
-                        else:
-                            doc = next(po for po in self.players if isinstance(po["role"], Doctor))
-                            self.update_user_stats(int(doc["player_id"]), 5, False, False)
-
-
-            # Логика Судьи
-            elif action["action"] == "cancel_vote" and action["player_id"] != self.lblock_player and action["player_id"] != final_kill_target and action["player_id"] != m_kill_target:
-                v = next(p for p in self.players if p["player_id"] == action["player_id"])
-                v["role"].vote_canceled = False
-                self.vote_canceled = action["target_id"]
-                self.update_user_stats(int(action["player_id"]), 5, False, False)
-
-            # Логика Бомжа
-            elif action["action"] == "start_tracking" and action["player_id"] != self.lblock_player and action[
-                "player_id"] != final_kill_target and action["player_id"] != m_kill_target:
-                t = "Сегодня всё тихо."
-
-                # Проверяем, совпадает ли цель с жертвой мафии
-                if action["target_id"] == final_kill_target:
-                    ma = [po for po in self.players if isinstance(po["role"], (Mafia, DonMafia))]
-                    p = random.choice(ma)
-                    t = f"ОЙ!! Кажется, вы видели {p['player_name']} на месте преступления."
-
-                # Проверяем, совпадает ли цель с жертвой маньяка
-                elif action["target_id"] == m_kill_target:
-                    p = next(po for po in self.players if isinstance(po["role"], Maniac))
-                    t = f"ОЙ!! Кажется, вы видели {p['player_name']} на месте преступления."
-
-                # Проверяем, если игрок следит за мафией или маньяком
-                elif action["target_id"] in [po["player_id"] for po in self.players if isinstance(po["role"], (Mafia, DonMafia, Maniac))]:
-                    t = "Странно, но дома никого не было..."
-
-                # Добавляем результат
-                results.append({
-                    "action": "start_tracking",
-                    "player_id": action["player_id"],
-                    "target_id": action["target_id"],
-                    "text": t
-                })
-                if t != "Сегодня всё тихо.":
-                    self.update_user_stats(int(action["player_id"]), 4, False, False)
-
-        return results
+    # ----- Снимок состояния -----
+
+    def to_dict(self):
+        """
+        Компактный снимок игры для сохранения между перезапусками.
+        """
+        roster = list(self._players)
+        roster += [p for p in self.players if p not in roster]
+        return {
+            "game_id": self.game_id,
+            "chat_id": self.chat_id,
+            "topic_id": self.topic_id,
+            "creator_id": self.creator_id,
+            "state": self.state,
+            "day_stage": self.day_stage,
+            "nominee_id": self.nominee_id,
+            "phase_seq": self.phase_seq,
+            "players": [[p.player_id, p.player_name, role_to_dict(p.role)] for p in roster],
+            "alive": [p.player_id for p in self.players],
+            "started": [p.player_id for p in self._players],
+            "night_actions": self.night_actions,
+            "lblock_player": self.lblock_player,
+            "nominations": list(self.nominations.items()),
+            "vote_canceled": self.vote_canceled,
+            "history": self.history,
+        }
+
+    @classmethod
+    def from_dict(cls, data, rng=None):
+        game = cls(data["game_id"], topic_id=data["topic_id"], chat_id=data["chat_id"], rng=rng)
+        game.creator_id = data["creator_id"]
+        game.state = data["state"]
+        game.day_stage = data["day_stage"]
+        game.nominee_id = data["nominee_id"]
+        game.phase_seq = data["phase_seq"]
+        by_id = {}
+        for player_id, player_name, role in data["players"]:
+            by_id[player_id] = Player(player_id, player_name, role_from_dict(role, player_id))
+        game.players = [by_id[player_id] for player_id in data["alive"]]
+        game._players = [by_id[player_id] for player_id in data["started"]]
+        game.roles = [p.role for p in by_id.values() if p.role]
+        game.night_actions = data["night_actions"]
+        game.lblock_player = data["lblock_player"]
+        game.nominations = dict(data["nominations"])
+        game.vote_canceled = data["vote_canceled"]
+        game.history = data.get("history", [])
+        return game
+
+    # ----- Конечный автомат игры -----
+
+    def handle(self, event):
+        """
+        Обрабатывает событие и возвращает список эффектов.
+        Метод синхронный и не делает ввода-вывода.
+        """
+        self.changed = True  # отказ (reject) и устаревший таймер сбрасывают
+        effects = self._handlers[type(event)](self, event)
+        if self._stats:
+            effects.extend(self._stats)
+            self._stats = []
+        # Ряды кнопок делятся между сообщениями одного перехода; дальше их
+        # держат только эффекты, а игра между фазами кэш не хранит
+        self._keyboards.clear()
+        return effects
+
+    def reject(self, text):
+        # Отказ нажатию: игра не изменилась, и снимок переписывать незачем
+        self.changed = False
+        return [AnswerCallback(text, show_alert=True)]
+
+    def say(self, text, buttons=None):
+        # Сообщение в общий чат игры
+        return SendMessage(self.chat_id, text, thread_id=self.topic_id, buttons=buttons)
+
+    def deadline(self, delay):
+        # Новая фаза: прежний дедлайн становится устаревшим
+        self.phase_seq += 1
+        return Schedule(delay, PhaseTimeout(self.phase_seq))
+
+    def find_player(self, player_id):
+        return next((p for p in self.players if p.player_id == player_id), None)
+
+    def voters_count(self, exclude=None):
+        # Сколько игроков должны проголосовать днём
+        return sum(1 for p in self.players if p.player_id != self.lblock_player and p.player_id != exclude)
+
+    def _on_start(self, event):
+        refusal = None
+        if self.state != "waiting":
+            refusal = "Игра уже начата"
+        elif event.user_id != self.creator_id:
+            refusal = "Только создатель игры может запустить её."
+        elif len(self.players) < 4:
+            refusal = "Недостаточно игроков для начала игры. Минимум 4."
+        if refusal:
+            self.changed = False
+            return [self.say(refusal)]
+
+        self.start_game()
+        player_roles = distribute_roles(self.players, self.rng)
+        self.roster_changed()  # Раздача перемешала игроков
+
+        effects = []
+        mafia = [p for p in self.players if p.kind & MAFIA]
+        for player_id, role in player_roles.items():
+            effects.append(SendMessage(player_id, f"Ваша роль: {role.role_name}. {role.role_desk}", required=True))
+            if 1 < len(mafia) and player_id in [p.player_id for p in mafia]:
+                mtxt = "Ваши напарники:\n"
+                for p in mafia:
+                    if p.player_id != player_id:
+                        mtxt += f"{p.player_name} {p.role.role_name}\n"
+                effects.append(SendMessage(player_id, mtxt))
+
+        effects.append(self.say("Роли распределены, игра начинается! Ночная фаза началась."))
+        return effects + self.start_night()
+
+    # Ночная фаза
+    def start_night(self):
+        self.state = "night"
+        self.day_stage = None
+        return [self.say("Ночная фаза: роли начинают свои действия.")] + self.night_keyboards() + [self.deadline(NIGHT_TIME)]
+
+    def night_keyboards(self):
+        effects = []
+        for player in self.players:
+            keyboard = player.role.keyboard(self, player) if player.role else None
+            if keyboard is not None:
+                text, buttons = keyboard
+                effects.append(SendMessage(player.player_id, text, buttons=buttons))
+        return effects
+
+    def players_with_actions(self):
+        return [p for p in self.players if p.role is None or p.role.has_night_action()]
+
+    def _on_night_action(self, event):
+        if self.state != "night":
+            return self.reject("Сейчас нельзя выполнить действие.")
+
+        # Проверка, не совершал ли игрок уже действие
+        if event.player_id in [a['player_id'] for a in self.night_actions]:
+            return self.reject("Вы уже выбрали действие!")
+
+        if event.action == "skip":
+            self.night_actions.append({"action": event.action, "player_id": event.player_id})
+            effects = [EditMessage(event.chat_id, event.message_id, "Вы не дали никому иммунитет")]
+        else:
+            target = self.find_player(event.target_id)
+            if target is None:
+                return self.reject("Некорректный выбор.")
+            self.night_actions.append({"action": event.action, "player_id": event.player_id, "target_id": event.target_id})
+            effects = [
+                AnswerCallback("Ваше действие принято."),
+                EditMessage(event.chat_id, event.message_id, f"Ваш выбор {target.player_name}"),
+            ]
+
+        # Проверяем, все ли игроки выполнили действия
+        acted = {a['player_id'] for a in self.night_actions}
+        if all(p.player_id in acted for p in self.players_with_actions()):
+            effects += self.end_night()
+        return effects
+
+    def end_night(self):
+        results = self.process_night_actions()
+        effects = []
+        start_day_text = ""
+        for result in results:
+            self.history.append([self.phase_seq, result["action"], result.get("player_id"), result.get("target_id")])
+            if result["action"] in ("kill", "m_kill", "explode"):
+                # Одного игрока могут убить дважды за ночь
+                if self.find_player(result["target_id"]):
+                    self.del_player(result["target_id"])
+                start_day_text += result["text"] + "\n"
+
+            if result["action"] in ("investigate", "start_tracking"):
+                effects.append(SendMessage(result["player_id"], result["text"]))
+
+        if not any(player.kind & DON for player in self.players) and any(player.kind & MAFIA for player in self.players):
+            ma = [po for po in self.players if po.kind & MAFIA]
+            m = self.rng.choice(ma)
+            self.change_role(m.player_id, DonMafia)
+            effects.append(SendMessage(m.player_id, f"Ваш Дон погиб, вы занимаете его место. {m.role.role_desk}"))
+
+        effects.append(self.say(start_day_text or "Этой ночью всё спокойно"))
+
+        winner = self.declare_winner()
+        if winner:
+            return effects + winner
+
+        self.night_actions = []
+        self.state = "day"
+        self.day_stage = "discussion"
+        effects.append(self.say("Наступает день. Обсудите и голосуйте."))
+        effects.append(self.deadline(DISCUSSION_TIME))
+        return effects
+
+    # Истёк дедлайн фазы: решаем с тем, что успели прислать
+    def _on_timeout(self, event):
+        if event.seq != self.phase_seq or self.state == "finished":
+            self.changed = False
+            return []
+        if self.state == "night":
+            return [self.say("Время ночи вышло.")] + self.end_night()
+        if self.day_stage == "discussion":
+            return self.start_nomination()
+        if self.day_stage == "nomination":
+            return [self.say("Время на номинации вышло.")] + self.process_nominations()
+        if self.day_stage == "final_vote":
+            return [self.say("Голосование окончено.")] + self.finalize_final_vote()
+        return []
+
+    # Дневная фаза
+    def start_nomination(self):
+        self.day_stage = "nomination"
+        self.nominations = {}
+        effects = [self.say("Обсуждение закончилось. Выдвигайте кандидатов на голосование в личных сообщениях.")]
+        for player in self.players:
+            if player.player_id != self.lblock_player:
+                # Получивший иммунитет судьи в списке не показывается
+                buttons = self.buttons_for(("nomination",), self.nomination_row, viewer=player.player_id,
+                                           hidden=self.vote_canceled) + [[("Пропустить", "nominate:skip")]]
+                effects.append(SendMessage(player.player_id, "Выберите игрока для номинации или воздержитесь.", buttons=buttons))
+        effects.append(self.deadline(NOMINATION_TIME))
+        return effects
+
+    @staticmethod
+    def nomination_row(player):
+        return [(player.player_name, f"nominate:{player.player_id}")]
+
+    def _on_nominate(self, event):
+        if self.state != "day" or self.day_stage != "nomination" or event.player_id in self.nominations:
+            return self.reject("Сейчас нельзя голосовать")
+
+        if event.player_id == self.lblock_player:
+            return self.reject("Вы заблокированы любовницей и не можете голосовать.")
+
+        if event.nominee_id is None:
+            self.nominations[event.player_id] = None
+            effects = [EditMessage(event.chat_id, event.message_id, "Вы воздержались от номинации.")]
+        else:
+            nominee = self.find_player(event.nominee_id)
+            if nominee is None:
+                return self.reject("Некорректный выбор.")
+            self.nominations[event.player_id] = event.nominee_id
+            effects = [EditMessage(event.chat_id, event.message_id, f"Вы выбрали игрока {nominee.player_name}.")]
+
+        if len(self.nominations) >= self.voters_count():
+            effects += self.process_nominations()
+        return effects
+
+    def process_nominations(self):
+        vote_counts = {}
+        for nominee in self.nominations.values():
+            if nominee:
+                vote_counts[nominee] = vote_counts.get(nominee, 0) + 1
+
+        if not vote_counts:
+            return [self.say("Никто не был номинирован. День заканчивается.")] + self.start_night()
+
+        max_votes = max(vote_counts.values())
+        top_nominees = [player_id for player_id, count in vote_counts.items() if count == max_votes]
+
+        if len(top_nominees) > 1:
+            return [self.say("Несколько игроков номинированы с равным количеством голосов. Никто не будет линчеван. День заканчивается.")] + self.start_night()
+        return self.start_final_vote(top_nominees[0])
+
+    # Финальное голосование
+    def start_final_vote(self, nominee_id):
+        self.nominations = {}
+        self.day_stage = "final_vote"
+        self.nominee_id = nominee_id
+        self.history.append([self.phase_seq, "nominated", None, nominee_id])
+        nominee = self.find_player(nominee_id)
+        buttons = [[("Да", f"final_vote:yes:{nominee_id}"), ("Нет", f"final_vote:no:{nominee_id}")]]
+        return [
+            self.say(f"Голосуйте за казнь игрока {nominee.player_name}. Да или Нет?", buttons=buttons),
+            self.deadline(FINAL_VOTE_TIME),
+        ]
+
+    def _on_final_vote(self, event):
+        if self.state != "day" or self.day_stage != "final_vote" or event.nominee_id != self.nominee_id:
+            return self.reject("Сейчас нельзя голосовать.")
+
+        if event.player_id in self.nominations:
+            return self.reject("Вы уже проголосовали.")
+
+        if event.player_id == self.lblock_player:
+            return self.reject("Вы заблокированы и не можете голосовать.")
+
+        if event.player_id == event.nominee_id:
+            return self.reject("Вы не можете голосовать за себя")
+
+        self.nominations[event.player_id] = event.decision
+        effects = [AnswerCallback("Ваш голос учтен.")]
+
+        # Кандидат сам не голосует
+        if len(self.nominations) >= self.voters_count(exclude=self.nominee_id):
+            effects += self.finalize_final_vote()
+        return effects
+
+    def finalize_final_vote(self):
+        yes_votes = sum(1 for vote in self.nominations.values() if vote == "yes")
+        no_votes = sum(1 for vote in self.nominations.values() if vote == "no")
+        nominee = self.find_player(self.nominee_id)
+        self.nominee_id = None
+
+        if yes_votes > no_votes:
+            self.del_player(nominee.player_id)
+            self.history.append([self.phase_seq, "lynched", None, nominee.player_id])
+            effects = [self.say(f"Игрок {nominee.player_name} был линчёван.")]
+        else:
+            self.history.append([self.phase_seq, "spared", None, nominee.player_id])
+            effects = [self.say(f"Игрок {nominee.player_name} остался жив.")]
+
+        return effects + (self.declare_winner() or self.start_night())
+
+    def declare_winner(self):
+        winner = self.check_winner()
+        if not winner:
+            return None
+        if winner == "peaceful":
+            text = "Мирные жители победили! Мафия уничтожена."
+        elif winner == "mafia":
+            text = "Мафия победила! Мирные жители проиграли."
+        else:
+            text = "Маньяк победил!"
+        self.end_game()
+        return [self.say(text), Settle(self.settlement), GameOver()]
+
+    _handlers = {
+        StartGame: _on_start,
+        NightAction: _on_night_action,
+        PhaseTimeout: _on_timeout,
+        Nominate: _on_nominate,
+        FinalVote: _on_final_vote,
+    }
+
+
+# Распределение ролей
+def distribute_roles(players, rng=random):
+    num_players = len(players)
+    roles = []
+
+    if num_players <= 6:
+        roles = [DonMafia(None), Commissioner(None), Doctor(None)] + [Villager(None)] * (num_players - 3)
+    elif num_players <= 9:
+        roles = [Mafia(None), DonMafia(None), Commissioner(None), Doctor(None), Lover(None)] + [Villager(None)] * (num_players - 5)
+    elif num_players <= 12:
+        roles = [DonMafia(None), Commissioner(None), Doctor(None), Lover(None), Kamikaze(None), Hobo(None)] + [Villager(None)] * (num_players - 8) + [Mafia(None)]* 2
+    elif num_players <= 15:
+        roles = [DonMafia(None), Commissioner(None), Doctor(None), Lover(None), Kamikaze(None), Hobo(None), Judge(None), Maniac(None)] + [Villager(None)] * (num_players - 11) + [Mafia(None)]* 3
+
+
+    rng.shuffle(players)
+    rng.shuffle(roles)
+
+    player_roles = {}
+    for player, role in zip(players, roles):
+        player.set_role(role)
+        role.player_id = player.player_id
+        player_roles[player.player_id] = role
+
+    return player_roles
@@ -0,0 +1,182 @@
+"""
+Приём обновлений через вебхук (aiohttp) вместо long polling.
+
+Telegram получает 200 сразу после проверки секрета, а само обновление
+уходит в ограниченную очередь, которую разбирает пул воркеров.
+Каждое обновление воркер запускает отдельной задачей (не больше
+concurrency одновременно): обработчики ждут отправки ответов и не
+должны занимать воркеров, пока очередь растёт.
+
+Локальная проверка: записать обновления (RECORD_UPDATES=updates.jsonl)
+и проиграть их на сервер:
+    python webhook.py replay updates.jsonl http://127.0.0.1:10000/webhook SECRET
+"""
+import asyncio
+import hmac
+import json
+import logging
+import time
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    def __init__(self, dp, bot, path="/webhook", secret=None, workers=8, queue_size=1000, concurrency=256):
+        if not secret:
+            # Без секрета любой, кто знает адрес, может слать боту поддельные обновления
+            raise ValueError("WebhookServer требует secret (X-Telegram-Bot-Api-Secret-Token)")
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._handlers = asyncio.Semaphore(concurrency)  # обработчиков одновременно
+        self._inflight = set()
+        self._tasks = []
+        self._runner = None
+        # Метрики
+        self.received = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def handle(self, request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            self.rejected += 1
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait((time.monotonic(), data))
+        except asyncio.QueueFull:
+            # Telegram повторит доставку позже
+            self.dropped += 1
+            return web.Response(status=503)
+        self.received += 1
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            received_at, data = await self.queue.get()
+            # Обработчик может долго ждать отправки ответов (лимиты Telegram),
+            # поэтому идёт отдельной задачей, а воркер сразу берёт следующее
+            await self._handlers.acquire()
+            task = asyncio.get_running_loop().create_task(self._feed(received_at, data))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _feed(self, received_at, data):
+        try:
+            update = Update.model_validate(data, context={"bot": self.bot})
+            await self.dp.feed_update(self.bot, update, received_at=received_at)
+        except Exception:
+            logging.exception("Ошибка при обработке обновления из вебхука")
+        finally:
+            self._handlers.release()
+            self.queue.task_done()
+
+    async def start(self, host="0.0.0.0", port=10000):
+        self._tasks = [asyncio.get_running_loop().create_task(self._worker()) for _ in range(self.workers)]
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info("Вебхук слушает %s:%s%s", host, port, self.path)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        # Дорабатываем то, что уже принято
+        await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+class UpdateLatency(BaseMiddleware):
+    """
+    Задержка от получения обновления до запуска обработчиков.
+
+    В режиме вебхука received_at ставит сервер при приёме запроса,
+    при polling — сам диспетчер, поэтому для сравнения режимов есть
+    ещё telegram_delay: время от даты сообщения до получения (точность
+    Telegram — секунда, поэтому сравнивать стоит средние).
+    """
+    def __init__(self, record_path=None, window=1000):
+        self.window = window
+        self.handler_delay = []
+        self.telegram_delay = []
+        self._record = open(record_path, "a", encoding="utf-8") if record_path else None
+
+    def _push(self, values, value):
+        values.append(value)
+        if len(values) > self.window:
+            del values[0]
+
+    async def __call__(self, handler, event, data):
+        received_at = data.setdefault("received_at", time.monotonic())
+        self._push(self.handler_delay, time.monotonic() - received_at)
+        if event.message is not None:
+            self._push(self.telegram_delay, time.time() - event.message.date.timestamp())
+        if self._record is not None:
+            self._record.write(event.model_dump_json(exclude_none=True) + "\n")
+            self._record.flush()
+        return await handler(event, data)
+
+    def summary(self):
+        def mean(values):
+            return sum(values) / len(values) if values else 0.0
+        return {
+            "handler_delay_ms": mean(self.handler_delay) * 1000,
+            "telegram_delay_ms": mean(self.telegram_delay) * 1000,
+            "samples": len(self.handler_delay),
+        }
+
+
+async def replay(path, url, secret=None, concurrency=10):
+    """
+    Отправляет записанные обновления на вебхук и меряет время ответа.
+    """
+    from aiohttp import ClientSession
+
+    with open(path, encoding="utf-8") as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    headers = {SECRET_HEADER: secret} if secret else {}
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+
+    async def post(session, update):
+        async with semaphore:
+            started = time.perf_counter()
+            async with session.post(url, json=update, headers=headers) as response:
+                await response.read()
+                timings.append((response.status, time.perf_counter() - started))
+
+    async with ClientSession() as session:
+        await asyncio.gather(*(post(session, update) for update in updates))
+
+    ok = sorted(t for status, t in timings if status == 200)
+    print(f"отправлено {len(timings)}, принято {len(ok)}")
+    if ok:
+        print(f"ответ: p50 {ok[len(ok) // 2] * 1000:.2f} мс, max {ok[-1] * 1000:.2f} мс")
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) >= 4 and sys.argv[1] == "replay":
+        asyncio.run(replay(sys.argv[2], sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else None))
+    else:
+        print(__doc__)